@@ -0,0 +1,148 @@
+"""Compare the speed and output of the Python synth and liboddvoices.
+
+    python benchmarks/parity.py [MUSIC_JSON ...]
+
+Each music file is rendered by oddvoices.synth and by the liboddvoices_frontend
+binary. Files with "segments" and "events" are rendered as they are; files with
+"text", "notes" and "durations" are first converted by oddvoices.frontend, which
+needs the pronunciation dictionary. For each case, the harness reports the real-time
+factor of both engines and the sample and spectral differences between them. The
+C++ timing includes process startup and writing the WAV file.
+
+If the C++ binary has not been built, the harness says so and exits successfully.
+"""
+
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.signal
+import soundfile
+
+import oddvoices.corpus
+import oddvoices.frontend
+import oddvoices.g2p
+import oddvoices.synth
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+DEFAULT_BINARY = REPO_ROOT / "liboddvoices/build/liboddvoices_frontend"
+DEFAULT_VOICE = REPO_ROOT / "tests/compiled-voices/quake.voice"
+DEFAULT_MUSIC_DIR = pathlib.Path(__file__).resolve().parent / "music"
+
+
+def spectrogram(signal):
+    return np.abs(scipy.signal.stft(signal)[2])
+
+
+def to_synth_music(music, database, pronunciation_dict):
+    if "events" in music:
+        return music
+    synth = oddvoices.synth.Synth(database)
+    return oddvoices.frontend.make_music(synth, music, pronunciation_dict)
+
+
+def render_python(database, music):
+    synth = oddvoices.synth.Synth(database)
+    start = time.perf_counter()
+    result = oddvoices.synth.sing(synth, music)
+    return result, time.perf_counter() - start
+
+
+def render_cpp(binary, voice_file, music):
+    with tempfile.TemporaryDirectory() as directory:
+        music_file = pathlib.Path(directory) / "music.json"
+        out_file = pathlib.Path(directory) / "out.wav"
+        with open(music_file, "w") as f:
+            json.dump(music, f)
+        start = time.perf_counter()
+        subprocess.run([str(binary), str(voice_file), music_file, out_file], check=True)
+        elapsed = time.perf_counter() - start
+        result, rate = soundfile.read(out_file, dtype="float32")
+    return result, elapsed
+
+
+def compare_case(name, binary, voice_file, database, music):
+    result_py, seconds_py = render_python(database, music)
+    result_cpp, seconds_cpp = render_cpp(binary, voice_file, music)
+
+    rate = database["rate"]
+    length = min(len(result_py), len(result_cpp))
+    difference = result_py[:length] - result_cpp[:length]
+    spectral_difference = np.abs(
+        spectrogram(result_py[:length]) - spectrogram(result_cpp[:length])
+    )
+    return {
+        "name": name,
+        "python_samples": len(result_py),
+        "cpp_samples": len(result_cpp),
+        "python_real_time_factor": len(result_py) / rate / seconds_py,
+        "cpp_real_time_factor": len(result_cpp) / rate / seconds_cpp,
+        "max_sample_difference": float(np.max(np.abs(difference), initial=0)),
+        "rms_sample_difference": (
+            float(np.sqrt(np.mean(difference**2))) if length else 0.0
+        ),
+        "max_spectral_difference": float(np.max(spectral_difference, initial=0)),
+        "mean_spectral_difference": (
+            float(np.mean(spectral_difference)) if spectral_difference.size else 0.0
+        ),
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("music_files", nargs="*")
+    parser.add_argument("--voice", default=str(DEFAULT_VOICE))
+    parser.add_argument("--binary", default=str(DEFAULT_BINARY))
+    parser.add_argument(
+        "--float-arena",
+        action="store_true",
+        help="load the voice for the Python engine with float_arena=True",
+    )
+    parser.add_argument("-o", "--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    binary = pathlib.Path(args.binary)
+    if not binary.exists():
+        print(
+            f"Skipping: {binary} not found. Build liboddvoices to compare engines.",
+            file=sys.stderr,
+        )
+        return
+
+    music_files = args.music_files or sorted(DEFAULT_MUSIC_DIR.glob("*.json"))
+    with open(args.voice, "rb") as f:
+        database = oddvoices.corpus.read_voice_file(f, float_arena=args.float_arena)
+
+    pronunciation_dict = None
+    report = []
+    for music_file in music_files:
+        with open(music_file) as f:
+            music = json.load(f)
+        if "events" not in music and pronunciation_dict is None:
+            pronunciation_dict = oddvoices.g2p.read_cmudict()
+        music = to_synth_music(music, database, pronunciation_dict)
+        case = compare_case(
+            pathlib.Path(music_file).stem, binary, args.voice, database, music
+        )
+        report.append(case)
+        print(
+            f"{case['name']:20}"
+            f" python {case['python_real_time_factor']:7.2f}x"
+            f" cpp {case['cpp_real_time_factor']:7.2f}x"
+            f" max diff {case['max_sample_difference']:.4f}"
+            f" max spectral diff {case['max_spectral_difference']:.4f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""Performance benchmarks for OddVoices.
+
+    python benchmarks/suite.py run -o results.json
+    python benchmarks/suite.py compare baseline.json results.json
+
+"run" measures the synth, voice file I/O, G2P and voice compilation using the voice
+and corpora bundled with the repository, and writes the results as JSON. "compare"
+reads two result files and exits with status 1 if any benchmark regressed by more
+than the threshold.
+"""
+
+import copy
+import io
+import json
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import oddvoices.corpus
+import oddvoices.g2p
+import oddvoices.phrase_cache
+import oddvoices.resample
+import oddvoices.synth
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+DEFAULT_VOICE = REPO_ROOT / "tests/compiled-voices/quake.voice"
+DEFAULT_CORPUS = REPO_ROOT / "voices/quake"
+EXAMPLE_DIR = REPO_ROOT / "example"
+
+GROUPS = ["synth", "draft", "resample", "phrase_cache", "voice_io", "g2p", "compile"]
+FREQUENCIES = [100, 200, 400]
+FORMANT_SHIFTS = [0.5, 1.0, 2.0]
+LAYOUTS = ["int16", "float32", "pooled"]
+# Threshold of oddvoices.corpus.dedupe_frames for the pooled layout.
+DEDUPE_THRESHOLD = 0.002
+NOTE_DURATION = 2.0
+PHRASE_REPEATS = 8
+OUTPUT_RATES = [48000, 96000]
+
+
+def make_note_music(frequency, formant_shift):
+    return {
+        "segments": [-1, 0, 1, 2],
+        "events": [
+            {
+                "frequency": frequency,
+                "formant_shift": formant_shift,
+                "duration": NOTE_DURATION,
+                "note_on": True,
+            },
+            {"duration": 0.3, "note_off": True},
+        ],
+    }
+
+
+def get_syllable_segments(database):
+    """Indices of the segments of a syllable that is a single long vowel, sung
+    from silence to silence."""
+    segments_list = database["segments_list"]
+    for name in segments_list:
+        if database["segments"][name]["long"]:
+            if "_" + name in segments_list and name + "_" in segments_list:
+                return [segments_list.index(s) for s in ["_" + name, name, name + "_"]]
+    raise RuntimeError("Voice has no syllable for the phrase cache benchmark")
+
+
+def make_repeated_music(database, repeats):
+    """A short phrase sung repeats times, with a rest before each repeat."""
+    syllable = [-1] + get_syllable_segments(database)
+    music: dict = {"segments": [], "events": []}
+    for i in range(repeats):
+        music["segments"] += syllable * 2
+        music["events"] += [
+            {"duration": 0.25},
+            {"frequency": 200, "duration": 0.5, "note_on": True},
+            {"duration": 0.1, "note_off": True},
+            {"frequency": 300, "duration": 0.5, "note_on": True},
+            {"duration": 0.2, "note_off": True},
+        ]
+    return music
+
+
+def get_frame_bytes(database):
+    if "frames" in database:
+        return database["frames"].nbytes
+    if "frame_pool" in database:
+        return database["frame_pool"].nbytes + sum(
+            database["segments"][segment_id]["frame_indices"].nbytes
+            for segment_id in database["segments_list"]
+        )
+    return sum(
+        database["segments"][segment_id]["frames"].nbytes
+        for segment_id in database["segments_list"]
+    )
+
+
+def best_time(function, repeat):
+    """Call function repeat times and return the shortest wall time and the
+    result of the last call."""
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def result(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def benchmark_synth(args, results):
+    for layout in LAYOUTS:
+        with open(args.voice, "rb") as f:
+            database = oddvoices.corpus.read_voice_file(
+                f, float_arena=layout == "float32"
+            )
+        if layout == "pooled":
+            report = oddvoices.corpus.dedupe_frames(database, DEDUPE_THRESHOLD)
+            results["synth/pooled/snr_db"] = result(report["snr_db"], "dB", True)
+        results[f"synth/{layout}/frame_bytes"] = result(
+            get_frame_bytes(database), "bytes", False
+        )
+        for frequency in FREQUENCIES:
+            for formant_shift in FORMANT_SHIFTS:
+                music = make_note_music(frequency, formant_shift)
+
+                def render():
+                    synth = oddvoices.synth.Synth(database)
+                    return oddvoices.synth.sing(synth, music)
+
+                seconds, audio = best_time(render, args.repeat)
+                duration = len(audio) / database["rate"]
+                name = f"synth/{layout}/frequency={frequency}/formant_shift={formant_shift}"
+                results[name] = result(duration / seconds, "x real time", True)
+
+
+def benchmark_draft(args, results):
+    """Compare the real-time factor of draft renders with full quality ones."""
+    with open(args.voice, "rb") as f:
+        database = oddvoices.corpus.read_voice_file(f)
+    for frequency in FREQUENCIES:
+        music = make_note_music(frequency, 1.0)
+        speeds = {}
+        for name, synth_class in [
+            ("full", oddvoices.synth.Synth),
+            ("draft", oddvoices.synth.DraftSynth),
+        ]:
+
+            def render():
+                synth = synth_class(database)
+                return synth, oddvoices.synth.sing(synth, music)
+
+            seconds, (synth, audio) = best_time(render, args.repeat)
+            speeds[name] = len(audio) / synth.sample_rate / seconds
+            results[f"draft/{name}/frequency={frequency}"] = result(
+                speeds[name], "x real time", True
+            )
+        results[f"draft/speedup/frequency={frequency}"] = result(
+            speeds["draft"] / speeds["full"], "x", True
+        )
+
+
+def get_imaging_db(audio, sample_rate, cutoff):
+    """Energy of audio above cutoff, relative to its total energy, in dB. The
+    voice has no content above its Nyquist frequency, so anything there is an
+    artifact of rendering at a higher rate."""
+    power = np.square(np.abs(np.fft.rfft(audio)))
+    frequencies = np.fft.rfftfreq(len(audio), 1 / sample_rate)
+    return float(10 * np.log10(np.sum(power[frequencies > cutoff]) / np.sum(power)))
+
+
+def benchmark_resample(args, results):
+    """Compare rendering at the output rate with rendering at the voice's rate
+    and resampling, for speed and for imaging above the voice's Nyquist."""
+    with open(args.voice, "rb") as f:
+        database = oddvoices.corpus.read_voice_file(f)
+    music = make_note_music(200, 1.0)
+    for output_rate in OUTPUT_RATES:
+        if output_rate == database["rate"]:
+            continue
+
+        def render_direct():
+            synth = oddvoices.synth.Synth(database, sample_rate=output_rate)
+            return oddvoices.synth.sing(synth, music)
+
+        def render_resampled():
+            synth = oddvoices.synth.Synth(database)
+            blocks = oddvoices.synth.sing_blocks(synth, music)
+            return np.concatenate(
+                list(
+                    oddvoices.resample.resample_blocks(
+                        blocks, synth.sample_rate, output_rate
+                    )
+                )
+            )
+
+        for name, render in [
+            ("direct", render_direct),
+            ("resampled", render_resampled),
+        ]:
+            seconds, audio = best_time(render, args.repeat)
+            prefix = f"resample/{name}/rate={output_rate}"
+            results[f"{prefix}/speed"] = result(
+                len(audio) / output_rate / seconds, "x real time", True
+            )
+            results[f"{prefix}/imaging"] = result(
+                get_imaging_db(audio, output_rate, database["rate"] / 2), "dB", False
+            )
+
+
+def benchmark_phrase_cache(args, results):
+    with open(args.voice, "rb") as f:
+        database = oddvoices.corpus.read_voice_file(f)
+    music = make_repeated_music(database, PHRASE_REPEATS)
+
+    def render(phrase_cache, canonical_phrase_starts=False):
+        synth = oddvoices.synth.Synth(database)
+        synth.canonical_phrase_starts = canonical_phrase_starts
+        return oddvoices.synth.sing(synth, music, phrase_cache=phrase_cache)
+
+    # In exact mode, repeats within the music do not hit, so the cache only
+    # speeds up rendering the same music again. The output is unchanged.
+    seconds, expected = best_time(lambda: render(None), args.repeat)
+    duration = len(expected) / database["rate"]
+    results["phrase_cache/exact/uncached"] = result(
+        duration / seconds, "x real time", True
+    )
+    phrase_cache = oddvoices.phrase_cache.PhraseCache()
+    render(phrase_cache)
+    seconds, audio = best_time(lambda: render(phrase_cache), args.repeat)
+    assert np.array_equal(audio, expected)
+    results["phrase_cache/exact/rerender"] = result(
+        duration / seconds, "x real time", True
+    )
+
+    # The lossy canonical mode makes repeats after a rest hit in a first render.
+    for name, make_cache in [
+        ("uncached", lambda: None),
+        ("cached", oddvoices.phrase_cache.PhraseCache),
+    ]:
+        seconds, audio = best_time(lambda: render(make_cache(), True), args.repeat)
+        duration = len(audio) / database["rate"]
+        results[f"phrase_cache/canonical/{name}/repeats={PHRASE_REPEATS}"] = result(
+            duration / seconds, "x real time", True
+        )
+
+    # Incremental re-renders after editing one note. Everything from the edit on
+    # is rendered again, so an early edit saves little.
+    notes = [i for i, event in enumerate(music["events"]) if "note_on" in event]
+    for name, index in [
+        ("first", notes[0]),
+        ("middle", notes[len(notes) // 2]),
+        ("last", notes[-1]),
+    ]:
+        edited = copy.deepcopy(music)
+        edited["events"][index]["frequency"] = 250
+        seconds, audio = time_incremental_render(database, music, edited, args.repeat)
+        duration = len(audio) / database["rate"]
+        results[f"phrase_cache/incremental/edit={name}"] = result(
+            duration / seconds, "x real time", True
+        )
+
+
+def time_incremental_render(database, music, edited, repeat):
+    """Render music through a phrase cache directory, then return the shortest
+    time to render edited through the same directory, and its audio."""
+    best = float("inf")
+    for i in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            synth = oddvoices.synth.Synth(database)
+            phrase_cache = oddvoices.phrase_cache.PhraseCache(directory=directory)
+            oddvoices.synth.sing(synth, music, phrase_cache=phrase_cache)
+            start = time.perf_counter()
+            synth = oddvoices.synth.Synth(database)
+            phrase_cache = oddvoices.phrase_cache.PhraseCache(directory=directory)
+            audio = oddvoices.synth.sing(synth, edited, phrase_cache=phrase_cache)
+            best = min(best, time.perf_counter() - start)
+    return best, audio
+
+
+def benchmark_voice_io(args, results):
+    with open(args.voice, "rb") as f:
+        data = f.read()
+    megabytes = len(data) / 1e6
+
+    seconds, database = best_time(
+        lambda: oddvoices.corpus.read_voice_file(io.BytesIO(data)), args.repeat
+    )
+    results["voice_io/read_voice_file"] = result(megabytes / seconds, "MB/s", True)
+
+    seconds, _ = best_time(
+        lambda: oddvoices.corpus.write_voice_file(io.BytesIO(), database),
+        args.repeat,
+    )
+    results["voice_io/write_voice_file"] = result(megabytes / seconds, "MB/s", True)
+
+    f = io.BytesIO()
+    oddvoices.corpus.write_voice_file(f, database, compress=True)
+    compressed = f.getvalue()
+    results["voice_io/compressed_size"] = result(
+        len(compressed) / len(data), "ratio", False
+    )
+
+    def read_compressed():
+        result = oddvoices.corpus.read_voice_file(io.BytesIO(compressed))
+        for segment_id in result["segments_list"]:
+            oddvoices.corpus.get_segment_frames(result, segment_id)
+
+    seconds, _ = best_time(read_compressed, args.repeat)
+    results["voice_io/read_compressed_voice_file"] = result(
+        megabytes / seconds, "MB/s", True
+    )
+
+
+def benchmark_g2p(args, results):
+    seconds, pronunciation_dict = best_time(oddvoices.g2p.read_cmudict, args.repeat)
+    results["g2p/read_cmudict"] = result(
+        len(pronunciation_dict) / seconds, "words/s", True
+    )
+
+    texts = []
+    for path in sorted(EXAMPLE_DIR.glob("*.json")):
+        with open(path) as f:
+            texts.append(json.load(f)["text"])
+    text = " ".join(texts)
+    num_words = len(oddvoices.g2p.tokenize(text))
+    seconds, _ = best_time(
+        lambda: oddvoices.g2p.pronounce_text(text, pronunciation_dict), args.repeat
+    )
+    results["g2p/pronounce_text"] = result(num_words / seconds, "words/s", True)
+
+
+def benchmark_compile(args, results):
+    analyzer = oddvoices.corpus.CorpusAnalyzer(args.corpus)
+    seconds, _ = best_time(analyzer.render_database, 1)
+    results["compile/render_database"] = result(seconds, "s", False)
+
+
+BENCHMARKS = {
+    "synth": benchmark_synth,
+    "draft": benchmark_draft,
+    "resample": benchmark_resample,
+    "phrase_cache": benchmark_phrase_cache,
+    "voice_io": benchmark_voice_io,
+    "g2p": benchmark_g2p,
+    "compile": benchmark_compile,
+}
+
+
+def run(args):
+    results: dict = {}
+    for group in args.only or GROUPS:
+        print(f"Running {group} benchmarks...", file=sys.stderr)
+        BENCHMARKS[group](args, results)
+
+    report = {
+        "metadata": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        old = baseline[name]["value"]
+        new = current[name]["value"]
+        sign = 1 if current[name]["higher_is_better"] else -1
+        if current[name]["unit"] == "dB":
+            # Levels compare by their difference, since a ratio of two levels in
+            # dB means nothing.
+            change = sign * (new - old)
+            regressed = change < -args.db_threshold
+            change_text = f"{change:+6.1f} dB"
+        else:
+            if old == 0:
+                continue
+            change = sign * (new - old) / abs(old)
+            regressed = change < -args.threshold
+            change_text = f"{change:+8.1%}"
+        status = "ok"
+        if regressed:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:60} {old:12.4g} {new:12.4g} {change_text}  {status}")
+
+    for name in sorted(set(baseline) ^ set(current)):
+        print(f"{name:60} only in {'baseline' if name in baseline else 'current'}")
+
+    if len(regressions) != 0:
+        print(f"{len(regressions)} benchmark(s) regressed", file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("-o", "--output", help="write results to this file")
+    run_parser.add_argument("--only", nargs="+", choices=GROUPS)
+    run_parser.add_argument("--voice", default=str(DEFAULT_VOICE))
+    run_parser.add_argument("--corpus", default=str(DEFAULT_CORPUS))
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.set_defaults(function=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare results against a baseline"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown that counts as a regression (default 0.1)",
+    )
+    compare_parser.add_argument(
+        "--db-threshold",
+        type=float,
+        default=1.0,
+        help="change in dB that counts as a regression (default 1.0)",
+    )
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
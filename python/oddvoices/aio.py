@@ -0,0 +1,164 @@
+"""asyncio entry points for rendering.
+
+Rendering is CPU-bound, so it runs in an executor and the event loop only waits
+for finished blocks. By default the loop's default thread pool is used. Renders in
+threads share oddvoices.cache, so each voice and cmudict is loaded once per
+process, but they also share the GIL. Pass a
+concurrent.futures.ProcessPoolExecutor to render in parallel; each worker process
+then keeps its own cache between renders.
+
+    async for block in oddvoices.aio.sing_blocks("quake.voice", spec):
+        ...
+
+spec is a music spec for oddvoices.frontend (text, notes, durations) or music
+for oddvoices.synth (segments, events).
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import queue
+import threading
+from typing import AsyncIterator, Optional
+
+import numpy as np
+
+import oddvoices.cache
+import oddvoices.frontend
+import oddvoices.sinks
+import oddvoices.synth
+
+# How many blocks a worker process may render ahead of the consumer.
+MAX_PENDING_BLOCKS = 16
+# How often a worker process blocked on a full queue checks for cancellation.
+POLL_INTERVAL = 0.1
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def _render_blocks(voice_file, spec, sample_rate, sample_format, block_size):
+    synth = oddvoices.frontend.load_synth(voice_file, sample_rate)
+    if "events" in spec:
+        music = spec
+    else:
+        pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+        music = oddvoices.frontend.make_music(synth, spec, pronunciation_dict)
+    for block in oddvoices.synth.sing_blocks(synth, music, block_size):
+        yield oddvoices.sinks.convert_block(block, sample_format)
+
+
+def _render_to_queue(arguments, blocks, cancelled) -> None:
+    """Run in a worker process. Put each block on the queue, then None."""
+    try:
+        for block in _render_blocks(*arguments):
+            while True:
+                if cancelled.is_set():
+                    return
+                try:
+                    blocks.put(block, timeout=POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    pass
+    finally:
+        if not cancelled.is_set():
+            blocks.put(None)
+
+
+def _get_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = multiprocessing.Manager()
+        return _manager
+
+
+async def sing_blocks(
+    voice_file: str,
+    spec,
+    sample_rate: Optional[float] = None,
+    sample_format: str = "float32",
+    executor: Optional[concurrent.futures.Executor] = None,
+    block_size: int = oddvoices.synth.BLOCK_SIZE,
+) -> AsyncIterator[np.ndarray]:
+    """Render spec and yield blocks of samples in the given sample format as they
+    are ready. Cancelling the consuming task, or closing the iterator, stops the
+    render after the block in progress."""
+    arguments = (voice_file, spec, sample_rate, sample_format, block_size)
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        iterator = _sing_blocks_in_process(arguments, executor)
+    else:
+        iterator = _sing_blocks_in_thread(arguments, executor)
+    async for block in iterator:
+        yield block
+
+
+async def _sing_blocks_in_thread(arguments, executor):
+    loop = asyncio.get_running_loop()
+    blocks = _render_blocks(*arguments)
+    future = None
+    try:
+        while True:
+            # Each block is a separate executor call, so the render only advances
+            # as fast as it is consumed and stops as soon as it is not.
+            future = loop.run_in_executor(executor, next, blocks, None)
+            block = await future
+            if block is None:
+                break
+            yield block
+    finally:
+        if future is None or future.done():
+            blocks.close()
+
+
+async def _sing_blocks_in_process(arguments, executor):
+    loop = asyncio.get_running_loop()
+    manager = _get_manager()
+    blocks = manager.Queue(MAX_PENDING_BLOCKS)
+    cancelled = manager.Event()
+    future = loop.run_in_executor(
+        executor, _render_to_queue, arguments, blocks, cancelled
+    )
+    try:
+        while True:
+            # Waiting on the manager's queue blocks, so do it in a thread.
+            block = await loop.run_in_executor(None, blocks.get)
+            if block is None:
+                break
+            yield block
+        await future
+    finally:
+        if not future.done():
+            cancelled.set()
+            # Wake a get() that is still waiting in a thread.
+            try:
+                blocks.put_nowait(None)
+            except queue.Full:
+                pass
+
+
+async def render(voice_file: str, spec, **kwargs) -> np.ndarray:
+    """Render spec and return all samples. Takes the same arguments as
+    sing_blocks()."""
+    blocks = [block async for block in sing_blocks(voice_file, spec, **kwargs)]
+    if len(blocks) == 0:
+        return np.zeros(0, dtype=kwargs.get("sample_format", "float32"))
+    return np.concatenate(blocks)
+
+
+async def sing(
+    voice_file: str,
+    spec,
+    out_file: str,
+    executor: Optional[concurrent.futures.Executor] = None,
+    **kwargs,
+) -> Optional[oddvoices.synth.SynthStats]:
+    """Run oddvoices.frontend.sing in the executor. Keyword arguments are passed
+    on to it. Once started, a render to a file runs to the end even if the
+    awaiting task is cancelled."""
+    loop = asyncio.get_running_loop()
+    function = functools.partial(
+        oddvoices.frontend.sing, voice_file, spec, out_file, **kwargs
+    )
+    return await loop.run_in_executor(executor, function)
@@ -0,0 +1,230 @@
+"""Render many music specs in one run.
+
+    sing-batch MANIFEST [-j N] [-o RESULTS]
+
+The manifest is a JSON list of jobs:
+
+    [{"voice": "quake.voice", "spec": "song.json", "output": "song.wav"}, ...]
+
+"spec" is the path of a music JSON file, as taken by sing, or the spec itself.
+A job may also have a "sample_rate". Relative paths are relative to the manifest.
+
+Jobs run in a pool of worker processes, each of which loads cmudict once. Voices
+are loaded once, into shared memory that every worker reads from. Each job's
+cost is estimated from the length of its music and its number of syllables, and
+the most expensive jobs are started first so that no long job is left running
+alone at the end. A failed job is recorded in
+the results and does not stop the others.
+"""
+
+import concurrent.futures
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+from typing import Dict, List, Optional
+
+import oddvoices.cache
+import oddvoices.frontend
+import oddvoices.g2p
+import oddvoices.shared
+import oddvoices.sinks
+
+# Estimated render time of a syllable, relative to one second of audio.
+SYLLABLE_COST = 0.05
+
+
+def read_manifest(manifest_file: str) -> List[dict]:
+    with open(manifest_file) as f:
+        jobs = json.load(f)
+    directory = os.path.dirname(os.path.abspath(manifest_file))
+    for job in jobs:
+        for name in ["voice", "spec", "output"]:
+            if isinstance(job.get(name), str):
+                job[name] = os.path.join(directory, job[name])
+    return jobs
+
+
+def load_spec(job: dict) -> dict:
+    spec = job["spec"]
+    if isinstance(spec, str):
+        with open(spec) as f:
+            spec = json.load(f)
+    return spec
+
+
+def get_music_seconds(spec, syllable_count: int) -> float:
+    """The length of the music in seconds, not counting the release of the last
+    note."""
+    beats = 0.0
+    rests = spec.get("rests", [])
+    for i in range(syllable_count):
+        beats += spec["durations"][i % len(spec["durations"])]
+        if len(rests) != 0:
+            beats += rests[i % len(rests)]
+    return beats * 60 / spec.get("bpm", 60)
+
+
+def estimate_cost(spec, syllable_count: int) -> float:
+    return get_music_seconds(spec, syllable_count) + SYLLABLE_COST * syllable_count
+
+
+def count_syllables(spec, pronunciation_dict: Dict[str, List[str]]) -> int:
+    phonemes = oddvoices.g2p.pronounce_text(spec["text"], pronunciation_dict)
+    return sum([phoneme == "-" for phoneme in phonemes])
+
+
+def schedule(costs: List[float]) -> List[int]:
+    """Order job indices longest first, keeping manifest order among equals."""
+    return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+
+def _init_worker(voice_handles: List[dict]) -> None:
+    oddvoices.shared.install(voice_handles)
+    oddvoices.cache.load_pronunciation_dict()
+
+
+def _run_job(job: dict, sample_format: str) -> dict:
+    start = time.perf_counter()
+    num_samples = 0
+
+    def progress(samples_rendered: int, total: Optional[int]) -> None:
+        nonlocal num_samples
+        num_samples = samples_rendered
+
+    try:
+        spec = load_spec(job)
+        oddvoices.frontend.sing(
+            job["voice"],
+            spec,
+            job["output"],
+            sample_rate=job.get("sample_rate"),
+            sample_format=sample_format,
+            progress=progress,
+        )
+        sample_rate = job.get("sample_rate")
+        if sample_rate is None:
+            sample_rate = oddvoices.cache.load_database(job["voice"])["rate"]
+        result = {
+            "status": "ok",
+            "audio_seconds": num_samples / sample_rate,
+        }
+    except Exception as error:
+        result = {
+            "status": "failed",
+            "error": f"{type(error).__name__}: {error}",
+            "traceback": traceback.format_exc(),
+        }
+    result["seconds"] = time.perf_counter() - start
+    result["worker"] = os.getpid()
+    return result
+
+
+def run_batch(
+    jobs: List[dict],
+    max_workers: Optional[int] = None,
+    sample_format: str = "float32",
+) -> dict:
+    """Run jobs as read by read_manifest and return the results manifest: one
+    result per job, in manifest order, and totals."""
+    start = time.perf_counter()
+    results: List[dict] = [{} for job in jobs]
+    costs = []
+    pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+    for i, job in enumerate(jobs):
+        results[i]["voice"] = job.get("voice")
+        # Inline specs are left out of the results.
+        if isinstance(job.get("spec"), str):
+            results[i]["spec"] = job["spec"]
+        results[i]["output"] = job.get("output")
+        try:
+            spec = load_spec(job)
+            costs.append(estimate_cost(spec, count_syllables(spec, pronunciation_dict)))
+        except Exception as error:
+            results[i]["status"] = "failed"
+            results[i]["error"] = f"Bad spec: {type(error).__name__}: {error}"
+            costs.append(0.0)
+        results[i]["estimated_cost"] = costs[-1]
+
+    # Workers share a single copy of each voice, or without shared memory load
+    # their own. A voice that cannot be read fails its jobs when they run.
+    shared_voices = []
+    voice_files = set([job.get("voice") for job in jobs])
+    for voice_file in sorted([name for name in voice_files if isinstance(name, str)]):
+        if not oddvoices.shared.AVAILABLE:
+            break
+        try:
+            shared_voices.append(oddvoices.shared.SharedVoice.publish(voice_file))
+        except Exception:
+            pass
+    voice_handles = [voice.handle for voice in shared_voices]
+
+    # The pool hands out jobs in the order they are submitted.
+    with contextlib.ExitStack() as stack:
+        for voice in shared_voices:
+            stack.enter_context(voice)
+        executor = stack.enter_context(
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers, initializer=_init_worker, initargs=(voice_handles,)
+            )
+        )
+        futures = {}
+        for i in schedule(costs):
+            if "status" not in results[i]:
+                futures[i] = executor.submit(_run_job, jobs[i], sample_format)
+        for i, future in futures.items():
+            try:
+                results[i].update(future.result())
+            except concurrent.futures.process.BrokenProcessPool as error:
+                # A worker died, which fails every job that had not finished.
+                results[i].update(
+                    {"status": "failed", "error": f"BrokenProcessPool: {error}"}
+                )
+
+    failures = sum([result["status"] != "ok" for result in results])
+    return {
+        "jobs": results,
+        "succeeded": len(results) - failures,
+        "failed": failures,
+        "seconds": time.perf_counter() - start,
+        "render_seconds": sum([result.get("seconds", 0.0) for result in results]),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes")
+    parser.add_argument(
+        "-o",
+        "--results",
+        help="write the results manifest here instead of to stdout",
+    )
+    parser.add_argument(
+        "--sample-format",
+        choices=oddvoices.sinks.SAMPLE_FORMATS,
+        default="float32",
+        help="sample format of the outputs",
+    )
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest)
+    report = run_batch(jobs, args.jobs, args.sample_format)
+    if args.results is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.results, "w") as f:
+            json.dump(report, f, indent=4)
+    for result in report["jobs"]:
+        if result["status"] != "ok":
+            print(f"{result['output']}: {result['error']}", file=sys.stderr)
+    if report["failed"] != 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
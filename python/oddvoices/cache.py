@@ -0,0 +1,65 @@
+"""Process-wide caches of loaded voices and pronunciation dictionaries, so that a
+long-running process such as oddvoices.server loads each of them only once.
+A cached voice is reloaded if its file changes."""
+
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import oddvoices.g2p
+import oddvoices.voice_file
+
+_databases: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+_pronunciation_dict: Optional[Dict[str, List[str]]] = None
+_lock = threading.Lock()
+
+
+def load_database(voice_file: str) -> dict:
+    """Read a voice file, or return the cached database if the file has not
+    changed since it was last read. The database must not be modified. Safe to
+    call from several threads."""
+    path = os.path.realpath(voice_file)
+    with _lock:
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = _databases.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(path, "rb") as f:
+            database = oddvoices.voice_file.read_voice_file(f)
+        _databases[path] = (version, database)
+        return database
+
+
+def add_database(voice_file: str, database: dict) -> None:
+    """Make load_database return database for voice_file until the file
+    changes."""
+    path = os.path.realpath(voice_file)
+    with _lock:
+        stat = os.stat(path)
+        _databases[path] = ((stat.st_mtime_ns, stat.st_size), database)
+
+
+def remove_database(voice_file: str, database: dict) -> None:
+    """Forget database if it is the one cached for voice_file."""
+    path = os.path.realpath(voice_file)
+    with _lock:
+        cached = _databases.get(path)
+        if cached is not None and cached[1] is database:
+            del _databases[path]
+
+
+def load_pronunciation_dict() -> Dict[str, List[str]]:
+    """Return cmudict as parsed by oddvoices.g2p.read_cmudict, reading it once."""
+    global _pronunciation_dict
+    with _lock:
+        if _pronunciation_dict is None:
+            _pronunciation_dict = oddvoices.g2p.read_cmudict()
+        return _pronunciation_dict
+
+
+def clear() -> None:
+    global _pronunciation_dict
+    with _lock:
+        _databases.clear()
+        _pronunciation_dict = None
@@ -1,11 +1,29 @@
 import json
 import pathlib
-import struct
 import soundfile
 import scipy.signal
 import numpy as np
 import oddvoices.phonology
 
+# Voice file I/O lives in oddvoices.voice_file, which does not need SciPy or
+# soundfile. Its names are also available here.
+from oddvoices.voice_file import (  # noqa: F401
+    MAGIC_WORD,
+    COMPRESSED_MAGIC_WORD,
+    POOLED_MAGIC_WORD,
+    write_voice_file_header,
+    encode_frames,
+    decode_frames,
+    decode_segment,
+    get_segment_frames,
+    make_frame_arena,
+    write_voice_file,
+    read_string,
+    read_voice_file_header,
+    read_voice_file,
+    compare_encodings,
+)
+
 
 def midi_note_to_hertz(midi_note):
     return 440 * 2 ** ((midi_note - 69) / 12)
@@ -19,6 +37,9 @@ def seconds_to_timestamp(seconds):
 
 AUTOCORRELATION_WINDOW_SIZE_NUMBER_OF_PERIODS = 8
 RANDOMIZED_PHASE_CUTOFF = 3000.0
+# Number of principal components used to find candidate duplicates in
+# dedupe_frames.
+DEDUPE_DIMENSIONS = 16
 
 
 class CorpusAnalyzer:
@@ -165,88 +186,81 @@ class CorpusAnalyzer:
         return self.database
 
 
-MAGIC_WORD = b"ODDVOICES\0\0\0"
-
-
-def write_voice_file_header(f, database):
-    f.write(MAGIC_WORD)
-    f.write(struct.pack("<l", database["rate"]))
-    f.write(struct.pack("<l", database["grain_length"]))
-
-    for phoneme in database["phonemes"]:
-        f.write(phoneme.encode("ascii") + b"\0")
-    f.write(b"\0")
-
-    for segment_name in database["segments_list"]:
-        f.write(segment_name.encode("ascii") + b"\0")
-        num_frames = database["segments"][segment_name]["num_frames"]
-        is_long = database["segments"][segment_name]["long"]
-        f.write(struct.pack("<l", num_frames))
-        f.write(struct.pack("<l", 1 if is_long else 0))
-    f.write(b"\0")
-
-
-def write_voice_file(f, database):
-    write_voice_file_header(f, database)
-    for segment_name in database["segments_list"]:
-        array = database["segments"][segment_name]["frames"].flatten()
-        packed_array = struct.pack(f"<{len(array)}h", *array)
-        f.write(packed_array)
-
-
-def read_string(f):
-    result = []
-    while True:
-        c = f.read(1)
-        if c == b"\0":
-            break
-        if len(result) > 255:
-            raise ValueError("String longer than 255 characters")
-        result.append(c)
-    return b"".join(result).decode("ascii")
-
-
-def read_voice_file_header(f, database):
-    if f.read(len(MAGIC_WORD)) != MAGIC_WORD:
-        raise RuntimeError("Invalid voice file")
-    database["rate"] = struct.unpack("<l", f.read(4))[0]
-    database["grain_length"] = struct.unpack("<l", f.read(4))[0]
-
-    database["phonemes"] = []
-    while True:
-        phoneme = read_string(f)
-        if len(phoneme) == 0:
-            break
-        database["phonemes"].append(phoneme)
-
-    database["segments_list"] = []
-    database["segments"] = {}
-    while True:
-        segment_id = read_string(f)
-        if len(segment_id) == 0:
-            break
-        database["segments_list"].append(segment_id)
-        database["segments"][segment_id] = {}
-        database["segments"][segment_id]["num_frames"] = struct.unpack("<l", f.read(4))[
-            0
-        ]
-        database["segments"][segment_id]["long"] = (
-            struct.unpack("<l", f.read(4))[0] != 0
-        )
-
+def dedupe_frames(database, threshold):
+    """Replace the frames of every segment with indices into a shared pool of
+    frames, stored as database["frame_pool"], merging frames that differ by at
+    most threshold in RMS, relative to full scale. Each segment is left with
+    "frame_indices" giving the pool index of each of its frames. Returns a
+    report of the sizes before and after, and of the error introduced."""
+    import scipy.spatial
 
-def read_voice_file(f):
-    database = {}
-    read_voice_file_header(f, database)
+    frames = np.concatenate(
+        [
+            get_segment_frames(database, segment_id, keep=False)
+            for segment_id in database["segments_list"]
+        ]
+    )
+    signal = frames.astype(np.float64) / 32767
+    radius = threshold * np.sqrt(database["grain_length"])
+
+    # Greedy leader clustering: each frame not yet merged starts a cluster of the
+    # unmerged frames within the radius. Distances between projections onto the
+    # principal components never exceed the true distances, so a search of the
+    # projections finds every candidate, and the true distances decide.
+    leaders = np.full(len(frames), -1)
+    pool_indices = []
+    if len(frames) != 0:
+        centered = signal - signal.mean(axis=0)
+        components = np.linalg.svd(centered, full_matrices=False)[2]
+        projected = centered @ components[:DEDUPE_DIMENSIONS].T
+        tree = scipy.spatial.cKDTree(projected)
+        for i in range(len(frames)):
+            if leaders[i] != -1:
+                continue
+            leaders[i] = len(pool_indices)
+            pool_indices.append(i)
+            candidates = np.array(
+                [
+                    j
+                    for j in tree.query_ball_point(projected[i], radius)
+                    if leaders[j] == -1
+                ],
+                dtype=int,
+            )
+            distances = np.linalg.norm(signal[candidates] - signal[i], axis=1)
+            leaders[candidates[distances <= radius]] = leaders[i]
 
+    pool = frames[pool_indices]
+    offset = 0
     for segment_id in database["segments_list"]:
-        num_frames = database["segments"][segment_id]["num_frames"]
-        num_samples = num_frames * database["grain_length"]
-        array = np.array(struct.unpack(f"<{num_samples}h", f.read(num_samples * 2)))
-        array = array.reshape(num_frames, database["grain_length"])
-        database["segments"][segment_id]["frames"] = array
-
-    return database
+        segment = database["segments"][segment_id]
+        segment.pop("frames", None)
+        segment.pop("encoded", None)
+        segment.pop("decoded", None)
+        segment["frame_indices"] = leaders[
+            offset : offset + segment["num_frames"]
+        ].astype(np.int32)
+        offset += segment["num_frames"]
+    database["frame_pool"] = pool
+
+    # Errors are in dB relative to full scale, floored at -200 dB.
+    errors = signal - pool[leaders].astype(np.float64) / 32767
+    frame_errors = np.sqrt(np.mean(np.square(errors), axis=1))
+    if len(frame_errors) == 0:
+        frame_errors = np.zeros(1)
+
+    def to_db(value):
+        return float(20 * np.log10(max(value, 1e-10)))
+
+    return {
+        "frames": len(frames),
+        "pool_frames": len(pool),
+        "bytes": frames.nbytes,
+        "pool_bytes": pool.nbytes + len(frames) * 4,
+        "max_error_db": to_db(np.max(frame_errors)),
+        "mean_error_db": to_db(np.mean(frame_errors)),
+        "snr_db": to_db(np.linalg.norm(signal)) - to_db(np.linalg.norm(errors)),
+    }
 
 
 def main():
@@ -255,9 +269,36 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("in_dir")
     parser.add_argument("out_file")
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help=(
+            "compress the segments of the voice file. Compressed voices are "
+            "smaller but can only be read by the Python synth."
+        ),
+    )
+    parser.add_argument(
+        "--dedupe",
+        type=float,
+        metavar="THRESHOLD",
+        help=(
+            "store frames once in a shared pool, merging frames whose RMS "
+            "difference relative to full scale is at most THRESHOLD, e.g. 0.002. "
+            "Pooled voices can only be read by the Python synth."
+        ),
+    )
     args = parser.parse_args()
+    if args.compress and args.dedupe is not None:
+        parser.error("--compress and --dedupe cannot be combined")
 
     segment_database = CorpusAnalyzer(args.in_dir).render_database()
+    report = {}
+    if args.compress:
+        report = compare_encodings(segment_database)
+    if args.dedupe is not None:
+        report = dedupe_frames(segment_database, args.dedupe)
 
     with open(args.out_file, "wb") as f:
-        write_voice_file(f, segment_database)
+        write_voice_file(f, segment_database, compress=args.compress)
+    if len(report) != 0:
+        print(json.dumps(report, indent=4))
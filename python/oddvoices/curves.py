@@ -0,0 +1,79 @@
+import math
+
+import numpy as np
+
+
+def validate_curve(curve: dict) -> None:
+    """Raise ValueError if render_curve cannot render a curve."""
+    points = curve.get("points", [])
+    if len(points) == 0:
+        raise ValueError("Curve has no points")
+    for point in points:
+        if not 2 <= len(point) <= 3:
+            raise ValueError(
+                f"Curve point is not [time, value] or [time, value, shape]: {point}"
+            )
+
+
+def render_curve(curve: dict, start_value: float, num_samples: int, sample_rate: float):
+    """Render a breakpoint curve to an array with one value per sample. Example:
+
+    {"points": [[0, 100], [0.5, 150], [1.0, 100, "exponential"]], "shape": "linear"}
+
+    Each point is [time, value] or [time, value, shape], where time is in seconds
+    from the start of the event and shape applies to the segment ending at that
+    point. If the first point is after time 0, the curve starts from start_value.
+    After the last point, its value is held.
+    """
+    validate_curve(curve)
+    points = [list(point) for point in curve["points"]]
+    default_shape = curve.get("shape", "linear")
+    if points[0][0] > 0:
+        points.insert(0, [0.0, start_value])
+
+    times = np.arange(num_samples) / sample_rate
+    result = np.full(num_samples, float(points[0][1]))
+    for point_1, point_2 in zip(points[:-1], points[1:]):
+        time_1, value_1 = point_1[:2]
+        time_2, value_2 = point_2[:2]
+        shape = point_2[2] if len(point_2) > 2 else default_shape
+        start, end = np.searchsorted(times, [time_1, time_2])
+        if time_2 <= time_1:
+            continue
+        x = (times[start:end] - time_1) / (time_2 - time_1)
+        if shape == "linear":
+            result[start:end] = value_1 + (value_2 - value_1) * x
+        elif shape == "exponential":
+            if value_1 * value_2 <= 0:
+                raise ValueError(
+                    "Exponential curve segments need nonzero values of the same sign"
+                )
+            result[start:end] = value_1 * (value_2 / value_1) ** x
+        elif shape == "step":
+            result[start:end] = value_1
+        else:
+            raise ValueError(f"Unknown curve shape: {shape}")
+    result[np.searchsorted(times, points[-1][0]) :] = points[-1][1]
+    return result
+
+
+def render_vibrato(
+    vibrato: dict, start_time: float, num_samples: int, sample_rate: float
+):
+    """Render a vibrato LFO as an array of frequency ratios. Example:
+
+    {"rate": 5.5, "depth": 0.5, "delay": 0.3, "attack": 0.2}
+
+    rate is in Hz and depth is the peak deviation in semitones. The vibrato starts
+    after delay seconds and fades in over attack seconds. start_time is the time
+    since the vibrato was set, so that the LFO runs continuously across events.
+    """
+    times = start_time + np.arange(num_samples) / sample_rate
+    delay = vibrato.get("delay", 0.0)
+    attack = vibrato.get("attack", 0.0)
+    depth = np.full(num_samples, float(vibrato["depth"]))
+    depth[times < delay] = 0.0
+    if attack > 0:
+        depth *= np.clip((times - delay) / attack, 0.0, 1.0)
+    lfo = np.sin(2 * math.pi * vibrato["rate"] * (times - delay))
+    return 2 ** (depth * lfo / 12)
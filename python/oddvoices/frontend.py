@@ -1,12 +1,15 @@
+import concurrent.futures
 import json
-import numpy as np
-import soundfile
-from typing import List, Optional
+import os
+import sys
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
-import oddvoices.corpus
+import oddvoices.cache
 import oddvoices.g2p
 import oddvoices.utils
 import oddvoices.phonology
+import oddvoices.profiling
+import oddvoices.sinks
 import oddvoices.synth
 
 NOTE_NAMES = ["c", "d", "e", "f", "g", "a", "b"]
@@ -91,65 +94,400 @@ def calculate_auto_trim_amounts(synth, phonemes, phoneme_speed):
     return trim_amounts
 
 
-def sing(voice_file: str, spec, out_file: str, sample_rate: Optional[float]):
-    pronunciation_dict = oddvoices.g2p.read_cmudict()
-    phonemes = oddvoices.g2p.pronounce_text(spec["text"], pronunciation_dict)
-    syllable_count = sum([phoneme == "-" for phoneme in phonemes])
+def load_synth(
+    voice_file: str, sample_rate: Optional[float] = None, draft: bool = False
+):
+    database = oddvoices.cache.load_database(voice_file)
+    if draft:
+        return oddvoices.synth.DraftSynth(database, sample_rate=sample_rate)
+    return oddvoices.synth.Synth(database, sample_rate=sample_rate)
 
-    with open(voice_file, "rb") as f:
-        database = oddvoices.corpus.read_voice_file(f)
-    synth = oddvoices.synth.Synth(database, sample_rate=sample_rate)
 
-    trim_amounts = calculate_auto_trim_amounts(
-        synth, phonemes, spec.get("phoneme_speed", 1.0)
-    )
+def get_syllable_frequency(spec, i: int) -> float:
+    note = spec["notes"][i % len(spec["notes"])]
+    if isinstance(note, str):
+        note = note_string_to_midinote(note)
+    note += spec.get("transposition", 0)
+    return oddvoices.utils.midi_note_to_hertz(note)
+
 
+def make_events(
+    spec, syllable_count: int, trim_amounts: List[float], start: int = 0
+) -> List[dict]:
+    """Make the events for syllables start to syllable_count - 1."""
     events = []
-    for i in range(syllable_count):
-        note = spec["notes"][i % len(spec["notes"])]
-        if isinstance(note, str):
-            note = note_string_to_midinote(note)
-        note += spec.get("transposition", 0)
-        frequency = oddvoices.utils.midi_note_to_hertz(note)
-        duration = (
-            spec["durations"][i % len(spec["durations"])] * 60 / spec.get("bpm", 60)
-        )
+    last_frequency = None
+    if start > 0:
+        last_frequency = get_syllable_frequency(spec, start - 1)
+    seconds_per_beat = 60 / spec.get("bpm", 60)
+    rests = spec.get("rests", [])
+    for i in range(start, syllable_count):
+        frequency = get_syllable_frequency(spec, i)
+        duration = spec["durations"][i % len(spec["durations"])] * seconds_per_beat
         trim = trim_amounts[i]
-        events.append(
-            {
-                "note_on": True,
-                "frequency": frequency,
-                "duration": duration - trim,
-                "formant_shift": spec.get("formant_shift", 1.0),
-                "phoneme_speed": spec.get("phoneme_speed", 1.0),
+        if len(rests) != 0 and rests[i % len(rests)] > 0:
+            # Silence before the syllable.
+            events.append({"duration": rests[i % len(rests)] * seconds_per_beat})
+        event = {
+            "note_on": True,
+            "frequency": frequency,
+            "duration": duration - trim,
+            "formant_shift": spec.get("formant_shift", 1.0),
+            "phoneme_speed": spec.get("phoneme_speed", 1.0),
+        }
+        if spec.get("portamento", 0) > 0 and last_frequency is not None:
+            event["frequency"] = {
+                "points": [
+                    [0, last_frequency],
+                    [spec["portamento"], frequency, "exponential"],
+                ]
             }
-        )
+        if "vibrato" in spec:
+            event["vibrato"] = spec["vibrato"]
+        last_frequency = frequency
+        events.append(event)
         events.append(
             {
                 "note_off": True,
                 "duration": trim,
             }
         )
+    return events
 
-    segments = phonemes_to_segments(synth, phonemes)
+
+def make_music(
+    synth: oddvoices.synth.Synth,
+    spec,
+    pronunciation_dict,
+    profiler: Optional[oddvoices.profiling.StageProfiler] = None,
+) -> dict:
+    """Convert a music spec with text, notes and durations into the segments and
+    events that oddvoices.synth.sing takes."""
+    with oddvoices.profiling.stage(profiler, "pronounce_text"):
+        phonemes = oddvoices.g2p.pronounce_text(spec["text"], pronunciation_dict)
+        syllable_count = sum([phoneme == "-" for phoneme in phonemes])
+
+    with oddvoices.profiling.stage(profiler, "calculate_auto_trim_amounts"):
+        trim_amounts = calculate_auto_trim_amounts(
+            synth, phonemes, spec.get("phoneme_speed", 1.0)
+        )
+
+    with oddvoices.profiling.stage(profiler, "make_events"):
+        events = make_events(spec, syllable_count, trim_amounts)
+
+    with oddvoices.profiling.stage(profiler, "phonemes_to_segments"):
+        segments = phonemes_to_segments(synth, phonemes)
+        segment_indices = get_segment_indices(synth, segments)
+
+    music: dict = {
+        "segments": segment_indices,
+        "events": events,
+    }
+    return music
+
+
+def get_segment_indices(synth: oddvoices.synth.Synth, segments: List[str]) -> List[int]:
     segment_indices = []
     for segment_name in segments:
         try:
             segment_index = synth.database["segments_list"].index(segment_name)
-        except:
+        except ValueError:
             segment_index = -1
         segment_indices.append(segment_index)
+    return segment_indices
 
-    music: dict = {
-        "segments": segment_indices,
-        "events": events,
+
+def make_music_chunks(
+    synth: oddvoices.synth.Synth, spec, phrases: Iterable[List[str]]
+) -> Iterator[dict]:
+    """Like make_music(), but take the phonemes of the text one phrase at a time
+    and yield music chunks for oddvoices.synth.sing_stream as soon as they are
+    ready. Rendering the chunks gives the same audio as make_music() on the whole
+    text.
+
+    The segments between two phrases depend on both, and a syllable's trim amount
+    is only known once its last segment is, so each chunk holds back the events
+    of the last syllable until the next phrase arrives."""
+    phoneme_speed = spec.get("phoneme_speed", 1.0)
+    last_phoneme: Optional[str] = None
+    syllable_count = 0
+    syllable: List[str] = []
+    trim_amounts: List[float] = []
+    events_made = 0
+
+    for phonemes in phrases:
+        if len(phonemes) == 0:
+            continue
+        syllable_count += sum([phoneme == "-" for phoneme in phonemes])
+        # Start from the last phoneme of the previous phrase to get the segments
+        # that join the two phrases.
+        if last_phoneme is not None:
+            phonemes = [last_phoneme] + phonemes
+        last_phoneme = phonemes[-1]
+        segments = phonemes_to_segments(synth, phonemes)
+
+        for segment in segments:
+            if segment == "-":
+                if len(syllable) != 0:
+                    trim_amounts.append(get_trim_amount(synth, syllable, phoneme_speed))
+                syllable = []
+            else:
+                syllable.append(segment)
+
+        ready_count = min(syllable_count, len(trim_amounts))
+        yield {
+            "segments": get_segment_indices(synth, segments),
+            "events": make_events(spec, ready_count, trim_amounts, events_made),
+        }
+        events_made = ready_count
+
+    trim_amounts.append(get_trim_amount(synth, syllable, phoneme_speed))
+    yield {
+        "segments": [],
+        "events": make_events(spec, syllable_count, trim_amounts, events_made),
     }
 
-    result = oddvoices.synth.sing(synth, music)
-    soundfile.write(out_file, result, samplerate=int(synth.sample_rate))
 
+_worker_pronunciation_dict: Dict[str, List[str]] = {}
+
+
+def _init_pronunciation_worker() -> None:
+    global _worker_pronunciation_dict
+    _worker_pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+
+
+def _pronounce_phrase(phrase: str) -> List[str]:
+    return oddvoices.g2p.pronounce_text(phrase, _worker_pronunciation_dict)
 
-def main():
+
+def write_blocks(blocks, out_file, sample_rate, sample_format, profiler) -> None:
+    """Write blocks to out_file, or to stdout if it is "-". A file is written under
+    a temporary name next to it and renamed once complete, so if rendering fails
+    or is cancelled there is no partial file and an existing out_file is kept."""
+    if out_file == "-":
+        _write_blocks(blocks, out_file, sample_rate, sample_format, profiler)
+        return
+    directory, name = os.path.split(os.path.abspath(out_file))
+    # Keep the extension, which the sink takes the file type from.
+    base, extension = os.path.splitext(name)
+    temporary_file = os.path.join(directory, f".{base}.{os.getpid()}.part{extension}")
+    try:
+        _write_blocks(blocks, temporary_file, sample_rate, sample_format, profiler)
+        os.replace(temporary_file, out_file)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+
+def _write_blocks(blocks, out_file, sample_rate, sample_format, profiler) -> None:
+    sink = oddvoices.sinks.open_sink(out_file, sample_rate, sample_format)
+    try:
+        with oddvoices.profiling.stage(profiler, "render"):
+            for block in blocks:
+                sink.write(oddvoices.sinks.convert_block(block, sample_format))
+    finally:
+        with oddvoices.profiling.stage(profiler, "write"):
+            sink.close()
+
+
+def sing(
+    voice_file: str,
+    spec,
+    out_file: str,
+    sample_rate: Optional[float] = None,
+    stats: bool = False,
+    profiler: Optional[oddvoices.profiling.StageProfiler] = None,
+    sample_format: Optional[str] = None,
+    pipelined: bool = False,
+    phrase_cache_directory: Optional[str] = None,
+    incremental: bool = False,
+    draft: bool = False,
+    resample: bool = False,
+    progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    cancel: Optional[oddvoices.synth.CancellationToken] = None,
+    canonical_phrase_starts: bool = False,
+) -> Optional[oddvoices.synth.SynthStats]:
+    """Render a music spec to an audio file, or to raw PCM on stdout if out_file is
+    "-". Audio is written block by block on a background thread while rendering,
+    in the given sample format (see oddvoices.sinks), by default float32, or
+    int16 if draft is True. If stats is True, collect
+    and return the synth's render statistics. If a profiler is given, each stage
+    of the pipeline is timed with it.
+
+    If pipelined is True, the text is pronounced one phrase at a time in a worker
+    process while earlier phrases render, so audio starts after the first phrase
+    instead of after the whole text. The output is the same.
+
+    If phrase_cache_directory is given, rendered phrases are cached there and
+    reused by later renders (see oddvoices.phrase_cache). If incremental is also
+    True, phrases of earlier renders that this one did not use are removed, so
+    the directory keeps only this render for the next edit. The output is the
+    same as without the cache. canonical_phrase_starts selects the lossy mode of
+    oddvoices.phrase_cache, in which repeated phrases hit too.
+
+    If draft is True, render a quick preview with oddvoices.synth.DraftSynth, at
+    the draft sample rate unless sample_rate is given.
+
+    If resample is True, the synth renders at its own rate, which is the voice's
+    rate unless draft is True, and the output is converted to sample_rate with
+    oddvoices.resample.
+
+    progress and cancel are passed to oddvoices.synth.sing_blocks. Samples are
+    counted at the synth's rate, and the total is None if pipelined is True. A
+    cancelled render raises oddvoices.synth.RenderCancelled and leaves no
+    out_file behind."""
+    sample_format = get_sample_format(sample_format, draft)
+    if pipelined:
+        return _sing_pipelined(
+            voice_file,
+            spec,
+            out_file,
+            sample_rate,
+            stats,
+            profiler,
+            sample_format,
+            phrase_cache_directory,
+            incremental,
+            draft,
+            resample,
+            progress,
+            cancel,
+            canonical_phrase_starts,
+        )
+    with oddvoices.profiling.stage(profiler, "read_cmudict"):
+        pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+    with oddvoices.profiling.stage(profiler, "load_voice"):
+        synth = load_synth(voice_file, None if resample else sample_rate, draft)
+    if stats:
+        synth.enable_stats()
+    music = make_music(synth, spec, pronunciation_dict, profiler=profiler)
+
+    phrase_cache = make_phrase_cache(
+        synth, phrase_cache_directory, canonical_phrase_starts
+    )
+    blocks = oddvoices.synth.sing_blocks(
+        synth, music, phrase_cache=phrase_cache, progress=progress, cancel=cancel
+    )
+    blocks, output_rate = resample_output(blocks, synth, sample_rate, resample)
+    write_blocks(blocks, out_file, output_rate, sample_format, profiler)
+    if incremental and phrase_cache is not None:
+        phrase_cache.prune()
+    return synth.stats
+
+
+def get_sample_format(sample_format: Optional[str], draft: bool) -> str:
+    """The sample format to write: sample_format if given, otherwise int16 for
+    drafts and float32 for full quality renders."""
+    if sample_format is not None:
+        return sample_format
+    return "int16" if draft else "float32"
+
+
+def resample_output(blocks, synth, sample_rate: Optional[float], resample: bool):
+    """Return the blocks a synth rendered, converted to sample_rate if resample is
+    True, and the rate they are at."""
+    if not resample or sample_rate is None or sample_rate == synth.sample_rate:
+        return blocks, synth.sample_rate
+    import oddvoices.resample
+
+    blocks = oddvoices.resample.resample_blocks(blocks, synth.sample_rate, sample_rate)
+    return blocks, sample_rate
+
+
+def make_phrase_cache(
+    synth, directory: Optional[str], canonical_phrase_starts: bool = False
+):
+    """Make a phrase cache in directory for synth, or return None if directory is
+    None. With canonical_phrase_starts, phrase starts are made canonical, with or
+    without a cache, so that repeated phrases hit. That changes the output (see
+    oddvoices.phrase_cache)."""
+    synth.canonical_phrase_starts = canonical_phrase_starts
+    if directory is None:
+        return None
+    import oddvoices.phrase_cache
+
+    return oddvoices.phrase_cache.PhraseCache(directory=directory)
+
+
+def _sing_pipelined(
+    voice_file,
+    spec,
+    out_file,
+    sample_rate,
+    stats,
+    profiler,
+    sample_format,
+    phrase_cache_directory,
+    incremental,
+    draft,
+    resample,
+    progress,
+    cancel,
+    canonical_phrase_starts,
+):
+    phrases = oddvoices.g2p.split_phrases(spec["text"])
+    # A single worker keeps the phrases in order and loads cmudict once.
+    # Pronunciation is much faster than rendering, so it stays ahead.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, initializer=_init_pronunciation_worker
+    ) as executor:
+        futures = [executor.submit(_pronounce_phrase, phrase) for phrase in phrases]
+        with oddvoices.profiling.stage(profiler, "load_voice"):
+            synth = load_synth(voice_file, None if resample else sample_rate, draft)
+        if stats:
+            synth.enable_stats()
+        phonemes = (future.result() for future in futures)
+        chunks = make_music_chunks(synth, spec, phonemes)
+        phrase_cache = make_phrase_cache(
+            synth, phrase_cache_directory, canonical_phrase_starts
+        )
+        blocks = oddvoices.synth.sing_stream(
+            synth, chunks, phrase_cache=phrase_cache, progress=progress, cancel=cancel
+        )
+        blocks, output_rate = resample_output(blocks, synth, sample_rate, resample)
+        try:
+            write_blocks(blocks, out_file, output_rate, sample_format, profiler)
+        except BaseException:
+            # Do not wait for phrases that will not be rendered.
+            for future in futures:
+                future.cancel()
+            raise
+    if incremental and phrase_cache is not None:
+        phrase_cache.prune()
+    return synth.stats
+
+
+def plan(
+    voice_file: str,
+    spec,
+    sample_rate: Optional[float] = None,
+    draft: bool = False,
+    resample: bool = False,
+) -> dict:
+    """Predict the output length, grain count and memory use of sing() without
+    rendering. See oddvoices.synth.plan. With resample, the synth is planned at
+    the rate it renders at, given as "render_sample_rate", and the output length
+    is that of the resampled output."""
+    import oddvoices.resample
+
+    pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+    synth = load_synth(voice_file, None if resample else sample_rate, draft)
+    music = make_music(synth, spec, pronunciation_dict)
+    result = oddvoices.synth.plan(synth, music)
+    result["render_sample_rate"] = synth.sample_rate
+    if resample and sample_rate is not None and sample_rate != synth.sample_rate:
+        # The length of oddvoices.resample.resample_blocks output.
+        up, down = oddvoices.resample.get_ratio(synth.sample_rate, sample_rate)
+        num_samples = -(-result["num_samples"] * up // down)
+        result["sample_rate"] = sample_rate
+        result["num_samples"] = num_samples
+        result["duration"] = num_samples / sample_rate
+        result["output_bytes"] = num_samples * 4
+    return result
+
+
+def make_parser():
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -157,11 +495,158 @@ def main():
     parser.add_argument("music_file")
     parser.add_argument("out_file")
     parser.add_argument("-s", "--sample-rate", type=float)
+    parser.add_argument(
+        "--resample",
+        action="store_true",
+        help=(
+            "render at the voice's own sample rate and convert the output to "
+            "--sample-rate, which is faster when the rates differ"
+        ),
+    )
+    add_render_arguments(parser)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print a JSON render plan instead of rendering",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="print render statistics as JSON"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print the time and peak memory of each stage as JSON",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="with --profile, also trace allocations in each stage (slow)",
+    )
+    return parser
+
 
-    args = parser.parse_args()
+def main(argv: Optional[List[str]] = None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    check_render_arguments(parser, args)
 
     music_file = args.music_file
     with open(music_file) as f:
         music = json.load(f)
 
-    sing(args.voice_npz, music, args.out_file, sample_rate=args.sample_rate)
+    report_file = sys.stderr if args.out_file == "-" else sys.stdout
+    if args.dry_run:
+        plan_result = plan(
+            args.voice_npz, music, args.sample_rate, args.draft, args.resample
+        )
+        print(json.dumps(plan_result, indent=4), file=report_file)
+        return
+
+    profiler = None
+    if args.profile:
+        profiler = oddvoices.profiling.StageProfiler(trace_memory=args.profile_memory)
+    stats = sing(
+        args.voice_npz,
+        music,
+        args.out_file,
+        sample_rate=args.sample_rate,
+        stats=args.stats,
+        profiler=profiler,
+        sample_format=args.sample_format,
+        pipelined=args.pipelined,
+        phrase_cache_directory=args.phrase_cache,
+        incremental=args.incremental,
+        draft=args.draft,
+        resample=args.resample,
+        canonical_phrase_starts=args.canonical_phrase_starts,
+    )
+    print_report(stats, profiler, file=report_file)
+
+
+def add_render_arguments(parser) -> None:
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help=(
+            "render in a running oddvoices-server, which keeps voices and "
+            "dictionaries loaded. Falls back to rendering here if none is running."
+        ),
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help=(
+            "pronounce the lyrics a phrase at a time in a worker process while "
+            "rendering, so audio starts sooner"
+        ),
+    )
+    parser.add_argument(
+        "--phrase-cache",
+        metavar="DIRECTORY",
+        help=(
+            "cache rendered phrases in this directory and reuse them, so that "
+            "re-renders of the same music are faster. The output is the same as "
+            "without the cache. Repeats within a song are not reused unless "
+            "--canonical-phrase-starts is given, so a first render is not faster."
+        ),
+    )
+    parser.add_argument(
+        "--canonical-phrase-starts",
+        action="store_true",
+        help=(
+            "restart grain timing at each phrase that starts from silence, so that "
+            "repeated phrases reuse the phrase cache. This is lossy: the output "
+            "sounds alike but its waveform differs from a normal render."
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "with --phrase-cache, keep only this render's phrases in the "
+            "directory, so that after an edit the music before the first change "
+            "is reused. Everything from the first change on is rendered again, "
+            "so an edit near the start saves little. Use a separate directory "
+            "for each song."
+        ),
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help=(
+            "render a quick, lower quality preview: 16 kHz unless a sample rate "
+            "is given, no interpolation, at most 4 overlapping grains, and int16 "
+            "output unless --sample-format is given"
+        ),
+    )
+    parser.add_argument(
+        "--sample-format",
+        choices=oddvoices.sinks.SAMPLE_FORMATS,
+        help=(
+            "sample format of the output: float32 by default, or int16 with "
+            "--draft. int16 halves buffered memory and writes "
+            "16-bit files. With an out_file of -, raw PCM in this format is "
+            "written to stdout."
+        ),
+    )
+
+
+def check_render_arguments(parser, args) -> None:
+    """Report options added by add_render_arguments that cannot be combined."""
+    if args.incremental and args.phrase_cache is None:
+        parser.error("--incremental requires --phrase-cache")
+
+
+def print_report(
+    stats: Optional[oddvoices.synth.SynthStats],
+    profiler: Optional[oddvoices.profiling.StageProfiler],
+    file=sys.stdout,
+) -> None:
+    """Print --stats and --profile output as a single JSON object."""
+    if profiler is not None:
+        report = profiler.as_dict()
+        if stats is not None:
+            report["stats"] = stats.as_dict()
+        print(json.dumps(report, indent=4), file=file)
+    elif stats is not None:
+        print(json.dumps(stats.as_dict(), indent=4), file=file)
@@ -5,6 +5,8 @@ import sys
 import oddvoices.phonology
 import oddvoices.utils
 
+PHRASE_PUNCTUATION = ".!?,;:"
+
 
 def arpabet_to_xsampa(string: str) -> str:
     """Convert an ARPABET phoneme string to X-SAMPA."""
@@ -107,6 +109,25 @@ def tokenize(text: str) -> List[str]:
     return words
 
 
+def split_phrases(text: str) -> List[str]:
+    """Split a text into phrases at line breaks and after words ending in
+    punctuation such as commas and periods. Phrases are split only between
+    whitespace-separated words, so pronouncing each phrase and joining the results
+    gives the same phonemes as pronouncing the whole text."""
+    phrases = []
+    for line in text.splitlines():
+        phrase: List[str] = []
+        for island in line.split():
+            phrase.append(island)
+            word = island.rstrip("\"')]")
+            if word != "" and word[-1] in PHRASE_PUNCTUATION:
+                phrases.append(" ".join(phrase))
+                phrase = []
+        if len(phrase) != 0:
+            phrases.append(" ".join(phrase))
+    return phrases
+
+
 def pronounce_unrecognized_word(word: str) -> List[str]:
     """Guess an X-SAMPA pronunciation of an unrecognized or OOV (out-of-vocabulary)
     word."""
@@ -1,22 +1,363 @@
-import mido
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import os
+import struct
+import sys
+import tempfile
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 
+import numpy as np
+
+import oddvoices.cache
 import oddvoices.frontend
+import oddvoices.profiling
+import oddvoices.synth
+
+DEFAULT_TEMPO = 500_000
+
+
+class MidiEvent(NamedTuple):
+    """A message read by MidiFileReader, with the attributes of a mido message
+    that are used here. type is "note_on", "note_off", "set_tempo",
+    "end_of_track" or "other"."""
+
+    type: str
+    time: int
+    channel: int = 0
+    note: int = 0
+    velocity: int = 0
+    tempo: int = 0
+
+
+def _read_variable_length(data: bytes, position: int) -> Tuple[int, int]:
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position
+
+
+def parse_track(data: bytes) -> Iterator[MidiEvent]:
+    """Yield the messages of the data of a track chunk one at a time."""
+    position = 0
+    status = 0
+    while position < len(data):
+        delta, position = _read_variable_length(data, position)
+        if data[position] >= 0x80:
+            status = data[position]
+            position += 1
+        elif status == 0:
+            # A data byte without running status.
+            raise ValueError(f"Invalid MIDI track data at byte {position}")
+
+        if status == 0xFF:
+            meta_type = data[position]
+            length, position = _read_variable_length(data, position + 1)
+            if meta_type == 0x51 and length == 3:
+                tempo = int.from_bytes(data[position : position + 3], "big")
+                yield MidiEvent("set_tempo", delta, tempo=tempo)
+            elif meta_type == 0x2F:
+                yield MidiEvent("end_of_track", delta)
+                return
+            else:
+                yield MidiEvent("other", delta)
+            position += length
+            status = 0
+        elif status in [0xF0, 0xF7]:
+            length, position = _read_variable_length(data, position)
+            yield MidiEvent("other", delta)
+            position += length
+            status = 0
+        elif status > 0xF0:
+            raise ValueError(f"Invalid MIDI status byte {status:#x}")
+        else:
+            kind = status & 0xF0
+            channel = status & 0x0F
+            if kind in [0xC0, 0xD0]:
+                yield MidiEvent("other", delta, channel)
+                position += 1
+            else:
+                note, velocity = data[position], data[position + 1]
+                position += 2
+                if kind == 0x90:
+                    yield MidiEvent("note_on", delta, channel, note, velocity)
+                elif kind == 0x80:
+                    yield MidiEvent("note_off", delta, channel, note, velocity)
+                else:
+                    yield MidiEvent("other", delta, channel)
+
+
+class MidiTrackReader:
+    """A track of a MIDI file that is read from disk each time it is iterated,
+    and parsed one message at a time."""
+
+    def __init__(self, path: str, offset: int, length: int):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __iter__(self) -> Iterator[MidiEvent]:
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(self.length)
+        return parse_track(data)
+
+
+class MidiFileReader:
+    """A Standard MIDI File with the ticks_per_beat and tracks of a mido.MidiFile,
+    but whose tracks are only parsed while they are iterated, so that no list of
+    messages is built. Holds at most the raw bytes of one track in memory."""
+
+    def __init__(self, path: str):
+        self.tracks: List[MidiTrackReader] = []
+        with open(path, "rb") as f:
+            kind, length = struct.unpack(">4sI", f.read(8))
+            if kind != b"MThd":
+                raise ValueError(f"Not a MIDI file: {path}")
+            midi_format, num_tracks, division = struct.unpack(">hhh", f.read(6))
+            if division < 0:
+                raise ValueError("SMPTE time division is not supported")
+            self.ticks_per_beat = division
+            f.seek(8 + length)
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                kind, length = struct.unpack(">4sI", header)
+                if kind == b"MTrk":
+                    self.tracks.append(MidiTrackReader(path, f.tell(), length))
+                f.seek(length, os.SEEK_CUR)
+
+
+class TempoMap:
+    """Convert ticks to seconds using the set_tempo messages of every track."""
+
+    def __init__(self, midi_file):
+        self.ticks_per_beat = midi_file.ticks_per_beat
+        changes: Dict[int, int] = {}
+        for track in midi_file.tracks:
+            tick = 0
+            for message in track:
+                tick += message.time
+                if message.type == "set_tempo":
+                    changes[tick] = message.tempo
 
+        self.ticks = [0]
+        self.seconds = [0.0]
+        self.tempos = [DEFAULT_TEMPO]
+        for tick in sorted(changes):
+            if tick != self.ticks[-1]:
+                self.seconds.append(self.tick_to_seconds(tick))
+                self.ticks.append(tick)
+                self.tempos.append(changes[tick])
+            else:
+                self.tempos[-1] = changes[tick]
 
-def make_music_spec_from_midi_file(midi_file):
-    microseconds_per_beat = 500_000
-    notes = []
-    durations = []
-    for message in midi_file:
-        if message.type == "note_on":
-            notes.append(message.note)
-        elif message.type == "note_off":
-            durations.append(message.time)
+    def tick_to_seconds(self, tick: int) -> float:
+        i = bisect.bisect_right(self.ticks, tick) - 1
+        beats = (tick - self.ticks[i]) / self.ticks_per_beat
+        return self.seconds[i] + beats * self.tempos[i] * 1e-6
 
-    return {"notes": notes, "durations": durations}
 
+class Note(NamedTuple):
+    channel: int
+    pitch: int
+    start: float
+    end: float
 
-def main():
+
+def iter_notes(track, tempo_map: TempoMap) -> Iterator[Note]:
+    """Yield the notes of a track as they end. A note off ends the earliest note
+    still sounding with the same channel and pitch. Notes still sounding at the
+    end of the track end there."""
+    tick = 0
+    sounding: Dict[Tuple[int, int], collections.deque] = {}
+    for message in track:
+        tick += message.time
+        if message.type not in ["note_on", "note_off"]:
+            continue
+        key = (message.channel, message.note)
+        if message.type == "note_on" and message.velocity > 0:
+            sounding.setdefault(key, collections.deque()).append(tick)
+        elif len(sounding.get(key, [])) != 0:
+            start = sounding[key].popleft()
+            yield Note(
+                *key, tempo_map.tick_to_seconds(start), tempo_map.tick_to_seconds(tick)
+            )
+    end = tempo_map.tick_to_seconds(tick)
+    for (channel, pitch), starts in sounding.items():
+        for start in starts:
+            yield Note(channel, pitch, tempo_map.tick_to_seconds(start), end)
+
+
+def notes_to_spec(notes: List[Note]) -> dict:
+    """Make a monophonic music spec from notes, timed in seconds. Of notes that
+    start together, the highest is sung. A note is cut short when the next one
+    starts, and gaps become rests."""
+    notes = sorted(notes, key=lambda note: (note.start, -note.pitch))
+    spec: dict = {"notes": [], "durations": [], "rests": []}
+    position = 0.0
+    # Index of the first note that starts after the current one.
+    next_index = 0
+    for i, note in enumerate(notes):
+        if i > 0 and note.start == notes[i - 1].start:
+            continue
+        next_index = max(next_index, i + 1)
+        while next_index < len(notes) and notes[next_index].start <= note.start:
+            next_index += 1
+        end = note.end
+        if next_index < len(notes):
+            end = min(end, notes[next_index].start)
+        spec["notes"].append(note.pitch)
+        spec["durations"].append(end - note.start)
+        spec["rests"].append(note.start - position)
+        position = end
+    return spec
+
+
+def make_music_specs_from_midi_file(midi_file) -> List[dict]:
+    """Make a music spec, timed in seconds, for each track and channel of a MIDI
+    file that has notes. Each spec also has the "track" and "channel" it came
+    from. midi_file is a MidiFileReader or a mido.MidiFile."""
+    tempo_map = TempoMap(midi_file)
+    specs = []
+    for track_index, track in enumerate(midi_file.tracks):
+        parts: Dict[int, List[Note]] = {}
+        for note in iter_notes(track, tempo_map):
+            parts.setdefault(note.channel, []).append(note)
+        for channel in sorted(parts):
+            spec = notes_to_spec(parts[channel])
+            spec["track"] = track_index
+            spec["channel"] = channel
+            specs.append(spec)
+    return specs
+
+
+def make_music_spec_from_midi_file(midi_file) -> dict:
+    """Make a music spec for the first part of a MIDI file."""
+    specs = make_music_specs_from_midi_file(midi_file)
+    if len(specs) == 0:
+        return {"notes": [], "durations": [], "rests": []}
+    return specs[0]
+
+
+def _render_part(
+    voice_file: str,
+    spec,
+    part_file: str,
+    sample_rate: Optional[float],
+    phrase_cache_directory: Optional[str],
+    incremental: bool,
+    draft: bool,
+    canonical_phrase_starts: bool,
+) -> None:
+    """Render a part to part_file as raw float32 samples, a block at a time."""
+    synth = oddvoices.frontend.load_synth(voice_file, sample_rate, draft)
+    pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+    music = oddvoices.frontend.make_music(synth, spec, pronunciation_dict)
+    phrase_cache = oddvoices.frontend.make_phrase_cache(
+        synth, phrase_cache_directory, canonical_phrase_starts
+    )
+    blocks = oddvoices.synth.sing_blocks(synth, music, phrase_cache=phrase_cache)
+    with open(part_file, "wb") as f:
+        for block in blocks:
+            f.write(block.tobytes())
+    if incremental and phrase_cache is not None:
+        phrase_cache.prune()
+
+
+def mix_part_files(
+    part_files: List[str], block_size: int = oddvoices.synth.BLOCK_SIZE
+) -> Iterator[np.ndarray]:
+    """Mix parts written by _render_part at equal gain, scaled so that the mix
+    cannot clip. Reads a block of each part at a time."""
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(name, "rb")) for name in part_files]
+        while True:
+            result = np.zeros(block_size, dtype="float32")
+            length = 0
+            for f in files:
+                part = np.frombuffer(f.read(block_size * 4), dtype="float32")
+                result[: len(part)] += part
+                length = max(length, len(part))
+            if length == 0:
+                return
+            if len(files) > 1:
+                result /= len(files)
+            yield result[:length]
+
+
+def sing_parts(
+    voice_file: str,
+    specs: List[dict],
+    out_file: str,
+    sample_rate: Optional[float] = None,
+    sample_format: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    profiler: Optional[oddvoices.profiling.StageProfiler] = None,
+    phrase_cache_directory: Optional[str] = None,
+    incremental: bool = False,
+    draft: bool = False,
+    canonical_phrase_starts: bool = False,
+) -> None:
+    """Render several parts in parallel worker processes and write their mix.
+    Parts are rendered to temporary files next to out_file and mixed a block at
+    a time, so memory use does not grow with the length of the music. With
+    incremental, each part keeps its phrases in its own subdirectory of
+    phrase_cache_directory. With draft, parts are rendered as by
+    oddvoices.frontend.sing with draft, and the mix is written as int16 unless
+    sample_format is given."""
+    sample_format = oddvoices.frontend.get_sample_format(sample_format, draft)
+    # Load everything first, so that forked workers share it.
+    with oddvoices.profiling.stage(profiler, "read_cmudict"):
+        oddvoices.cache.load_pronunciation_dict()
+    with oddvoices.profiling.stage(profiler, "load_voice"):
+        synth = oddvoices.frontend.load_synth(voice_file, sample_rate, draft)
+
+    directory = None
+    if out_file != "-":
+        directory = os.path.dirname(os.path.abspath(out_file))
+    with tempfile.TemporaryDirectory(dir=directory) as part_directory:
+        part_files = [
+            os.path.join(part_directory, f"part-{i}.raw") for i in range(len(specs))
+        ]
+        with oddvoices.profiling.stage(profiler, "render_parts"):
+            with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+                futures = []
+                for i, spec in enumerate(specs):
+                    cache_directory = phrase_cache_directory
+                    if incremental and cache_directory is not None:
+                        cache_directory = os.path.join(cache_directory, f"part-{i}")
+                    futures.append(
+                        executor.submit(
+                            _render_part,
+                            voice_file,
+                            spec,
+                            part_files[i],
+                            sample_rate,
+                            cache_directory,
+                            incremental,
+                            draft,
+                            canonical_phrase_starts,
+                        )
+                    )
+                for future in futures:
+                    future.result()
+
+        oddvoices.frontend.write_blocks(
+            mix_part_files(part_files),
+            out_file,
+            synth.sample_rate,
+            sample_format,
+            profiler,
+        )
+
+
+def make_parser():
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -25,8 +366,35 @@ def main():
     parser.add_argument("-l", "--lyrics", type=str)
     parser.add_argument("-f", "--lyrics_file", type=str)
     parser.add_argument("out_file")
+    parser.add_argument(
+        "--part",
+        type=int,
+        help=(
+            "sing only this part, counting from 0. By default every track and "
+            "channel with notes is sung, in parallel, to the same lyrics."
+        ),
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="number of parts to render at once"
+    )
+    oddvoices.frontend.add_render_arguments(parser)
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print the time and peak memory of each stage as JSON",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="with --profile, also trace allocations in each stage (slow)",
+    )
+    return parser
 
-    args = parser.parse_args()
+
+def main(argv: Optional[List[str]] = None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    oddvoices.frontend.check_render_arguments(parser, args)
 
     if args.lyrics is not None:
         lyrics = args.lyrics
@@ -36,8 +404,48 @@ def main():
     else:
         raise RuntimeError("You must supply either -l or -f")
 
-    midi_file = mido.MidiFile(args.midi_file)
-    spec = make_music_spec_from_midi_file(midi_file)
-    spec["text"] = lyrics
+    profiler = None
+    if args.profile:
+        profiler = oddvoices.profiling.StageProfiler(trace_memory=args.profile_memory)
+    with oddvoices.profiling.stage(profiler, "read_midi"):
+        midi_file = MidiFileReader(args.midi_file)
+        specs = make_music_specs_from_midi_file(midi_file)
+    if len(specs) == 0:
+        raise RuntimeError(f"{args.midi_file} has no notes")
+    if args.part is not None:
+        specs = [specs[args.part]]
+    if args.pipelined and len(specs) > 1:
+        # Parts are mixed once all of them are rendered, so pronouncing while
+        # rendering would not make audio start sooner.
+        parser.error("--pipelined sings a single part; choose one with --part")
+    for spec in specs:
+        spec["text"] = lyrics
 
-    oddvoices.frontend.sing(args.voice_file, spec, args.out_file)
+    if len(specs) == 1:
+        oddvoices.frontend.sing(
+            args.voice_file,
+            specs[0],
+            args.out_file,
+            profiler=profiler,
+            sample_format=args.sample_format,
+            pipelined=args.pipelined,
+            phrase_cache_directory=args.phrase_cache,
+            incremental=args.incremental,
+            draft=args.draft,
+            canonical_phrase_starts=args.canonical_phrase_starts,
+        )
+    else:
+        sing_parts(
+            args.voice_file,
+            specs,
+            args.out_file,
+            sample_format=args.sample_format,
+            max_workers=args.jobs,
+            profiler=profiler,
+            phrase_cache_directory=args.phrase_cache,
+            incremental=args.incremental,
+            draft=args.draft,
+            canonical_phrase_starts=args.canonical_phrase_starts,
+        )
+    report_file = sys.stderr if args.out_file == "-" else sys.stdout
+    oddvoices.frontend.print_report(None, profiler, file=report_file)
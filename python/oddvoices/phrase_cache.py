@@ -0,0 +1,174 @@
+"""A content-addressed cache of rendered phrases, used by oddvoices.synth.sing and
+sing_blocks through their phrase_cache argument.
+
+A phrase runs from the start of one note to the start of the next, so each
+syllable is its own phrase. A phrase is looked up by the voice, the sample rate,
+the events, and a snapshot of the synth when it starts: its parameters, phase,
+segment timeline and the grains still sounding. If the synth is resting between
+notes, only the part of its state that the phrase does not replace is used. A hit
+also requires the segments at the front of the synth's queue to be the ones the
+phrase used when it was rendered, and to run out at the same point. The cached
+audio is then used instead of rendering, and the synth, grains included, is left
+in the state the render ended in, so the output is exactly what rendering would
+have produced.
+
+Because the grain phase is kept through silences, a repeated phrase almost
+always starts at a different phase than the first time, so repeats within a song
+rarely hit. In this exact mode the cache speeds up only rendering the same music
+again, in whole or up to an edit, not the first render of a song.
+
+Synth.canonical_phrase_starts is a lossy mode that makes repeats hit: it resets
+the phase and vibrato time and drops grains still sounding at every note that
+starts from silence. A phrase after a rest then renders the same wherever it
+comes, but grains land at different times than in a render without it. The
+result sounds alike, yet its waveform differs from the exact render by about as
+much as the signal itself. Renders in this mode match each other, with or without
+a cache.
+
+Entries are kept in memory up to max_bytes of audio, evicting the least recently
+used, and optionally in a directory, which can be shared between runs.
+
+For incremental re-rendering, render the music through a cache in a directory,
+then prune() it so that the directory holds only that render's phrases. After an
+edit, rendering again with a new cache on the directory reuses every phrase
+before the first one that changed, and the output matches a full render exactly.
+The synth state after an edited phrase differs, so the phrases after it are
+rendered again too, except that with canonical_phrase_starts, phrases that start
+from silence are reused. In exact mode the state almost never converges again: the
+grain phase only stands still while the synth rests, so any change to how long
+notes sound shifts it for the rest of the music. An edit near the start therefore
+re-renders nearly everything, and costs about as much as a full render.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional, Set, Tuple
+
+import numpy as np
+
+import oddvoices.voice_file
+
+
+def get_voice_fingerprint(database) -> str:
+    """Hash everything in a voice database that affects rendering."""
+    digest = hashlib.sha256()
+    header = [database["rate"], database["grain_length"], database["segments_list"]]
+    digest.update(json.dumps(header).encode())
+    if "frames" in database:
+        digest.update(np.ascontiguousarray(database["frames"]).tobytes())
+    for segment_id in database["segments_list"]:
+        segment = database["segments"][segment_id]
+        digest.update(json.dumps([segment_id, segment["long"]]).encode())
+        if "frames" in database:
+            digest.update(str(segment["offset"]).encode())
+        else:
+            # Compressed and pooled voices hash like raw voices with the same
+            # frames. Compressed segments are decoded without keeping them.
+            frames = oddvoices.voice_file.get_segment_frames(
+                database, segment_id, keep=False
+            )
+            digest.update(np.ascontiguousarray(frames).tobytes())
+    return digest.hexdigest()
+
+
+def make_key(value) -> str:
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=repr).encode()
+    ).hexdigest()
+
+
+class PhraseCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Keys of the entries used or stored since the cache was made.
+        self.used: Set[str] = set()
+        # The last voice fingerprinted, kept only as long as the cache.
+        self._fingerprint: Optional[Tuple[dict, str]] = None
+
+    def get_voice_fingerprint(self, database) -> str:
+        """get_voice_fingerprint(database), computed once for the voice used with
+        this cache."""
+        if self._fingerprint is None or self._fingerprint[0] is not database:
+            self._fingerprint = (database, get_voice_fingerprint(database))
+        return self._fingerprint[1]
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.directory is not None:
+            entry = self._read(key)
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        """Store an entry: a dict with the "audio" as a float32 array and other
+        JSON-serializable values."""
+        self.used.add(key)
+        self._remember(key, entry)
+        if self.directory is not None:
+            self._write(key, entry)
+
+    def prune(self) -> None:
+        """Remove every entry that has not been used or stored since the cache was
+        made, from memory and from the directory."""
+        for key in list(self.entries):
+            if key not in self.used:
+                self.nbytes -= self.entries.pop(key)["audio"].nbytes
+        if self.directory is None:
+            return
+        for name in os.listdir(self.directory):
+            key, extension = os.path.splitext(name)
+            if extension == ".npz" and key not in self.used:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def _remember(self, key: str, entry: dict) -> None:
+        if key in self.entries:
+            return
+        self.entries[key] = entry
+        self.nbytes += entry["audio"].nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.nbytes -= old_entry["audio"].nbytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
+
+    def _read(self, key: str) -> Optional[dict]:
+        try:
+            with np.load(self._path(key)) as data:
+                entry = json.loads(str(data["metadata"]))
+                entry["audio"] = data["audio"]
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry
+
+    def _write(self, key: str, entry: dict) -> None:
+        metadata = {name: value for name, value in entry.items() if name != "audio"}
+        # Write to a temporary file first so that readers never see half a file.
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, audio=entry["audio"], metadata=json.dumps(metadata))
+        os.replace(path, self._path(key))
+
+    def as_dict(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,91 @@
+import contextlib
+import sys
+import time
+import tracemalloc
+from typing import Callable, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
+
+
+def get_max_rss_bytes() -> Optional[int]:
+    """Return the peak resident set size of this process so far, if the platform
+    reports it."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class StageProfiler:
+    """Record the wall time and memory use of each named stage of a render.
+
+    Every record has the stage's wall time and the process's peak resident set size
+    when it finished. If trace_memory is True, memory is also measured with
+    tracemalloc, which sees NumPy allocations too, and reported as the peak above
+    the memory in use when the stage started. Tracing is precise but slows
+    rendering down several times, so it is off by default.
+
+    If a callback is given, it is called with each stage's record as it finishes,
+    for example to forward it to a metrics pipeline.
+    """
+
+    def __init__(
+        self,
+        callback: Optional[Callable[[dict], None]] = None,
+        trace_memory: bool = False,
+    ):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages: List[dict] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            else:
+                # Python < 3.9 has no reset_peak, so restart tracing instead.
+                tracemalloc.stop()
+                tracemalloc.start()
+            start_memory = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "seconds": time.perf_counter() - start,
+                "max_rss_bytes": get_max_rss_bytes(),
+            }
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                record["peak_memory_bytes"] = max(peak_memory - start_memory, 0)
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(record["seconds"] for record in self.stages)
+
+    def as_dict(self) -> dict:
+        return {"stages": self.stages, "total_seconds": self.total_seconds}
+
+
+def stage(profiler: Optional[StageProfiler], name: str):
+    """Return profiler.stage(name), or a context manager that does nothing if
+    profiler is None."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
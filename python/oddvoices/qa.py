@@ -0,0 +1,277 @@
+"""Check a voice by rendering each of its segments, or each pair of segments that
+can follow each other, over a grid of frequencies and formant shifts.
+
+    oddvoices-qa quake.voice [--pairs] [-j N] [--sort METRIC] [-o report.csv]
+
+Every render gets cheap metrics that point at problems worth listening to:
+
+    peak, rms          level of the render
+    clipped            number of samples at or beyond full scale
+    discontinuity      largest sample-to-sample jump near a segment transition,
+                       relative to the RMS jump of the whole render
+    loop_jump_db       largest change in level across the loop point of a long
+                       segment, in dB
+
+The report has one row per render, sorted with the worst first, as CSV or JSON.
+Renders run in parallel worker processes that share one copy of the voice.
+"""
+
+import concurrent.futures
+import contextlib
+import csv
+import json
+import math
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import oddvoices.shared
+import oddvoices.synth
+import oddvoices.voice_file
+
+FREQUENCIES = [110.0, 220.0, 440.0]
+FORMANT_SHIFTS = [0.8, 1.0, 1.25]
+METRICS = ["peak", "rms", "clipped", "discontinuity", "loop_jump_db"]
+# How many times a long segment loops before the note ends.
+LOOP_REPEATS = 2.5
+# Silence rendered after the last segment, in seconds.
+TAIL = 0.05
+CLIP_LEVEL = 1.0
+# Half-width of the window around a transition searched for jumps, in seconds.
+TRANSITION_WINDOW = 0.005
+# Length of the windows compared at a loop point, in seconds.
+LOOP_WINDOW = 0.01
+
+
+def split_segment(database, segment_id: str) -> Tuple[str, str]:
+    """Return the phonemes a segment starts and ends with. "_" is silence."""
+    phonemes = database["phonemes"] + ["_"]
+    if segment_id in phonemes:
+        return segment_id, segment_id
+    for phoneme in phonemes:
+        if segment_id.startswith(phoneme) and segment_id[len(phoneme) :] in phonemes:
+            return phoneme, segment_id[len(phoneme) :]
+    raise ValueError(f"Cannot split segment into phonemes: {segment_id}")
+
+
+def get_pairs(database) -> List[List[str]]:
+    """Every pair of segments where the first ends with the phoneme the second
+    starts with."""
+    starts: Dict[str, List[str]] = {}
+    for segment_id in database["segments_list"]:
+        starts.setdefault(split_segment(database, segment_id)[0], []).append(segment_id)
+    pairs = []
+    for segment_id in database["segments_list"]:
+        end = split_segment(database, segment_id)[1]
+        for next_segment_id in starts.get(end, []):
+            pairs.append([segment_id, next_segment_id])
+    return pairs
+
+
+def _get_hold_time(synth, segment_id: str) -> float:
+    length = synth.get_segment_length(segment_id)
+    if synth.database["segments"][segment_id]["long"]:
+        return length * LOOP_REPEATS
+    return length
+
+
+def render_segments(
+    synth: oddvoices.synth.Synth, segments: List[str], frequency: float
+) -> Tuple[np.ndarray, List[int], List[int]]:
+    """Sing segments as one note on a fresh synth. Returns the audio and the
+    sample indices of segment transitions and of loop points of long
+    segments."""
+    synth.frequency = frequency
+    synth.segment_queue = list(segments)
+    events = [
+        {"note_on": True, "duration": _get_hold_time(synth, segments[0])},
+        {
+            "note_off": True,
+            "duration": sum([_get_hold_time(synth, s) for s in segments[1:]]) + TAIL,
+        },
+    ]
+    result: List[float] = []
+    transitions = []
+    loop_points = []
+    for event in events:
+        num_samples = int(event["duration"] * synth.sample_rate)
+        oddvoices.synth._start_event(synth, event, num_samples)
+        for i in range(num_samples):
+            segment_id = synth.segment_id
+            segment_time = synth.segment_time
+            result.append(synth.process())
+            if synth.segment_id != segment_id:
+                if synth.segment_id != "-" and segment_id != "-":
+                    transitions.append(len(result))
+            elif synth.segment_is_long and synth.segment_time < segment_time:
+                loop_points.append(len(result))
+    return np.array(result, dtype="float32"), transitions, loop_points
+
+
+def _rms(audio: np.ndarray) -> float:
+    if len(audio) == 0:
+        return 0.0
+    return float(np.sqrt(np.mean(np.square(audio, dtype=np.float64))))
+
+
+def get_metrics(
+    audio: np.ndarray,
+    transitions: List[int],
+    loop_points: List[int],
+    sample_rate: float,
+) -> dict:
+    jumps = np.abs(np.diff(audio.astype(np.float64)))
+    typical_jump = _rms(jumps)
+    discontinuity = 0.0
+    window = max(int(TRANSITION_WINDOW * sample_rate), 1)
+    for transition in transitions:
+        nearby = jumps[max(transition - window, 0) : transition + window]
+        if len(nearby) != 0 and typical_jump > 0:
+            discontinuity = max(discontinuity, float(nearby.max()) / typical_jump)
+
+    loop_jump_db = 0.0
+    window = max(int(LOOP_WINDOW * sample_rate), 1)
+    for loop_point in loop_points:
+        before = _rms(audio[max(loop_point - window, 0) : loop_point])
+        after = _rms(audio[loop_point : loop_point + window])
+        if before > 0 and after > 0:
+            loop_jump_db = max(loop_jump_db, abs(20 * math.log10(after / before)))
+
+    return {
+        "peak": float(np.max(np.abs(audio), initial=0.0)),
+        "rms": _rms(audio),
+        "clipped": int(np.sum(np.abs(audio) >= CLIP_LEVEL)),
+        "discontinuity": discontinuity,
+        "loop_jump_db": loop_jump_db,
+    }
+
+
+def check_item(
+    voice_file: str,
+    segments: List[str],
+    frequencies: List[float],
+    formant_shifts: List[float],
+    sample_rate: Optional[float] = None,
+) -> List[dict]:
+    """Render one segment or pair over the grid and return a row per render."""
+    import oddvoices.cache
+
+    database = oddvoices.cache.load_database(voice_file)
+    rows = []
+    for frequency in frequencies:
+        for formant_shift in formant_shifts:
+            synth = oddvoices.synth.Synth(database, sample_rate=sample_rate)
+            synth.formant_shift = formant_shift
+            audio, transitions, loop_points = render_segments(
+                synth, segments, frequency
+            )
+            row = {
+                "segments": " ".join(segments),
+                "frequency": frequency,
+                "formant_shift": formant_shift,
+            }
+            row.update(get_metrics(audio, transitions, loop_points, synth.sample_rate))
+            rows.append(row)
+    return rows
+
+
+def run_qa(
+    voice_file: str,
+    pairs: bool = False,
+    frequencies: List[float] = FREQUENCIES,
+    formant_shifts: List[float] = FORMANT_SHIFTS,
+    max_workers: Optional[int] = None,
+    sort: str = "discontinuity",
+) -> List[dict]:
+    """Check every segment, or every pair of segments, of a voice. Returns the
+    rows of the report sorted by a metric, largest first."""
+    with contextlib.ExitStack() as stack:
+        if oddvoices.shared.AVAILABLE:
+            voice = stack.enter_context(
+                oddvoices.shared.SharedVoice.publish(voice_file)
+            )
+            database = voice.database
+            voice_handles = [voice.handle]
+        else:
+            # Each worker loads its own copy of the voice.
+            with open(voice_file, "rb") as f:
+                database = oddvoices.voice_file.read_voice_file(f)
+            voice_handles = []
+        if pairs:
+            items = get_pairs(database)
+        else:
+            items = [[segment_id] for segment_id in database["segments_list"]]
+        executor = stack.enter_context(
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers,
+                initializer=oddvoices.shared.install,
+                initargs=(voice_handles,),
+            )
+        )
+        futures = [
+            executor.submit(
+                check_item, voice_file, segments, frequencies, formant_shifts
+            )
+            for segments in items
+        ]
+        rows = [row for future in futures for row in future.result()]
+    rows.sort(key=lambda row: -row[sort])
+    return rows
+
+
+def write_report(rows: List[dict], f, report_format: str = "csv") -> None:
+    if report_format == "json":
+        json.dump(rows, f, indent=4)
+        f.write("\n")
+        return
+    fields = ["segments", "frequency", "formant_shift"] + METRICS
+    writer = csv.DictWriter(f, fields)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("voice_file")
+    parser.add_argument(
+        "--pairs",
+        action="store_true",
+        help="render every pair of segments that can follow each other",
+    )
+    parser.add_argument(
+        "--frequencies", type=float, nargs="+", default=FREQUENCIES, metavar="HZ"
+    )
+    parser.add_argument(
+        "--formant-shifts", type=float, nargs="+", default=FORMANT_SHIFTS
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes")
+    parser.add_argument(
+        "--sort",
+        choices=METRICS,
+        default="discontinuity",
+        help="metric to sort the report by, largest first",
+    )
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("-o", "--out-file", help="write the report here")
+    args = parser.parse_args(argv)
+
+    rows = run_qa(
+        args.voice_file,
+        pairs=args.pairs,
+        frequencies=args.frequencies,
+        formant_shifts=args.formant_shifts,
+        max_workers=args.jobs,
+        sort=args.sort,
+    )
+    if args.out_file is None:
+        write_report(rows, sys.stdout, args.format)
+    else:
+        with open(args.out_file, "w", newline="") as f:
+            write_report(rows, f, args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Real-time synthesis driven by timestamped events.
+
+A RealtimeEngine owns a Synth and renders it in fixed-size blocks, for example from
+an audio callback. Other threads send it events, which use the same keys as the
+events of oddvoices.synth.sing:
+
+    {"note_on": True, "frequency": 220}
+    {"note_off": True}
+    {"formant_shift": 1.2, "phoneme_speed": 0.8, "vibrato": {...}}
+    {"segments": ["_h", "h", "h@", ...]}
+
+Parameters must be plain numbers; curves are not supported. "segments" queues
+segment names for the following notes, separated by a syllable break from any
+that are still queued or playing; lyrics_event() makes one from text.
+
+Each event is placed at the exact sample of its time, in seconds on the engine's
+timeline, which starts at the first block. The block covering time t is expected
+to be rendered at time t and heard latency seconds later. An event sent without a
+time is placed one block after it was sent, the earliest time that is certain not
+to be rendered yet, so live input is delayed by a constant amount instead of
+jittering with the block boundaries. Events that arrive too late for their time
+are played at the start of the next block.
+
+Work per block is bounded: at most max_events_per_block events are applied, and
+further ones wait for the next block. Text is converted to segments by the
+sender, not the audio thread.
+"""
+
+import heapq
+import itertools
+import queue
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import oddvoices.frontend
+import oddvoices.g2p
+import oddvoices.synth
+import oddvoices.utils
+
+SCALAR_PARAMETERS = oddvoices.synth.PARAMETERS
+
+
+class RealtimeStats:
+    """Timing counters collected by a RealtimeEngine."""
+
+    def __init__(self):
+        self.blocks = 0
+        self.events = 0
+        self.late_events = 0
+        self.deferred_events = 0
+        self.deadline_misses = 0
+        self.total_block_seconds = 0.0
+        self.max_block_seconds = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def average_block_seconds(self) -> float:
+        if self.blocks == 0:
+            return 0.0
+        return self.total_block_seconds / self.blocks
+
+    @property
+    def average_latency(self) -> float:
+        if self.events == 0:
+            return 0.0
+        return self.total_latency / self.events
+
+    def as_dict(self) -> dict:
+        result = dict(vars(self))
+        result["average_block_seconds"] = self.average_block_seconds
+        result["average_latency"] = self.average_latency
+        return result
+
+
+class RealtimeEngine:
+    """Render a synth block by block while applying events from other threads.
+
+    latency is the time from a block being rendered to it being heard, which is
+    at least one block for a callback-based audio output. A block whose rendering
+    ends after its first sample should have started playing counts as a deadline
+    miss. clock returns the current time in seconds and can be replaced to
+    simulate input and output timing."""
+
+    def __init__(
+        self,
+        synth: oddvoices.synth.Synth,
+        block_size: int = 256,
+        latency: Optional[float] = None,
+        max_events_per_block: int = 64,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.synth = synth
+        self.block_size = block_size
+        if latency is None:
+            latency = 2 * block_size / synth.sample_rate
+        self.latency = latency
+        self.block_duration = block_size / synth.sample_rate
+        self.max_events_per_block = max_events_per_block
+        self.clock = clock
+        self.stats = RealtimeStats()
+
+        self.start_time: Optional[float] = None
+        self.sample_position = 0
+        self.inbox: queue.Queue = queue.Queue()
+        self.pending: list = []
+        self.sequence = itertools.count()
+
+    def start(self) -> None:
+        """Start the timeline now. Called by the first process_block() if needed."""
+        self.start_time = self.clock()
+
+    def send(self, event: dict, time: Optional[float] = None) -> None:
+        """Schedule an event at time seconds on the engine's timeline, or one block
+        from now if time is None. Safe to call from any thread."""
+        for name in SCALAR_PARAMETERS:
+            if isinstance(event.get(name, 0), dict):
+                raise ValueError(f"Curves are not supported in real time: {name}")
+        for segment in event.get("segments", []):
+            if segment != "-" and segment not in self.synth.database["segments"]:
+                raise ValueError(f"Unknown segment: {segment}")
+        received = self.clock()
+        if time is None:
+            if self.start_time is None:
+                time = 0.0
+            else:
+                time = received - self.start_time + self.block_duration
+        self.inbox.put((time, received, event))
+
+    def process_block(self) -> np.ndarray:
+        """Render the next block_size samples as float32."""
+        block_start_time = self.clock()
+        if self.start_time is None:
+            self.start()
+        assert self.start_time is not None
+        sample_rate = self.synth.sample_rate
+
+        self._receive()
+        block_start = self.sample_position
+        block_end = block_start + self.block_size
+        result: list = []
+        position = block_start
+        applied = 0
+        while len(self.pending) != 0 and self.pending[0][0] < block_end:
+            if applied == self.max_events_per_block:
+                self.stats.deferred_events += sum(
+                    1 for pending in self.pending if pending[0] < block_end
+                )
+                break
+            sample, sequence, received, event = heapq.heappop(self.pending)
+            if sample < block_start:
+                self.stats.late_events += 1
+            sample = max(sample, position)
+            self._render(sample - position, result)
+            position = sample
+            self._apply(event)
+            applied += 1
+
+            heard = self.start_time + self.latency + sample / sample_rate
+            self.stats.events += 1
+            self.stats.total_latency += heard - received
+            self.stats.max_latency = max(self.stats.max_latency, heard - received)
+        self._render(block_end - position, result)
+        self.sample_position = block_end
+
+        end = self.clock()
+        seconds = end - block_start_time
+        self.stats.blocks += 1
+        self.stats.total_block_seconds += seconds
+        self.stats.max_block_seconds = max(self.stats.max_block_seconds, seconds)
+        if end > self.start_time + self.latency + block_start / sample_rate:
+            self.stats.deadline_misses += 1
+        return np.array(result, dtype="float32")
+
+    def _receive(self) -> None:
+        # Take a bounded number of events from the inbox, so that a burst of
+        # input is spread over several blocks.
+        for i in range(self.max_events_per_block):
+            try:
+                event_time, received, event = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            sample = int(round(event_time * self.synth.sample_rate))
+            heapq.heappush(self.pending, (sample, next(self.sequence), received, event))
+
+    def _render(self, num_samples: int, result: list) -> None:
+        if num_samples == 0:
+            return
+        # An empty event only advances vibrato, if there is any.
+        curves = oddvoices.synth._start_event(self.synth, {}, num_samples)
+        oddvoices.synth._render_event(self.synth, num_samples, curves, result)
+
+    def _apply(self, event: dict) -> None:
+        synth = self.synth
+        if "segments" in event:
+            if synth.is_active() or len(synth.segment_queue) != 0:
+                synth.segment_queue.append("-")
+            synth.segment_queue.extend(event["segments"])
+        oddvoices.synth._start_event(synth, event, 0)
+
+
+def lyrics_event(
+    synth: oddvoices.synth.Synth, text: str, pronunciation_dict: Dict[str, List[str]]
+) -> dict:
+    """Make a "segments" event that sings text, one syllable per note."""
+    phonemes = oddvoices.g2p.pronounce_text(text, pronunciation_dict)
+    return {"segments": oddvoices.frontend.phonemes_to_segments(synth, phonemes)}
+
+
+class MidiAdapter:
+    """Turn mido messages into events for a RealtimeEngine. The voice is
+    monophonic: the most recent held note sounds, and releasing it returns to the
+    previous held note. Pitch bend covers bend_range semitones."""
+
+    def __init__(self, engine: RealtimeEngine, bend_range: float = 2.0):
+        self.engine = engine
+        self.bend_range = bend_range
+        self.held_notes: List[int] = []
+        self.bend = 0.0
+
+    def _frequency(self, note: int) -> float:
+        return oddvoices.utils.midi_note_to_hertz(note + self.bend * self.bend_range)
+
+    def to_events(self, message) -> List[dict]:
+        if message.type == "note_on" and message.velocity > 0:
+            if message.note in self.held_notes:
+                self.held_notes.remove(message.note)
+            self.held_notes.append(message.note)
+            return [{"note_on": True, "frequency": self._frequency(message.note)}]
+        if message.type in ["note_on", "note_off"]:
+            if message.note not in self.held_notes:
+                return []
+            was_sounding = message.note == self.held_notes[-1]
+            self.held_notes.remove(message.note)
+            if not was_sounding:
+                return []
+            if len(self.held_notes) != 0:
+                return [{"frequency": self._frequency(self.held_notes[-1])}]
+            return [{"note_off": True}]
+        if message.type == "pitchwheel":
+            self.bend = message.pitch / 8192
+            if len(self.held_notes) != 0:
+                return [{"frequency": self._frequency(self.held_notes[-1])}]
+        return []
+
+    def send(self, message, time: Optional[float] = None) -> None:
+        """Send the events for a message to the engine. Can be used directly as
+        the callback of a mido input port."""
+        for event in self.to_events(message):
+            self.engine.send(event, time)
@@ -0,0 +1,111 @@
+"""Sample rate conversion of a stream of blocks, so that a synth can render at its
+voice's own rate and the output still comes out at any rate.
+
+The converter is a polyphase FIR filter: the input is conceptually upsampled by
+up, low-pass filtered and downsampled by down, where up / down is the ratio of
+the rates, but only the filter taps that meet nonzero input samples are
+computed. The filter is a Kaiser-windowed sinc with its delay removed, so output
+sample n is aligned with time n / output_rate of the input.
+"""
+
+import fractions
+from typing import Iterable, Iterator
+
+import numpy as np
+
+# Largest number of filter phases, which bounds the denominator of the ratio of
+# the rates.
+MAX_PHASES = 1000
+# Zero crossings of the sinc on each side of its center.
+HALF_TAPS = 16
+KAISER_BETA = 8.0
+# Fraction of the lower Nyquist frequency that is kept.
+ROLLOFF = 0.92
+
+
+def get_ratio(input_rate: float, output_rate: float):
+    """Return (up, down), the ratio of output_rate to input_rate as a fraction."""
+    ratio = fractions.Fraction(output_rate / input_rate).limit_denominator(MAX_PHASES)
+    return ratio.numerator, ratio.denominator
+
+
+def make_phase_filters(up: int, down: int) -> np.ndarray:
+    """Return an array with a row for each phase, holding the taps that apply to
+    the most recent input sample last."""
+    length = 2 * HALF_TAPS * up + 1
+    cutoff = ROLLOFF * 0.5 / max(up, down)
+    t = np.arange(length) - HALF_TAPS * up
+    taps = np.sinc(2 * cutoff * t) * np.kaiser(length, KAISER_BETA)
+    taps *= up / np.sum(taps)
+    num_taps = 2 * HALF_TAPS + 1
+    taps = np.concatenate([taps, np.zeros(num_taps * up - length)])
+    # Tap k of phase p is taps[p + k * up] and applies to the input k samples
+    # before the current one.
+    return np.ascontiguousarray(taps.reshape(num_taps, up).T[:, ::-1])
+
+
+class StreamingResampler:
+    """Convert blocks of samples from input_rate to output_rate. Feed blocks to
+    process(), which returns the output that is ready, and call flush() after the
+    last block for the rest. The total output is as long as the input scaled by
+    the ratio of the rates, rounded up."""
+
+    def __init__(self, input_rate: float, output_rate: float):
+        self.up, self.down = get_ratio(input_rate, output_rate)
+        self.filters = make_phase_filters(self.up, self.down)
+        self.num_taps = self.filters.shape[1]
+        self.delay = HALF_TAPS * self.up
+        # Input from absolute index buffer_start on. Input before the start of
+        # the stream is silence.
+        self.buffer = np.zeros(self.num_taps - 1, dtype=np.float64)
+        self.buffer_start = -(self.num_taps - 1)
+        self.input_length = 0
+        self.output_length = 0
+
+    def _render(self, end: int) -> np.ndarray:
+        """Compute output samples up to, not including, end."""
+        n = np.arange(self.output_length, end)
+        t = n * self.down + self.delay
+        phases = t % self.up
+        # Index into the buffer of the first input sample each output reads.
+        starts = t // self.up - (self.num_taps - 1) - self.buffer_start
+        windows = np.lib.stride_tricks.sliding_window_view(self.buffer, self.num_taps)
+        result = np.einsum("ij,ij->i", windows[starts], self.filters[phases])
+        self.output_length = end
+
+        # Keep only the input that later outputs still read.
+        t = end * self.down + self.delay
+        keep_from = t // self.up - (self.num_taps - 1) - self.buffer_start
+        keep_from = min(keep_from, len(self.buffer))
+        self.buffer = self.buffer[keep_from:]
+        self.buffer_start += keep_from
+        return result.astype(np.float32)
+
+    def process(self, block) -> np.ndarray:
+        self.buffer = np.concatenate([self.buffer, block])
+        self.input_length += len(block)
+        # Outputs up to end have all their input.
+        end = (self.input_length * self.up - 1 - self.delay) // self.down + 1
+        if end <= self.output_length:
+            return np.zeros(0, dtype=np.float32)
+        return self._render(end)
+
+    def flush(self) -> np.ndarray:
+        end = -(-self.input_length * self.up // self.down)
+        padding = self.delay // self.up + 1
+        self.buffer = np.concatenate([self.buffer, np.zeros(padding)])
+        return self._render(end)
+
+
+def resample_blocks(
+    blocks: Iterable[np.ndarray], input_rate: float, output_rate: float
+) -> Iterator[np.ndarray]:
+    """Resample a stream of float32 blocks, yielding blocks as they are ready."""
+    resampler = StreamingResampler(input_rate, output_rate)
+    for block in blocks:
+        result = resampler.process(block)
+        if len(result) != 0:
+            yield result
+    result = resampler.flush()
+    if len(result) != 0:
+        yield result
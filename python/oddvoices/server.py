@@ -0,0 +1,278 @@
+"""A local daemon that keeps voices and cmudict loaded between runs of sing and
+sing-midi.
+
+    oddvoices-server [--socket PATH] [--voice VOICE_FILE ...]
+
+sing --server and sing-midi --server send their command line to the server over a
+Unix socket, together with their standard input, output and error. The server
+forks a process for each command, which runs it in the client's working directory
+with everything already loaded, writing straight to the client's files and
+terminal. If no server is running, the command runs in the client as usual.
+
+The socket is $ODDVOICES_SERVER_SOCKET if set, or oddvoices-UID.sock in
+$XDG_RUNTIME_DIR or the temporary directory. Only the standard library is
+imported at the top of this module so that clients start quickly.
+"""
+
+import array
+import contextlib
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import traceback
+from typing import Iterable, List, Optional
+
+PROGRAMS = {"sing": "oddvoices.frontend", "sing-midi": "oddvoices.midi_frontend"}
+# Name of the argument that holds the voice file in each program.
+VOICE_ARGUMENTS = {"sing": "voice_npz", "sing-midi": "voice_file"}
+NUM_FDS = 3
+MAX_REQUEST_BYTES = 1 << 20
+REQUEST_TIMEOUT = 5.0
+STATUS = struct.Struct("!i")
+
+
+def default_socket_path() -> str:
+    path = os.environ.get("ODDVOICES_SERVER_SOCKET")
+    if path:
+        return path
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, f"oddvoices-{os.getuid()}.sock")
+
+
+def run_remote(
+    program: str, argv: List[str], socket_path: Optional[str] = None
+) -> Optional[int]:
+    """Run a sing or sing-midi command line in the server and return its exit
+    status, or None if no server is listening."""
+    if socket_path is None:
+        socket_path = default_socket_path()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+
+    with client:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        request = {"program": program, "argv": argv, "cwd": os.getcwd()}
+        data = json.dumps(request).encode() + b"\n"
+        fds = array.array("i", [0, 1, 2])
+        sent = client.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        client.sendall(data[sent:])
+        response = _receive_exactly(client, STATUS.size)
+
+    if len(response) < STATUS.size:
+        print("oddvoices-server closed the connection", file=sys.stderr)
+        return 1
+    return STATUS.unpack(response)[0]
+
+
+def sing_main() -> None:
+    _main("sing")
+
+
+def sing_midi_main() -> None:
+    _main("sing-midi")
+
+
+def _main(program: str) -> None:
+    """Entry point for the sing and sing-midi commands. --server is checked before
+    importing the program, so a command handled by the server never loads numpy,
+    scipy or the voice in the client."""
+    argv = sys.argv[1:]
+    if "--server" in argv:
+        status = run_remote(program, argv)
+        if status is not None:
+            sys.exit(status)
+    importlib.import_module(PROGRAMS[program]).main(argv)
+
+
+def _receive_exactly(connection, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return data
+
+
+def _receive_request(connection) -> dict:
+    fds = array.array("i")
+    data, ancillary, flags, address = connection.recvmsg(
+        MAX_REQUEST_BYTES, socket.CMSG_SPACE(NUM_FDS * fds.itemsize)
+    )
+    for level, kind, cmsg_data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            usable = len(cmsg_data) - len(cmsg_data) % fds.itemsize
+            fds.frombytes(cmsg_data[:usable])
+    try:
+        while not data.endswith(b"\n"):
+            if len(data) > MAX_REQUEST_BYTES:
+                raise ValueError("Request is too long")
+            chunk = connection.recv(MAX_REQUEST_BYTES)
+            if len(chunk) == 0:
+                raise ValueError("Incomplete request")
+            data += chunk
+        if len(fds) != NUM_FDS:
+            raise ValueError("Expected stdin, stdout and stderr")
+        request = json.loads(data)
+        if request.get("program") not in PROGRAMS:
+            raise ValueError(f"Unknown program: {request.get('program')}")
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    request["fds"] = list(fds)
+    return request
+
+
+def _warm(request: dict) -> None:
+    """Load the voice a request uses into the server's cache, so that this and
+    later forked processes find it already in memory."""
+    import oddvoices.cache
+
+    module = importlib.import_module(PROGRAMS[request["program"]])
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            args = module.make_parser().parse_args(request["argv"])
+    except SystemExit:
+        # The forked process reports the usage error to the client.
+        return
+    voice_file = getattr(args, VOICE_ARGUMENTS[request["program"]])
+    try:
+        oddvoices.cache.load_database(os.path.join(request["cwd"], voice_file))
+    except Exception as error:
+        print(f"Could not load {voice_file}: {error}", file=sys.stderr)
+
+
+def _run_request(request: dict) -> int:
+    for target, fd in enumerate(request["fds"]):
+        os.dup2(fd, target)
+        os.close(fd)
+    status = 0
+    try:
+        os.chdir(request["cwd"])
+        sys.argv = [request["program"]] + request["argv"]
+        module = importlib.import_module(PROGRAMS[request["program"]])
+        module.main(request["argv"])
+    except SystemExit as exit:
+        if isinstance(exit.code, int):
+            status = exit.code
+        elif exit.code is not None:
+            print(exit.code, file=sys.stderr)
+            status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return status
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Runs in the forked process.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        status = _run_request(self.server.pending_request)
+        self.request.sendall(STATUS.pack(status))
+
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Receive each request in the server process, load its voice there, then fork
+    a process to run it."""
+
+    def __init__(self, socket_path: str):
+        self.pending_request: Optional[dict] = None
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+    def process_request(self, request, client_address):
+        try:
+            request.settimeout(REQUEST_TIMEOUT)
+            self.pending_request = _receive_request(request)
+            request.settimeout(None)
+        except (OSError, ValueError) as error:
+            print(f"Bad request: {error}", file=sys.stderr)
+            self.shutdown_request(request)
+            return
+        _warm(self.pending_request)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            super().process_request(request, client_address)
+        finally:
+            # Only the server process gets here; the forked one exits.
+            for fd in self.pending_request["fds"]:
+                os.close(fd)
+            self.pending_request = None
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+        return
+    finally:
+        probe.close()
+    raise SystemExit(f"A server is already listening on {socket_path}")
+
+
+def serve(socket_path: str, voice_files: Iterable[str] = ()) -> None:
+    """Load cmudict and the given voices, then serve requests until interrupted."""
+    import oddvoices.cache
+
+    for module in PROGRAMS.values():
+        importlib.import_module(module)
+    oddvoices.cache.load_pronunciation_dict()
+    for voice_file in voice_files:
+        oddvoices.cache.load_database(voice_file)
+
+    _remove_stale_socket(socket_path)
+    server = Server(socket_path)
+    # Exit through the finally clause below so that the socket is removed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Listening on {socket_path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=default_socket_path())
+    parser.add_argument(
+        "--voice",
+        action="append",
+        default=[],
+        help="voice file to load at startup. Other voices are loaded on first use.",
+    )
+    args = parser.parse_args()
+    serve(args.socket, args.voice)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,535 @@
+"""A local HTTP service that renders music JSON with a pool of worker processes.
+
+    oddvoices-serve VOICE_FILE [VOICE_FILE ...] [--port 8000] [--workers N]
+
+Endpoints:
+
+    POST /render?voice=NAME&format=wav|raw&sample_format=float32|int16
+        The body is a music spec for oddvoices.frontend (text, notes, durations)
+        or music for oddvoices.synth (segments, events). With format=wav (the
+        default) the response is a WAV file. With format=raw, headerless
+        little-endian PCM is streamed with chunked encoding as it is rendered,
+        and the X-Sample-Rate and X-Sample-Format headers describe it.
+        sample_rate is also accepted. voice is the file name of the voice
+        without its extension and may be left out if only one voice is served.
+    GET /voices
+        The names of the voices, as JSON.
+    GET /metrics
+        Request counters and render totals, as JSON.
+
+The voices are loaded once into shared memory, which every worker reads from,
+and workers load cmudict once, at startup. At most workers +
+queue_size requests are accepted at a time; others get 503. A request that does
+not finish within the timeout gets 504, or is cut off if audio was already sent,
+and its render is stopped.
+"""
+
+import http.server
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional
+
+MAX_BODY_BYTES = 1 << 20
+# How many blocks a worker may render ahead of the client of its job.
+MAX_PENDING_BLOCKS = 16
+# How often a worker that is ahead checks whether the client caught up.
+POLL_INTERVAL = 0.01
+
+
+def _worker_main(
+    index,
+    voice_files,
+    voice_handles,
+    preload_dictionary,
+    jobs,
+    results,
+    cancelled_job,
+    consumed,
+):
+    import oddvoices.cache
+    import oddvoices.shared
+
+    oddvoices.shared.install(voice_handles)
+    if not oddvoices.shared.AVAILABLE:
+        for voice_file in voice_files.values():
+            oddvoices.cache.load_database(voice_file)
+    if preload_dictionary:
+        oddvoices.cache.load_pronunciation_dict()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if time.time() > job["deadline"]:
+            continue
+        try:
+            _render_job(index, job, voice_files, results, cancelled_job, consumed)
+        except Exception as error:
+            results.put((job["id"], "error", f"{type(error).__name__}: {error}"))
+
+
+class _JobCancellation:
+    """A cancellation token for oddvoices.synth that is cancelled when the service
+    sets the worker's flag to the job's id."""
+
+    def __init__(self, cancelled_job, job_id: int):
+        self.cancelled_job = cancelled_job
+        self.job_id = job_id
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_job.value == self.job_id
+
+
+def _get_consumed(consumed, job_id: int) -> int:
+    """The number of blocks of a job that its client has taken."""
+    with consumed.get_lock():
+        if consumed[0] != job_id:
+            return 0
+        return consumed[1]
+
+
+def _wait_for_client(job, blocks_sent: int, consumed, cancel) -> bool:
+    """Wait until the client of a job is at most MAX_PENDING_BLOCKS behind, so
+    that a slow client does not make the server buffer the whole render. Returns
+    False if the job was cancelled or ran out of time while waiting."""
+    while blocks_sent - _get_consumed(consumed, job["id"]) >= MAX_PENDING_BLOCKS:
+        if cancel.cancelled or time.time() > job["deadline"]:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def _render_job(index, job, voice_files, results, cancelled_job, consumed) -> None:
+    import oddvoices.cache
+    import oddvoices.frontend
+    import oddvoices.sinks
+    import oddvoices.synth
+
+    database = oddvoices.cache.load_database(voice_files[job["voice"]])
+    synth = oddvoices.synth.Synth(database, sample_rate=job["sample_rate"])
+    spec = job["spec"]
+    if "events" in spec:
+        music = spec
+    else:
+        pronunciation_dict = oddvoices.cache.load_pronunciation_dict()
+        music = oddvoices.frontend.make_music(synth, spec, pronunciation_dict)
+
+    results.put((job["id"], "start", (index, synth.sample_rate)))
+    start = time.perf_counter()
+    num_samples = 0
+    cancel = _JobCancellation(cancelled_job, job["id"])
+    blocks_sent = 0
+    try:
+        for block in oddvoices.synth.sing_blocks(synth, music, cancel=cancel):
+            if not _wait_for_client(job, blocks_sent, consumed, cancel):
+                return
+            block = oddvoices.sinks.convert_block(block, job["sample_format"])
+            results.put((job["id"], "block", block.tobytes()))
+            blocks_sent += 1
+            num_samples += len(block)
+    except oddvoices.synth.RenderCancelled:
+        return
+    render_seconds = time.perf_counter() - start
+    results.put((job["id"], "done", (num_samples / synth.sample_rate, render_seconds)))
+
+
+class RenderService:
+    """A pool of render worker processes shared by the HTTP handler threads.
+    voice_files maps voice names to voice files."""
+
+    def __init__(
+        self,
+        voice_files: Dict[str, str],
+        workers: int = 2,
+        queue_size: int = 8,
+        timeout: float = 60.0,
+        preload_dictionary: bool = True,
+    ):
+        self.voice_files = voice_files
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.job_ids = itertools.count(1)
+        self.job_queues: Dict[int, queue.Queue] = {}
+        self.lock = threading.Lock()
+        self.metrics = {
+            "requests": 0,
+            "completed": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "failed": 0,
+            "in_flight": 0,
+            "audio_seconds": 0.0,
+            "render_seconds": 0.0,
+        }
+
+        import oddvoices.shared
+
+        # The workers share a single copy of each voice, or without shared
+        # memory load their own.
+        self.shared_voices = []
+        if oddvoices.shared.AVAILABLE:
+            self.shared_voices = [
+                oddvoices.shared.SharedVoice.publish(voice_file)
+                for voice_file in voice_files.values()
+            ]
+        voice_handles = [voice.handle for voice in self.shared_voices]
+
+        self.jobs: multiprocessing.Queue = multiprocessing.Queue()
+        self.results: multiprocessing.Queue = multiprocessing.Queue()
+        self.workers = []
+        for i in range(workers):
+            cancelled_job = multiprocessing.Value("q", 0, lock=False)
+            # The id of the job the worker is rendering and how many of its
+            # blocks the client has taken.
+            consumed = multiprocessing.Array("q", 2)
+            process = multiprocessing.Process(
+                target=_worker_main,
+                args=(
+                    i,
+                    voice_files,
+                    voice_handles,
+                    preload_dictionary,
+                    self.jobs,
+                    self.results,
+                    cancelled_job,
+                    consumed,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.workers.append((process, cancelled_job, consumed))
+
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _dispatch(self) -> None:
+        """Route messages from the workers to the queue of the request they
+        belong to."""
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            with self.lock:
+                job_queue = self.job_queues.get(message[0])
+            if job_queue is not None:
+                job_queue.put(message[1:])
+
+    def _count(self, name: str, amount=1) -> None:
+        with self.lock:
+            self.metrics[name] += amount
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics["workers"] = len(self.workers)
+        metrics["workers_alive"] = sum(
+            process.is_alive() for process, cancelled_job, consumed in self.workers
+        )
+        return metrics
+
+    def render(self, job: dict):
+        """Submit a job and yield ("start", sample_rate), then ("block", bytes)
+        for each block and finally ("done", None). Raises RenderRejected if the
+        queue is full, RenderTimeout if the job takes longer than the timeout, and
+        RenderFailed if the worker raised an error."""
+        self._count("requests")
+        if not self.slots.acquire(blocking=False):
+            self._count("rejected")
+            raise RenderRejected()
+        self._count("in_flight")
+        job_id = next(self.job_ids)
+        # Not bounded, since the dispatcher must never block, but workers stay at
+        # most MAX_PENDING_BLOCKS ahead of the blocks taken from it.
+        job_queue: queue.Queue = queue.Queue()
+        with self.lock:
+            self.job_queues[job_id] = job_queue
+        deadline = time.time() + self.timeout
+        job = dict(job, id=job_id, deadline=deadline)
+        worker_index = None
+        blocks_consumed = 0
+        finished = False
+        try:
+            self.jobs.put(job)
+            while True:
+                try:
+                    kind, value = job_queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    self._count("timed_out")
+                    raise RenderTimeout()
+                if kind == "start":
+                    worker_index, sample_rate = value
+                    yield kind, sample_rate
+                elif kind == "block":
+                    yield kind, value
+                    blocks_consumed += 1
+                    assert worker_index is not None
+                    consumed = self.workers[worker_index][2]
+                    with consumed.get_lock():
+                        consumed[0] = job_id
+                        consumed[1] = blocks_consumed
+                elif kind == "error":
+                    finished = True
+                    self._count("failed")
+                    raise RenderFailed(value)
+                elif kind == "done":
+                    finished = True
+                    audio_seconds, render_seconds = value
+                    self._count("completed")
+                    self._count("audio_seconds", audio_seconds)
+                    self._count("render_seconds", render_seconds)
+                    yield kind, None
+                    return
+        finally:
+            # Stop the render if it timed out or the client went away. The worker
+            # checks its flag between blocks. A job that has not started is
+            # skipped once its deadline passes.
+            if not finished and worker_index is not None:
+                self.workers[worker_index][1].value = job_id
+            with self.lock:
+                del self.job_queues[job_id]
+            self._count("in_flight", -1)
+            self.slots.release()
+
+    def close(self) -> None:
+        for worker in self.workers:
+            self.jobs.put(None)
+        for process, cancelled_job, consumed in self.workers:
+            process.join()
+        self.results.put(None)
+        self.dispatcher.join()
+        for voice in self.shared_voices:
+            voice.close()
+
+
+class RenderRejected(Exception):
+    pass
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+class RenderFailed(Exception):
+    pass
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "HTTPServer"
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/metrics":
+            self._send_json(200, self.server.service.get_metrics())
+        elif path == "/voices":
+            self._send_json(200, sorted(self.server.service.voice_files))
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        import oddvoices.sinks
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/render":
+            self._send_json(404, {"error": "Not found"})
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self._send_json(400, {"error": "Invalid Content-Length"})
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_json(413, {"error": "Request body is too large"})
+            return
+        try:
+            spec = json.loads(self.rfile.read(length))
+        except ValueError as error:
+            self._send_json(400, {"error": f"Invalid JSON: {error}"})
+            return
+
+        voice_files = self.server.service.voice_files
+        voice = query.get("voice")
+        if voice is None and len(voice_files) == 1:
+            voice = next(iter(voice_files))
+        if voice not in voice_files:
+            self._send_json(404, {"error": f"Unknown voice: {voice}"})
+            return
+        output_format = query.get("format", "wav")
+        sample_format = query.get("sample_format", "float32")
+        if output_format not in ["wav", "raw"]:
+            self._send_json(400, {"error": f"Unknown format: {output_format}"})
+            return
+        if sample_format not in oddvoices.sinks.SAMPLE_FORMATS:
+            self._send_json(400, {"error": f"Unknown sample format: {sample_format}"})
+            return
+        sample_rate: Optional[float] = None
+        if "sample_rate" in query:
+            try:
+                sample_rate = float(query["sample_rate"])
+            except ValueError:
+                sample_rate = math.nan
+            # Also rejects nan.
+            if not 0 < sample_rate < math.inf:
+                self._send_json(
+                    400, {"error": f"Invalid sample rate: {query['sample_rate']}"}
+                )
+                return
+        job = {
+            "voice": voice,
+            "spec": spec,
+            "sample_format": sample_format,
+            "sample_rate": sample_rate,
+        }
+
+        messages = self.server.service.render(job)
+        try:
+            if output_format == "raw":
+                self._stream_raw(messages, sample_format)
+            else:
+                self._send_wav(messages, sample_format)
+        except RenderRejected:
+            self._send_json(503, {"error": "Too many requests"}, {"Retry-After": "1"})
+        except RenderTimeout:
+            self._send_json(504, {"error": "Render timed out"})
+        except RenderFailed as error:
+            self._send_json(500, {"error": str(error)})
+
+    def _send_wav(self, messages, sample_format: str) -> None:
+        import numpy as np
+        import soundfile
+
+        sample_rate = 0.0
+        blocks = []
+        for kind, value in messages:
+            if kind == "start":
+                sample_rate = value
+            elif kind == "block":
+                blocks.append(value)
+        dtype = "<f4" if sample_format == "float32" else "<i2"
+        audio = np.frombuffer(b"".join(blocks), dtype=dtype)
+        subtype = "PCM_16" if sample_format == "int16" else "FLOAT"
+        data = io.BytesIO()
+        soundfile.write(data, audio, int(sample_rate), format="WAV", subtype=subtype)
+        self._send(200, data.getvalue(), "audio/wav")
+
+    def _stream_raw(self, messages, sample_format: str) -> None:
+        kind, sample_rate = next(messages)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("X-Sample-Rate", str(sample_rate))
+        self.send_header("X-Sample-Format", sample_format)
+        self.end_headers()
+        try:
+            for kind, value in messages:
+                if kind == "block" and len(value) != 0:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(value), value))
+        except (RenderTimeout, RenderFailed):
+            # The status has already been sent. Ending without the final chunk
+            # tells the client that the response is incomplete.
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(
+        self, status: int, value, headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        self._send(status, json.dumps(value).encode(), "application/json", headers)
+
+    def _send(
+        self,
+        status: int,
+        body: bytes,
+        content_type: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service: RenderService, verbose: bool = False):
+        self.service = service
+        self.verbose = verbose
+        super().__init__(address, _Handler)
+
+
+def get_voice_name(voice_file: str) -> str:
+    return os.path.splitext(os.path.basename(voice_file))[0]
+
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+
+    import oddvoices.cache
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("voice_files", nargs="+")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=8,
+        help="requests to accept beyond one per worker before answering 503",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60.0, help="seconds allowed per request"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="log requests")
+    args = parser.parse_args(argv)
+
+    voice_files = {
+        get_voice_name(voice_file): voice_file for voice_file in args.voice_files
+    }
+    # Load cmudict before starting the workers, so that forked workers share it
+    # instead of each reading it again. The voices are published by the service.
+    oddvoices.cache.load_pronunciation_dict()
+
+    service = RenderService(
+        voice_files,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        timeout=args.timeout,
+    )
+    server = HTTPServer((args.host, args.port), service, verbose=args.verbose)
+    print(f"Serving on http://{args.host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
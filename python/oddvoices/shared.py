@@ -0,0 +1,173 @@
+"""Voice databases in shared memory, so that a pool of worker processes holds one
+copy of each voice instead of one per worker.
+
+The process that owns the pool publishes each voice:
+
+    voice = oddvoices.shared.SharedVoice.publish("quake.voice")
+
+and passes voice.handle, a small picklable dict, to its workers, which call
+install() with it. From then on oddvoices.cache.load_database returns a database
+whose frames are read-only NumPy views of the shared memory. The owner calls
+close() once the workers are done, which frees the memory after every process has
+detached from it. If the owner dies first, the multiprocessing resource tracker
+frees it.
+
+Workers must be started by the owner through multiprocessing, so that they share
+its resource tracker.
+
+Shared memory needs Python 3.8. On older versions AVAILABLE is False, and callers
+fall back to each process loading its own copy of the voice.
+"""
+
+import sys
+from typing import Dict, List
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # type: ignore
+
+import numpy as np
+
+import oddvoices.cache
+import oddvoices.voice_file
+
+AVAILABLE = shared_memory is not None
+
+# Shared memory attached by this process, kept open while views of it may exist.
+_attached: Dict[str, "shared_memory.SharedMemory"] = {}
+
+
+def _get_arrays(database) -> np.ndarray:
+    if "frames" in database:
+        return database["frames"]
+    if "frame_pool" in database:
+        return database["frame_pool"]
+    return np.concatenate(
+        [
+            oddvoices.voice_file.get_segment_frames(database, segment_id, keep=False)
+            for segment_id in database["segments_list"]
+        ]
+    )
+
+
+def _make_handle(database, memory, frames: np.ndarray) -> dict:
+    header = {
+        name: value
+        for name, value in database.items()
+        if name not in ["frames", "frame_pool"]
+    }
+    header["segments"] = {}
+    offsets = {}
+    offset = 0
+    for segment_id in database["segments_list"]:
+        segment = dict(database["segments"][segment_id])
+        segment.pop("frames", None)
+        segment.pop("encoded", None)
+        segment.pop("decoded", None)
+        header["segments"][segment_id] = segment
+        offsets[segment_id] = offset
+        offset += segment["num_frames"]
+    return {
+        "name": memory.name,
+        "dtype": frames.dtype.str,
+        "shape": frames.shape,
+        "arena": "frames" in database,
+        "pool": "frame_pool" in database,
+        "offsets": offsets,
+        "header": header,
+    }
+
+
+def _make_database(handle: dict, buffer) -> dict:
+    frames = np.ndarray(handle["shape"], dtype=handle["dtype"], buffer=buffer)
+    frames.flags.writeable = False
+    database = dict(handle["header"])
+    database["segments"] = {
+        segment_id: dict(segment)
+        for segment_id, segment in handle["header"]["segments"].items()
+    }
+    if handle["arena"]:
+        database["frames"] = frames
+    elif handle["pool"]:
+        # Segments keep their frame indices, which are part of the header.
+        database["frame_pool"] = frames
+    else:
+        for segment_id, segment in database["segments"].items():
+            offset = handle["offsets"][segment_id]
+            segment["frames"] = frames[offset : offset + segment["num_frames"]]
+    return database
+
+
+class SharedVoice:
+    """A voice database copied into shared memory owned by this process."""
+
+    def __init__(self, voice_file: str, database: dict):
+        self.voice_file = voice_file
+        self.closed = False
+        frames = _get_arrays(database)
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=max(frames.nbytes, 1)
+        )
+        shared_frames = np.ndarray(
+            frames.shape, dtype=frames.dtype, buffer=self.memory.buf
+        )
+        shared_frames[:] = frames
+        self.handle = _make_handle(database, self.memory, frames)
+        self.handle["voice_file"] = voice_file
+        # The owner uses the shared copy too, rather than keeping its own.
+        self.database = _make_database(self.handle, self.memory.buf)
+        oddvoices.cache.add_database(voice_file, self.database)
+
+    @classmethod
+    def publish(cls, voice_file: str, float_arena: bool = False) -> "SharedVoice":
+        with open(voice_file, "rb") as f:
+            database = oddvoices.voice_file.read_voice_file(f, float_arena=float_arena)
+        return cls(voice_file, database)
+
+    @property
+    def nbytes(self) -> int:
+        return self.memory.size
+
+    def close(self) -> None:
+        """Free the shared memory. Processes that still have it attached keep
+        their views until they exit."""
+        if self.closed:
+            return
+        self.closed = True
+        oddvoices.cache.remove_database(self.voice_file, self.database)
+        del self.database
+        self.memory.unlink()
+        try:
+            self.memory.close()
+        except BufferError:
+            # Views of the memory are still referenced in this process, so it
+            # stays mapped until the process exits.
+            _attached[self.memory.name] = self.memory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach(handle: dict) -> dict:
+    """Return a database whose frames are read-only views of a published voice."""
+    memory = _attached.get(handle["name"])
+    if memory is None:
+        if sys.version_info >= (3, 13):
+            memory = shared_memory.SharedMemory(handle["name"], track=False)
+        else:
+            # This registers the memory with the resource tracker again, which
+            # does nothing since workers share the owner's tracker.
+            memory = shared_memory.SharedMemory(handle["name"])
+        _attached[handle["name"]] = memory
+    return _make_database(handle, memory.buf)
+
+
+def install(handles: List[dict]) -> None:
+    """Attach published voices and put them in oddvoices.cache, so that
+    load_database returns them for their voice files."""
+    for handle in handles:
+        oddvoices.cache.add_database(handle["voice_file"], attach(handle))
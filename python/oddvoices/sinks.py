@@ -0,0 +1,109 @@
+import queue
+import sys
+import threading
+from typing import Optional, Union
+
+import numpy as np
+
+SAMPLE_FORMATS = ["float32", "int16"]
+
+
+def convert_block(block, sample_format: str):
+    """Convert a float32 block of samples to the given sample format."""
+    if sample_format == "float32":
+        return block
+    if sample_format == "int16":
+        return np.round(np.clip(block, -1, 1) * 32767).astype(np.int16)
+    raise ValueError(f"Unknown sample format: {sample_format}")
+
+
+class SoundFileSink:
+    """Write blocks to an audio file as they arrive. The file type is taken from
+    the extension, as with soundfile.write."""
+
+    def __init__(self, path: str, sample_rate: float, sample_format: str = "float32"):
+        # Imported here so that writing raw PCM does not load libsndfile.
+        import soundfile
+
+        subtype = "PCM_16" if sample_format == "int16" else None
+        self.file = soundfile.SoundFile(
+            path, "w", samplerate=int(sample_rate), channels=1, subtype=subtype
+        )
+
+    def write(self, block) -> None:
+        self.file.write(block)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class RawSink:
+    """Write blocks as headerless little-endian PCM to a binary stream, for example
+    stdout when piping into ffmpeg."""
+
+    def __init__(self, stream, sample_format: str = "float32"):
+        self.stream = stream
+        self.dtype = "<f4" if sample_format == "float32" else "<i2"
+
+    def write(self, block) -> None:
+        self.stream.write(block.astype(self.dtype).tobytes())
+
+    def close(self) -> None:
+        self.stream.flush()
+
+
+class ThreadedSink:
+    """Wrap another sink so that blocks are written on a background thread, which
+    lets encoding and disk I/O overlap with rendering. At most max_blocks blocks
+    are buffered; write() blocks when the writer falls behind. Errors raised by the
+    wrapped sink are raised again from the next write() or close()."""
+
+    def __init__(self, sink, max_blocks: int = 16):
+        self.sink = sink
+        self.queue: queue.Queue = queue.Queue(maxsize=max_blocks)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.sink.write(block)
+            except BaseException as error:
+                self.error = error
+
+    def _check_error(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+    def write(self, block) -> None:
+        self._check_error()
+        self.queue.put(block)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+        self._check_error()
+
+
+def open_sink(
+    out_file: str,
+    sample_rate: float,
+    sample_format: str = "float32",
+    threaded: bool = True,
+):
+    """Open a sink for out_file, which is a path or "-" for raw PCM on stdout."""
+    sink: Union[RawSink, SoundFileSink]
+    if out_file == "-":
+        sink = RawSink(sys.stdout.buffer, sample_format)
+    else:
+        sink = SoundFileSink(out_file, sample_rate, sample_format)
+    if threaded:
+        return ThreadedSink(sink)
+    return sink
@@ -1,12 +1,21 @@
-from typing import List
+import heapq
+import math
+import threading
+import time
+from typing import List, Optional, Tuple
 
 import numpy as np
-import soundfile
+
+import oddvoices.curves
+import oddvoices.voice_file
 
 
 class Grain:
-    def __init__(self, frame, old_frame, frame_length, crossfade, rate):
+    def __init__(
+        self, frame, old_frame, frame_length, crossfade, rate, scale=1 / 32767
+    ):
         self.rate = rate
+        self.scale = scale
         self.frame = frame
         self.old_frame = old_frame
         self.frame_length = frame_length
@@ -19,7 +28,6 @@ class Grain:
             self.playing = False
         if not self.playing:
             return 0
-        scale: float = 1 / 32767
         result = 0
         int_read_pos: int = int(self.read_pos)
         frac_read_pos: float = self.read_pos - int_read_pos
@@ -33,12 +41,72 @@ class Grain:
                 self.old_frame[int_read_pos] * (1 - frac_read_pos)
                 + self.old_frame[int_read_pos + 1] * frac_read_pos
             ) * self.crossfade
-        result *= scale
+        result *= self.scale
+        self.read_pos += self.rate
+        return result
+
+
+class DraftGrain(Grain):
+    """A grain that reads the nearest sample of its frames instead of
+    interpolating between two."""
+
+    def process(self):
+        if self.read_pos >= self.frame_length - 1:
+            self.playing = False
+        if not self.playing:
+            return 0
+        result = 0
+        index = int(self.read_pos + 0.5)
+        if self.frame is not None:
+            result += self.frame[index] * (1 - self.crossfade)
+        if self.old_frame is not None:
+            result += self.old_frame[index] * self.crossfade
+        result *= self.scale
         self.read_pos += self.rate
         return result
 
 
+class SynthStats:
+    """Counters collected by a Synth after enable_stats() is called. Samples taken
+    from a phrase cache are counted in cached_samples rather than
+    samples_rendered, and the time spent looking phrases up and storing them in
+    cache_seconds rather than render_seconds."""
+
+    def __init__(self):
+        self.samples_rendered = 0
+        self.cached_samples = 0
+        self.mixed_samples = 0
+        self.grains_started = 0
+        self.peak_grains = 0
+        self.total_live_grains = 0
+        self.segment_transitions = 0
+        self.start_grain_seconds = 0.0
+        self.mix_seconds = 0.0
+        self.render_seconds = 0.0
+        self.cache_seconds = 0.0
+
+    @property
+    def average_live_grains(self) -> float:
+        if self.mixed_samples == 0:
+            return 0.0
+        return self.total_live_grains / self.mixed_samples
+
+    @property
+    def samples_per_second(self) -> float:
+        if self.render_seconds == 0:
+            return 0.0
+        return self.samples_rendered / self.render_seconds
+
+    def as_dict(self) -> dict:
+        result = dict(vars(self))
+        result["average_live_grains"] = self.average_live_grains
+        result["samples_per_second"] = self.samples_per_second
+        return result
+
+
 class Synth:
+    grain_class = Grain
+
     def __init__(self, database, sample_rate=None):
         self.database = database
         self.database_rate: float = float(self.database["rate"])
@@ -51,6 +119,13 @@ class Synth:
         )
         self.max_frequency = 2000
         self.frame_length = self.database["grain_length"]
+        # Databases loaded with float_arena=True keep all frames in one float32
+        # array that is already scaled to [-1, 1].
+        self.arena = self.database.get("frames")
+        self.frame_scale = 1.0 if self.arena is not None else 1 / 32767
+        # Databases made by oddvoices.corpus.dedupe_frames keep int16 frames in a
+        # pool that segments index into.
+        self.frame_pool = self.database.get("frame_pool")
         self.crossfade_length = 0.03
 
         self.note_ons = 0
@@ -60,6 +135,8 @@ class Synth:
         self.phase = 0.0
         self.phoneme_speed = 1.0
         self.formant_shift = 1.0
+        self.vibrato = None
+        self.vibrato_time = 0.0
 
         self.grains = []
 
@@ -72,38 +149,97 @@ class Synth:
 
         self.segment_queue = []
         self.segment_is_long = False
+        self.stats: Optional[SynthStats] = None
+        # See oddvoices.phrase_cache.
+        self.canonical_phrase_starts = False
         self._new_segment()
 
+    def enable_stats(self) -> SynthStats:
+        """Start collecting a SynthStats. The instrumented methods replace process
+        and _start_grain on this instance only, so a synth without stats runs
+        exactly the same code as before."""
+        self.stats = SynthStats()
+        self.process = self._process_with_stats  # type: ignore
+        self._start_grain = self._start_grain_with_stats  # type: ignore
+        return self.stats
+
+    def _start_grain_with_stats(self):
+        start = time.perf_counter()
+        num_grains = len(self.grains)
+        type(self)._start_grain(self)
+        self.stats.grains_started += len(self.grains) - num_grains
+        self.stats.start_grain_seconds += time.perf_counter() - start
+
+    def _process_with_stats(self):
+        stats = self.stats
+        stats.samples_rendered += 1
+        if not self._update():
+            return 0.0
+
+        start = time.perf_counter()
+        self.grains = [grain for grain in self.grains if grain.playing]
+        result = sum([grain.process() for grain in self.grains])
+        stats.mix_seconds += time.perf_counter() - start
+
+        stats.mixed_samples += 1
+        stats.total_live_grains += len(self.grains)
+        stats.peak_grains = max(stats.peak_grains, len(self.grains))
+        return result
+
     def _start_grain(self):
         if self.segment_id == "-":
             return
 
-        frame_index = int(self.segment_time * self.expected_f0)
-        frame_index = (
-            frame_index % self.database["segments"][self.segment_id]["num_frames"]
-        )
-        frame = self.database["segments"][self.segment_id]["frames"][frame_index, :]
+        frame_index = self._get_frame_index(self.segment_id, self.segment_time)
 
         if self.old_segment_id != "-":
-            old_frame_index = int(self.old_segment_time * self.expected_f0)
-            old_frame_index = (
-                old_frame_index
-                % self.database["segments"][self.old_segment_id]["num_frames"]
+            old_frame_index = self._get_frame_index(
+                self.old_segment_id, self.old_segment_time
             )
-            old_frame = self.database["segments"][self.old_segment_id]["frames"][
-                old_frame_index, :
-            ]
         else:
-            old_frame = None
+            old_frame_index = None
+
+        grain = self._make_grain(
+            (self.segment_id, frame_index, self.old_segment_id, old_frame_index),
+            self.crossfade,
+            (self.database_rate / self.sample_rate) * self.formant_shift,
+        )
+        self.grains.append(grain)
 
-        grain = Grain(
+    def _make_grain(self, source, crossfade, rate):
+        """Make a grain from source, which is (segment_id, frame_index,
+        old_segment_id, old_frame_index). old_frame_index is None if there is no
+        old frame. The grain keeps its source, so that it can be made again."""
+        segment_id, frame_index, old_segment_id, old_frame_index = source
+        frame = self._get_frame(segment_id, frame_index)
+        old_frame = None
+        if old_frame_index is not None:
+            old_frame = self._get_frame(old_segment_id, old_frame_index)
+        grain = self.grain_class(
             frame,
             old_frame,
             self.frame_length,
-            crossfade=self.crossfade,
-            rate=(self.database_rate / self.sample_rate) * self.formant_shift,
+            crossfade=crossfade,
+            rate=rate,
+            scale=self.frame_scale,
         )
-        self.grains.append(grain)
+        grain.source = source
+        return grain
+
+    def _get_frame_index(self, segment_id, segment_time):
+        segment = self.database["segments"][segment_id]
+        return int(segment_time * self.expected_f0) % segment["num_frames"]
+
+    def _get_frame(self, segment_id, frame_index):
+        segment = self.database["segments"][segment_id]
+        if self.arena is not None:
+            return self.arena[segment["offset"] + frame_index]
+        if self.frame_pool is not None:
+            return self.frame_pool[segment["frame_indices"][frame_index]]
+        if "encoded" in segment:
+            frames = oddvoices.voice_file.decode_segment(self.database, segment_id)
+            return frames[frame_index, :]
+        return segment["frames"][frame_index, :]
 
     def _new_segment(self):
         if len(self.segment_queue) == 0:
@@ -115,6 +251,8 @@ class Synth:
         self.old_segment_time = self.segment_time
 
         self.segment_id = self.segment_queue.pop(0)
+        if self.stats is not None:
+            self.stats.segment_transitions += 1
         self.segment_time = 0.0
         if self.segment_id == "-":
             self.segment_length = 0
@@ -136,13 +274,30 @@ class Synth:
     def is_active(self):
         return self.segment_id != "-"
 
-    def process(self):
+    def is_silent(self):
+        """True if no notes are playing or waiting to play and no grains are left
+        to finish."""
+        return (
+            not self.is_active()
+            and self.note_ons == 0
+            and not any(grain.playing for grain in self.grains)
+        )
+
+    def is_idle(self):
+        """True if process() would return silence without changing any state."""
+        return not self.is_active() and (
+            self.note_ons == 0 or len(self.segment_queue) == 0
+        )
+
+    def _update(self):
+        """Advance the segment timeline and grain scheduler by one sample. Returns
+        False if the grains should not be mixed for this sample."""
         if not self.is_active() and self.note_ons == 0:
-            return 0.0
+            return False
 
         if not self.is_active() and self.note_ons != 0:
             if len(self.segment_queue) == 0:
-                return 0
+                return False
             else:
                 self.note_ons -= 1
                 self._new_segment()
@@ -170,6 +325,11 @@ class Synth:
             self.crossfade + self.crossfade_ramp * self.phoneme_speed, 0.0
         )
         self.phase += self.frequency / self.sample_rate
+        return True
+
+    def process(self):
+        if not self._update():
+            return 0.0
 
         self.grains = [grain for grain in self.grains if grain.playing]
         result = sum([grain.process() for grain in self.grains])
@@ -183,7 +343,554 @@ class Synth:
         self.note_offs += 1
 
 
-def sing(synth, music):
+# Default sample rate and grain polyphony of DraftSynth.
+DRAFT_SAMPLE_RATE = 16000
+DRAFT_MAX_GRAINS = 4
+
+
+class DraftSynth(Synth):
+    """A synth for quick previews, which renders at DRAFT_SAMPLE_RATE unless the
+    voice's own rate is lower, reads frames without interpolation and drops the
+    oldest grain when more than max_grains would overlap."""
+
+    grain_class = DraftGrain
+
+    def __init__(self, database, sample_rate=None, max_grains=DRAFT_MAX_GRAINS):
+        if sample_rate is None:
+            sample_rate = min(DRAFT_SAMPLE_RATE, database["rate"])
+        super().__init__(database, sample_rate=sample_rate)
+        self.max_grains = max_grains
+
+    def _start_grain(self):
+        playing = [grain for grain in self.grains if grain.playing]
+        if self.segment_id != "-" and len(playing) >= self.max_grains:
+            # Stopped grains are removed before the next mix.
+            playing[0].playing = False
+        super()._start_grain()
+
+
+class _Planner(Synth):
+    """A copy of a synth that runs the segment and event timeline without
+    rendering any audio. Grains are tracked only by the sample at which they
+    finish, counted in mixed samples like Synth.process counts them, and the
+    order in which they started. The cap of a DraftSynth is applied like
+    DraftSynth._start_grain applies it."""
+
+    def __init__(self, synth):
+        self.__dict__.update(synth.__dict__)
+        # Drop the instrumented methods that enable_stats() puts on the instance.
+        self.__dict__.pop("process", None)
+        self.__dict__.pop("_start_grain", None)
+        self.stats = None
+        self.segment_queue = list(synth.segment_queue)
+        self.grains = []
+        self.max_grains = getattr(synth, "max_grains", None)
+        self.mixed_samples = 0
+        self.grain_ends: List[Tuple[int, int]] = []
+        self.grain_lifetimes: dict = {}
+        self.grains_added = 0
+        self.num_grains = 0
+        self.peak_grains = 0
+        self.segments_used: List[str] = []
+        for grain in synth.grains:
+            if grain.playing:
+                self._add_grain(grain.rate, grain.read_pos)
+
+    def _add_grain(self, rate, read_pos=0):
+        key = (rate, read_pos)
+        if key not in self.grain_lifetimes:
+            # Count the samples exactly as Grain.process accumulates read_pos.
+            lifetime = 1
+            while read_pos < self.frame_length - 1:
+                read_pos += rate
+                lifetime += 1
+            self.grain_lifetimes[key] = lifetime
+        lifetime = self.grain_lifetimes[key]
+        heapq.heappush(
+            self.grain_ends, (self.mixed_samples + lifetime, self.grains_added)
+        )
+        self.grains_added += 1
+
+    def _stop_oldest_grain(self):
+        oldest = min(range(len(self.grain_ends)), key=lambda i: self.grain_ends[i][1])
+        self.grain_ends.pop(oldest)
+        heapq.heapify(self.grain_ends)
+
+    def _start_grain(self):
+        if self.segment_id == "-":
+            return
+        if self.max_grains is not None and len(self.grain_ends) >= self.max_grains:
+            self._stop_oldest_grain()
+        self._add_grain((self.database_rate / self.sample_rate) * self.formant_shift)
+        self.num_grains += 1
+
+    def _new_segment(self):
+        queue_length = len(self.segment_queue)
+        super()._new_segment()
+        if len(self.segment_queue) < queue_length and self.segment_id != "-":
+            self.segments_used.append(self.segment_id)
+
+    def process(self):
+        if not self._update():
+            return 0.0
+        while len(self.grain_ends) != 0 and self.grain_ends[0][0] <= self.mixed_samples:
+            heapq.heappop(self.grain_ends)
+        self.peak_grains = max(self.peak_grains, len(self.grain_ends))
+        self.mixed_samples += 1
+        return 0.0
+
+
+# Number of samples in each block yielded by sing_blocks.
+BLOCK_SIZE = 4096
+
+# Cost of each output sample while sing() collects float32 blocks and then
+# concatenates them.
+RENDER_BYTES_PER_SAMPLE = 4 + 4
+
+# Cost of the block sing_blocks() is filling, as a Python list of floats.
+BLOCK_BYTES_PER_SAMPLE = 8 + 24
+
+
+def _get_frames_nbytes(database):
+    """Bytes of frames once every segment is decoded."""
+    if "frames" in database:
+        return database["frames"].nbytes
+    if "frame_pool" in database:
+        return database["frame_pool"].nbytes + sum(
+            segment["frame_indices"].nbytes for segment in database["segments"].values()
+        )
+    return sum(
+        segment["num_frames"] * database["grain_length"] * 2
+        for segment in database["segments"].values()
+    )
+
+
+PARAMETERS = ["frequency", "phoneme_speed", "formant_shift"]
+
+
+def _validate_events(events):
+    """Check the curves in events, so that a bad one raises ValueError before any
+    of them is rendered or looked up in a phrase cache."""
+    for event in events:
+        for name in PARAMETERS:
+            if isinstance(event.get(name), dict):
+                oddvoices.curves.validate_curve(event[name])
+
+
+def _start_event(synth, event, num_samples):
+    """Apply an event's parameters and note on/off flags to the synth. Returns a
+    dict mapping parameter names to per-sample values for any parameters that
+    vary over the event."""
+    curves = {}
+    for name in PARAMETERS:
+        if name not in event:
+            continue
+        value = event[name]
+        if isinstance(value, dict):
+            start_value = getattr(synth, name)
+            curves[name] = oddvoices.curves.render_curve(
+                value, start_value, num_samples, synth.sample_rate
+            )
+            if num_samples > 0:
+                setattr(synth, name, curves[name][-1])
+        else:
+            setattr(synth, name, value)
+
+    if "vibrato" in event:
+        synth.vibrato = event["vibrato"]
+        synth.vibrato_time = 0.0
+    if synth.vibrato is not None:
+        frequency = curves.get("frequency", synth.frequency)
+        curves["frequency"] = frequency * oddvoices.curves.render_vibrato(
+            synth.vibrato, synth.vibrato_time, num_samples, synth.sample_rate
+        )
+        synth.vibrato_time += num_samples / synth.sample_rate
+
+    if event.get("note_on", False):
+        synth.note_on()
+    if event.get("note_off", False):
+        synth.note_off()
+
+    return {name: values.tolist() for name, values in curves.items()}
+
+
+def _render_event(synth, num_samples, curves, result, offset=0):
+    """Render num_samples samples of the current event into result, starting
+    offset samples into the event's curves."""
+    if len(curves) == 0:
+        for i in range(num_samples):
+            result.append(synth.process())
+        return
+
+    # Curves are written straight into the synth's parameters before each sample,
+    # which is all the phase accumulator and grain scheduler need.
+    final_values = {name: getattr(synth, name) for name in curves}
+    frequencies = curves.get("frequency")
+    phoneme_speeds = curves.get("phoneme_speed")
+    formant_shifts = curves.get("formant_shift")
+    for i in range(offset, offset + num_samples):
+        if frequencies is not None:
+            synth.frequency = frequencies[i]
+        if phoneme_speeds is not None:
+            synth.phoneme_speed = phoneme_speeds[i]
+        if formant_shifts is not None:
+            synth.formant_shift = formant_shifts[i]
+        result.append(synth.process())
+    for name, value in final_values.items():
+        setattr(synth, name, value)
+
+
+class RenderCancelled(Exception):
+    """Raised by a render whose CancellationToken was cancelled."""
+
+
+class CancellationToken:
+    """Ask a render to stop, from any thread. The render checks the token between
+    blocks and raises RenderCancelled, so it stops within one block. Any object
+    with a cancelled attribute can stand in for it, for example one that reads a
+    flag shared between processes."""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+def get_num_samples(synth, music) -> int:
+    """The number of samples sing(synth, music) renders. Events with a negative
+    duration, which oddvoices.frontend.make_music uses to start consonants early,
+    render nothing."""
+    return sum(
+        [
+            max(int(event["duration"] * synth.sample_rate), 0)
+            for event in music["events"]
+        ]
+    )
+
+
+def _track_render(blocks, total, progress, cancel):
+    """Pass blocks through, checking cancel before each one is rendered and
+    calling progress(samples_rendered, total) after."""
+    samples_rendered = 0
+    if cancel is not None and cancel.cancelled:
+        raise RenderCancelled()
+    for block in blocks:
+        samples_rendered += len(block)
+        if progress is not None:
+            progress(samples_rendered, total)
+        yield block
+        if cancel is not None and cancel.cancelled:
+            raise RenderCancelled()
+
+
+def sing_blocks(
+    synth, music, block_size=BLOCK_SIZE, phrase_cache=None, progress=None, cancel=None
+):
+    """Render music like sing(), but yield the output as float32 arrays of
+    block_size samples as soon as each is ready. The last block may be shorter.
+    Memory use does not grow with the length of the music.
+
+    If progress is given, it is called after each block with the number of
+    samples rendered so far and the total. If a CancellationToken is given as
+    cancel, it is checked between blocks and RenderCancelled is raised once it is
+    cancelled."""
+    total = get_num_samples(synth, music)
+    return sing_stream(
+        synth, [music], block_size, phrase_cache, progress, cancel, total
+    )
+
+
+def sing_stream(
+    synth,
+    chunks,
+    block_size=BLOCK_SIZE,
+    phrase_cache=None,
+    progress=None,
+    cancel=None,
+    total=None,
+):
+    """Like sing_blocks(), but take the music as an iterable of chunks, each with
+    its own "segments" and "events". A chunk's segments are queued just before its
+    events are rendered, so chunks can be produced while earlier ones play. The
+    output is the same as rendering all chunks joined together, as long as every
+    chunk queues the segments its events need.
+
+    If a phrase_cache (see oddvoices.phrase_cache) is given, phrases are looked up
+    in it and stored in it. Phrases do not extend across chunks.
+
+    The total passed to progress is total, which is None unless the caller knows
+    the length of the music in advance."""
+    blocks = _sing_stream(synth, chunks, block_size, phrase_cache)
+    if progress is None and cancel is None:
+        return blocks
+    return _track_render(blocks, total, progress, cancel)
+
+
+def _sing_stream(synth, chunks, block_size, phrase_cache):
+    if phrase_cache is not None or synth.canonical_phrase_starts:
+        yield from _sing_phrases(synth, chunks, block_size, phrase_cache)
+        return
+
+    block: list = []
+    for music in chunks:
+        _validate_events(music["events"])
+        _enqueue_segments(synth, music)
+        for event in music["events"]:
+            start = time.perf_counter()
+            num_samples = int(event["duration"] * synth.sample_rate)
+            curves = _start_event(synth, event, num_samples)
+            position = 0
+            while position < num_samples:
+                count = min(num_samples - position, block_size - len(block))
+                _render_event(synth, count, curves, block, position)
+                position += count
+                if len(block) == block_size:
+                    if synth.stats is not None:
+                        synth.stats.render_seconds += time.perf_counter() - start
+                    yield np.array(block, dtype="float32")
+                    start = time.perf_counter()
+                    block = []
+            if synth.stats is not None:
+                synth.stats.render_seconds += time.perf_counter() - start
+
+    if len(block) != 0:
+        yield np.array(block, dtype="float32")
+
+
+# Synth attributes that make up its state, apart from its grains and segment
+# queue.
+PHRASE_STATE = [
+    "note_ons",
+    "note_offs",
+    "frequency",
+    "phase",
+    "phoneme_speed",
+    "formant_shift",
+    "vibrato",
+    "vibrato_time",
+    "segment_id",
+    "segment_time",
+    "segment_length",
+    "segment_is_long",
+    "old_segment_id",
+    "old_segment_time",
+    "crossfade",
+    "crossfade_ramp",
+]
+
+# Of PHRASE_STATE, the attributes that can affect what a resting synth does next.
+# The segment attributes are all replaced when the next segment starts.
+RESTING_STATE = [
+    "note_offs",
+    "frequency",
+    "phase",
+    "phoneme_speed",
+    "formant_shift",
+    "vibrato",
+    "vibrato_time",
+]
+
+
+def _is_resting(synth):
+    return not synth.is_active() and synth.note_ons == 0
+
+
+def _sets_parameter(events, name):
+    """True if events set an attribute in RESTING_STATE, without using its old
+    value, before any note can sound."""
+    if name == "vibrato_time":
+        # Setting a vibrato restarts it.
+        name = "vibrato"
+    for event in events:
+        value = event.get(name)
+        if name in PARAMETERS and isinstance(value, dict):
+            # A curve starting after time 0 starts from the old value.
+            return value["points"][0][0] <= 0
+        if value is not None:
+            return True
+        if event.get("note_on", False):
+            return False
+    return False
+
+
+def _get_grains_state(synth):
+    """The grains that are still playing, as lists that can be stored as JSON."""
+    return [
+        list(grain.source) + [grain.crossfade, grain.rate, grain.read_pos]
+        for grain in synth.grains
+        if grain.playing
+    ]
+
+
+def _set_grains_state(synth, grains):
+    synth.grains = []
+    for values in grains:
+        grain = synth._make_grain(tuple(values[:4]), values[4], values[5])
+        grain.read_pos = values[6]
+        synth.grains.append(grain)
+
+
+def _get_state(synth):
+    """A snapshot of everything in the synth that rendering changes, apart from
+    its segment queue."""
+    state = {name: getattr(synth, name) for name in PHRASE_STATE}
+    state["grains"] = _get_grains_state(synth)
+    return state
+
+
+def _get_phrase_key(synth, events, phrase_cache):
+    """Key a phrase by the synth state it starts from and its events. If the synth
+    is resting, only the state that can affect the phrase is included, so that
+    the phrase can hit wherever the same state comes up."""
+    import oddvoices.phrase_cache
+
+    if _is_resting(synth):
+        state = {
+            name: getattr(synth, name)
+            for name in RESTING_STATE
+            if not _sets_parameter(events, name)
+        }
+        # A fresh synth does not crossfade into its first segment.
+        state["fresh"] = synth.old_segment_id is None
+    else:
+        state = {name: getattr(synth, name) for name in PHRASE_STATE}
+    state["grains"] = _get_grains_state(synth)
+    return oddvoices.phrase_cache.make_key(
+        {
+            "voice": phrase_cache.get_voice_fingerprint(synth.database),
+            "synth": type(synth).__name__,
+            "sample_rate": synth.sample_rate,
+            "crossfade_length": synth.crossfade_length,
+            "max_frequency": synth.max_frequency,
+            "state": state,
+            "events": events,
+        }
+    )
+
+
+def _use_cached_phrase(synth, entry) -> bool:
+    """Check that the queued segments match those used by a cached phrase, and if
+    so, consume them and move the synth to the phrase's end state."""
+    segments = entry["segments"]
+    queue = synth.segment_queue
+    if queue[: len(segments)] != segments:
+        return False
+    # A phrase that emptied the queue may have seen it empty.
+    if entry["emptied_queue"] != (len(queue) == len(segments)):
+        return False
+    del queue[: len(segments)]
+    for name in PHRASE_STATE:
+        setattr(synth, name, entry["state"][name])
+    _set_grains_state(synth, entry["state"]["grains"])
+    return True
+
+
+def _split_phrases(events):
+    """Split events into phrases, each starting at an event that starts a note."""
+    starts = [0] + [i for i in range(1, len(events)) if events[i].get("note_on", False)]
+    return [events[a:b] for a, b in zip(starts, starts[1:] + [len(events)])]
+
+
+def _render_phrases(synth, events, phrase_cache):
+    """Render events a phrase at a time, yielding each phrase as a float32 array.
+
+    A phrase runs from the start of one note to the start of the next. With a
+    phrase_cache, each phrase is looked up by the state of the synth when it
+    starts, including its grains, and stored with the state it ends in, so that a
+    hit leaves the synth exactly as rendering would."""
+    for phrase in _split_phrases(events):
+        if synth.canonical_phrase_starts and _is_resting(synth):
+            # Grains cut off when the synth stopped would resume at the next note.
+            synth.phase = 0.0
+            synth.vibrato_time = 0.0
+            synth.grains = []
+        key = None
+        entry = None
+        if phrase_cache is not None:
+            start = time.perf_counter()
+            key = _get_phrase_key(synth, phrase, phrase_cache)
+            entry = phrase_cache.get(key)
+            hit = entry is not None and _use_cached_phrase(synth, entry)
+            if synth.stats is not None:
+                synth.stats.cache_seconds += time.perf_counter() - start
+            if hit:
+                phrase_cache.hits += 1
+                phrase_cache.used.add(key)
+                if synth.stats is not None:
+                    synth.stats.cached_samples += len(entry["audio"])
+                yield entry["audio"]
+                continue
+            phrase_cache.misses += 1
+
+        start = time.perf_counter()
+        queued = list(synth.segment_queue)
+        result: list = []
+        for event in phrase:
+            num_samples = int(event["duration"] * synth.sample_rate)
+            curves = _start_event(synth, event, num_samples)
+            _render_event(synth, num_samples, curves, result)
+        audio = np.array(result, dtype="float32")
+        if synth.stats is not None:
+            synth.stats.render_seconds += time.perf_counter() - start
+
+        # Only the first entry for a key is kept, rather than one differing from
+        # it only in the segments queued after the phrase.
+        if key is not None and entry is None:
+            start = time.perf_counter()
+            consumed = len(queued) - len(synth.segment_queue)
+            new_entry = {
+                "audio": audio,
+                "segments": queued[:consumed],
+                "emptied_queue": len(synth.segment_queue) == 0,
+                "state": _get_state(synth),
+            }
+            phrase_cache.put(key, new_entry)
+            if synth.stats is not None:
+                synth.stats.cache_seconds += time.perf_counter() - start
+        yield audio
+
+
+def _sing_phrases(synth, chunks, block_size, phrase_cache):
+    pending: list = []
+    pending_samples = 0
+    for music in chunks:
+        _validate_events(music["events"])
+        _enqueue_segments(synth, music)
+        for phrase_audio in _render_phrases(synth, music["events"], phrase_cache):
+            pending.append(phrase_audio)
+            pending_samples += len(phrase_audio)
+            if pending_samples < block_size:
+                continue
+            audio = np.concatenate(pending)
+            end = len(audio) - len(audio) % block_size
+            for i in range(0, end, block_size):
+                yield audio[i : i + block_size]
+            pending = [audio[end:]]
+            pending_samples = len(audio) - end
+
+    if pending_samples != 0:
+        yield np.concatenate(pending)
+
+
+def sing(synth, music, phrase_cache=None, progress=None, cancel=None):
+    """Render music to a float32 array. See sing_blocks() for progress and
+    cancel."""
+    blocks = list(
+        sing_blocks(
+            synth, music, phrase_cache=phrase_cache, progress=progress, cancel=cancel
+        )
+    )
+    if len(blocks) == 0:
+        return np.zeros(0, dtype="float32")
+    return np.concatenate(blocks)
+
+
+def _enqueue_segments(synth, music):
     for segment_index in music["segments"]:
         if segment_index < 0:
             segment_name = "-"
@@ -191,23 +898,36 @@ def sing(synth, music):
             segment_name = synth.database["segments_list"][segment_index]
         synth.segment_queue.append(segment_name)
 
-    result = []
-    for i, event in enumerate(music["events"]):
-        duration = event["duration"]
-
-        if "frequency" in event:
-            synth.frequency = event["frequency"]
-        if "phoneme_speed" in event:
-            synth.phoneme_speed = event["phoneme_speed"]
-        if "formant_shift" in event:
-            synth.formant_shift = event["formant_shift"]
-
-        if event.get("note_on", False):
-            synth.note_on()
-        if event.get("note_off", False):
-            synth.note_off()
-
-        for i in range(int(duration * synth.sample_rate)):
-            result.append(synth.process())
 
-    return np.array(result, dtype="float32")
+def plan(synth, music):
+    """Predict the cost of sing(synth, music) without rendering audio, by running
+    only the segment and event timeline on a copy of the synth. The synth itself
+    is not modified."""
+    planner = _Planner(synth)
+    _validate_events(music["events"])
+    _enqueue_segments(planner, music)
+
+    num_samples = 0
+    for event in music["events"]:
+        event_samples = int(event["duration"] * planner.sample_rate)
+        num_samples += max(event_samples, 0)
+        curves = _start_event(planner, event, event_samples)
+        if planner.is_idle():
+            # Nothing changes while the synth is idle, so skip ahead.
+            continue
+        _render_event(planner, event_samples, curves, [])
+
+    return {
+        "sample_rate": planner.sample_rate,
+        "num_samples": num_samples,
+        "duration": num_samples / planner.sample_rate,
+        "num_grains": planner.num_grains,
+        "peak_grains": planner.peak_grains,
+        "num_segments": len(planner.segments_used),
+        "segments_used": sorted(set(planner.segments_used)),
+        "output_bytes": num_samples * 4,
+        "estimated_peak_bytes": _get_frames_nbytes(synth.database)
+        + num_samples * RENDER_BYTES_PER_SAMPLE,
+        "estimated_streaming_peak_bytes": _get_frames_nbytes(synth.database)
+        + BLOCK_SIZE * BLOCK_BYTES_PER_SAMPLE,
+    }
@@ -0,0 +1,261 @@
+"""Reading and writing voice files. Only NumPy is needed, so that rendering does
+not import the SciPy and soundfile dependencies of voice compilation in
+oddvoices.corpus."""
+
+import io
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+MAGIC_WORD = b"ODDVOICES\0\0\0"
+# Voice files whose segments are compressed with encode_frames. The C++ reader
+# rejects them.
+COMPRESSED_MAGIC_WORD = b"ODDVOICESZ\0\0"
+# Voice files whose segments refer to a frame pool made by
+# oddvoices.corpus.dedupe_frames. The C++ reader rejects them.
+POOLED_MAGIC_WORD = b"ODDVOICESP\0\0"
+
+# Held while a compressed segment is decoded, so that threads sharing a database
+# decode each segment once.
+_decode_lock = threading.Lock()
+
+
+def write_voice_file_header(f, database, magic_word=MAGIC_WORD):
+    f.write(magic_word)
+    f.write(struct.pack("<l", database["rate"]))
+    f.write(struct.pack("<l", database["grain_length"]))
+
+    for phoneme in database["phonemes"]:
+        f.write(phoneme.encode("ascii") + b"\0")
+    f.write(b"\0")
+
+    for segment_name in database["segments_list"]:
+        f.write(segment_name.encode("ascii") + b"\0")
+        num_frames = database["segments"][segment_name]["num_frames"]
+        is_long = database["segments"][segment_name]["long"]
+        f.write(struct.pack("<l", num_frames))
+        f.write(struct.pack("<l", 1 if is_long else 0))
+    f.write(b"\0")
+
+
+def encode_frames(frames):
+    """Compress int16 frames. Each frame is stored as its difference from the
+    previous one, which is small since neighboring pitch periods are alike. The
+    high and low bytes of the differences are then grouped separately, and the
+    result is compressed with zlib."""
+    frames = np.ascontiguousarray(frames, dtype="<i2")
+    deltas = np.diff(frames, axis=0, prepend=np.zeros_like(frames[:1]))
+    shuffled = deltas.view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(shuffled.tobytes(), 9)
+
+
+def decode_frames(data, num_frames, grain_length):
+    """Inverse of encode_frames."""
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(2, -1)
+    deltas = np.ascontiguousarray(shuffled.T).view("<i2")
+    deltas = deltas.reshape(num_frames, grain_length)
+    # Differences wrap around in int16, so summing them in int16 undoes them.
+    return np.cumsum(deltas, axis=0, dtype=np.int16)
+
+
+def decode_segment(database, segment_id, keep=True):
+    """Decode the frames of a segment read from a compressed voice file, which are
+    left encoded until first needed. Unless keep is False, they are kept in the
+    segment's "decoded" slot, so the rest of the database is never modified."""
+    segment = database["segments"][segment_id]
+    decoded = segment["decoded"]
+    if decoded:
+        return decoded[0]
+    if not keep:
+        return decode_frames(
+            segment["encoded"], segment["num_frames"], database["grain_length"]
+        )
+    with _decode_lock:
+        if not decoded:
+            decoded.append(
+                decode_frames(
+                    segment["encoded"], segment["num_frames"], database["grain_length"]
+                )
+            )
+    return decoded[0]
+
+
+def get_segment_frames(database, segment_id, keep=True):
+    """Return the frames of a segment as an int16 array, regardless of how the
+    database stores them in memory. With keep=False, the frames of a compressed
+    segment that has not been decoded yet are not kept."""
+    segment = database["segments"][segment_id]
+    if "frames" in segment:
+        return segment["frames"]
+    if "encoded" in segment:
+        return decode_segment(database, segment_id, keep=keep)
+    if "frame_indices" in segment:
+        return database["frame_pool"][segment["frame_indices"]]
+    offset = segment["offset"]
+    frames = database["frames"][offset : offset + segment["num_frames"]]
+    return np.round(frames * 32767).astype(np.int16)
+
+
+def make_frame_arena(database):
+    """Move the frames of all segments into one contiguous float32 array, stored as
+    database["frames"] and pre-scaled to [-1, 1]. Each segment is left with an
+    "offset" giving the index of its first frame in the arena."""
+    total_frames = sum(
+        database["segments"][segment_id]["num_frames"]
+        for segment_id in database["segments_list"]
+    )
+    arena = np.empty((total_frames, database["grain_length"]), dtype=np.float32)
+    offset = 0
+    for segment_id in database["segments_list"]:
+        segment = database["segments"][segment_id]
+        frames = get_segment_frames(database, segment_id, keep=False)
+        segment.pop("frames", None)
+        segment.pop("encoded", None)
+        segment.pop("decoded", None)
+        segment.pop("frame_indices", None)
+        arena[offset : offset + segment["num_frames"]] = frames * (1 / 32767)
+        segment["offset"] = offset
+        offset += segment["num_frames"]
+    database.pop("frame_pool", None)
+    database["frames"] = arena
+
+
+def write_voice_file(f, database, compress=False):
+    """Write a voice file. With compress, each segment is compressed with
+    encode_frames and preceded by its size in bytes.
+
+    A database with a frame pool from oddvoices.corpus.dedupe_frames is written
+    as the number of frames in the pool, the pool, and the frame indices of each
+    segment as int32. It cannot be compressed."""
+    if "frame_pool" in database:
+        if compress:
+            raise ValueError("A voice with a frame pool cannot be compressed")
+        write_voice_file_header(f, database, POOLED_MAGIC_WORD)
+        pool = database["frame_pool"]
+        f.write(struct.pack("<l", len(pool)))
+        f.write(np.ascontiguousarray(pool, dtype="<i2").tobytes())
+        for segment_name in database["segments_list"]:
+            indices = database["segments"][segment_name]["frame_indices"]
+            f.write(np.ascontiguousarray(indices, dtype="<i4").tobytes())
+        return
+    if compress:
+        write_voice_file_header(f, database, COMPRESSED_MAGIC_WORD)
+        for segment_name in database["segments_list"]:
+            frames = get_segment_frames(database, segment_name, keep=False)
+            data = encode_frames(frames)
+            f.write(struct.pack("<l", len(data)))
+            f.write(data)
+        return
+    write_voice_file_header(f, database)
+    for segment_name in database["segments_list"]:
+        array = get_segment_frames(database, segment_name, keep=False).flatten()
+        packed_array = struct.pack(f"<{len(array)}h", *array)
+        f.write(packed_array)
+
+
+def read_string(f):
+    result = []
+    while True:
+        c = f.read(1)
+        if c == b"\0":
+            break
+        if len(result) > 255:
+            raise ValueError("String longer than 255 characters")
+        result.append(c)
+    return b"".join(result).decode("ascii")
+
+
+def read_voice_file_header(f, database):
+    """Read the header of a voice file into database. Returns its magic word,
+    which tells how the frames that follow are stored."""
+    magic_word = f.read(len(MAGIC_WORD))
+    if magic_word not in [MAGIC_WORD, COMPRESSED_MAGIC_WORD, POOLED_MAGIC_WORD]:
+        raise RuntimeError("Invalid voice file")
+    database["rate"] = struct.unpack("<l", f.read(4))[0]
+    database["grain_length"] = struct.unpack("<l", f.read(4))[0]
+
+    database["phonemes"] = []
+    while True:
+        phoneme = read_string(f)
+        if len(phoneme) == 0:
+            break
+        database["phonemes"].append(phoneme)
+
+    database["segments_list"] = []
+    database["segments"] = {}
+    while True:
+        segment_id = read_string(f)
+        if len(segment_id) == 0:
+            break
+        database["segments_list"].append(segment_id)
+        database["segments"][segment_id] = {}
+        database["segments"][segment_id]["num_frames"] = struct.unpack("<l", f.read(4))[
+            0
+        ]
+        database["segments"][segment_id]["long"] = (
+            struct.unpack("<l", f.read(4))[0] != 0
+        )
+    return magic_word
+
+
+def read_voice_file(f, float_arena=False):
+    """Read a voice file. Segment frames are loaded as int16 arrays, unless
+    float_arena is True, in which case they are converted with make_frame_arena.
+
+    The segments of a compressed voice file are kept as "encoded" bytes until
+    get_segment_frames or the synth first needs their frames, which are then kept
+    in the segment's "decoded" list."""
+    database = {}
+    magic_word = read_voice_file_header(f, database)
+
+    if magic_word == POOLED_MAGIC_WORD:
+        pool_size = struct.unpack("<l", f.read(4))[0]
+        pool = np.frombuffer(f.read(pool_size * database["grain_length"] * 2), "<i2")
+        database["frame_pool"] = pool.astype(np.int16).reshape(
+            pool_size, database["grain_length"]
+        )
+
+    for segment_id in database["segments_list"]:
+        if magic_word == POOLED_MAGIC_WORD:
+            num_frames = database["segments"][segment_id]["num_frames"]
+            indices = np.frombuffer(f.read(num_frames * 4), dtype="<i4")
+            database["segments"][segment_id]["frame_indices"] = indices.astype(np.int32)
+            continue
+        if magic_word == COMPRESSED_MAGIC_WORD:
+            size = struct.unpack("<l", f.read(4))[0]
+            database["segments"][segment_id]["encoded"] = f.read(size)
+            database["segments"][segment_id]["decoded"] = []
+            continue
+        num_frames = database["segments"][segment_id]["num_frames"]
+        num_samples = num_frames * database["grain_length"]
+        array = np.frombuffer(f.read(num_samples * 2), dtype="<i2").astype(np.int16)
+        array = array.reshape(num_frames, database["grain_length"])
+        database["segments"][segment_id]["frames"] = array
+
+    if float_arena:
+        make_frame_arena(database)
+
+    return database
+
+
+def compare_encodings(database):
+    """Measure the size of a database as a raw and as a compressed voice file, and
+    the time to read each and get every segment's frames."""
+    report = {}
+    for name, compress in [("raw", False), ("compressed", True)]:
+        f = io.BytesIO()
+        write_voice_file(f, database, compress=compress)
+        data = f.getvalue()
+        start = time.perf_counter()
+        result = read_voice_file(io.BytesIO(data))
+        for segment_id in result["segments_list"]:
+            get_segment_frames(result, segment_id)
+        report[name] = {
+            "bytes": len(data),
+            "read_seconds": time.perf_counter() - start,
+        }
+    report["ratio"] = report["compressed"]["bytes"] / report["raw"]["bytes"]
+    return report
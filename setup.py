@@ -15,8 +15,12 @@ setuptools.setup(
     },
     entry_points={
         "console_scripts": [
-            "sing = oddvoices.frontend:main",
-            "sing-midi = oddvoices.midi_frontend:main",
+            "sing = oddvoices.server:sing_main",
+            "sing-midi = oddvoices.server:sing_midi_main",
+            "oddvoices-server = oddvoices.server:main",
+            "sing-batch = oddvoices.batch:main",
+            "oddvoices-qa = oddvoices.qa:main",
+            "oddvoices-serve = oddvoices.service:main",
             "oddvoices-compile = oddvoices.corpus:main",
             "oddvoices-generate-wordlist = oddvoices.phonology:generate_wordlist",
             "oddvoices-g2p = oddvoices.g2p:main",
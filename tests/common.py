@@ -1,3 +1,35 @@
 import pathlib
 
 TEST_ROOT = pathlib.Path(__file__).resolve().parent
+
+
+def make_test_database():
+    """Build a small voice database in memory, with segments that behave like a
+    real voice, for tests that cannot use the compiled voices."""
+    import numpy as np
+
+    rate = 8000
+    grain_length = 40
+    segments_list = ["_", "_A", "A", "A_", "_m", "m", "mA", "Am", "m_"]
+    t = np.arange(grain_length)
+    window = np.hanning(grain_length)
+    database: dict = {
+        "rate": rate,
+        "grain_length": grain_length,
+        "phonemes": ["A", "m", "_"],
+        "segments_list": segments_list,
+        "segments": {},
+    }
+    for i, segment_id in enumerate(segments_list):
+        is_long = segment_id == "A"
+        num_frames = 30 if is_long else 8 + i
+        frames = [
+            np.sin(2 * np.pi * (i + 1) * t / grain_length + j * 0.1) * window
+            for j in range(num_frames)
+        ]
+        database["segments"][segment_id] = {
+            "frames": (np.array(frames) * 20000).astype(np.int16),
+            "num_frames": num_frames,
+            "long": is_long,
+        }
+    return database
@@ -0,0 +1,66 @@
+import asyncio
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+import oddvoices.aio
+import oddvoices.corpus
+import oddvoices.synth
+import common
+from test_synth import EXAMPLE_MUSIC
+
+
+@pytest.fixture(scope="module")
+def voice_file(tmp_path_factory):
+    voice_file = str(tmp_path_factory.mktemp("voices") / "test.voice")
+    with open(voice_file, "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+    return voice_file
+
+
+def test_render(voice_file):
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    async def render_all():
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            return await asyncio.gather(
+                oddvoices.aio.render(voice_file, EXAMPLE_MUSIC),
+                oddvoices.aio.render(voice_file, EXAMPLE_MUSIC, block_size=1000),
+                oddvoices.aio.render(voice_file, EXAMPLE_MUSIC, executor=executor),
+            )
+
+    for result in asyncio.run(render_all()):
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_cancel(voice_file, use_processes):
+    music = {
+        "segments": [-1, 2],
+        "events": [{"frequency": 100, "duration": 60, "note_on": True}],
+    }
+
+    async def consume(blocks, executor):
+        iterator = oddvoices.aio.sing_blocks(
+            voice_file, music, executor=executor, block_size=100
+        )
+        async for block in iterator:
+            blocks.append(block)
+
+    async def cancel_after_first_block():
+        blocks: list = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            task = asyncio.ensure_future(
+                consume(blocks, executor if use_processes else None)
+            )
+            while len(blocks) == 0:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        return blocks
+
+    blocks = asyncio.run(asyncio.wait_for(cancel_after_first_block(), 30))
+    assert 0 < len(blocks) < 60 * 8000 / 100
@@ -0,0 +1,48 @@
+import json
+
+import numpy as np
+import soundfile
+
+import oddvoices.batch
+import oddvoices.corpus
+import oddvoices.frontend
+import common
+
+SPEC = {"text": "/mA/ /Am/", "notes": [60, 64], "durations": [0.5]}
+
+
+def test_estimate_cost():
+    spec = {"notes": [60], "durations": [1, 2], "rests": [0, 0.5], "bpm": 120}
+    assert oddvoices.batch.get_music_seconds(spec, 3) == (1 + 2.5 + 1) / 2
+    costs = [oddvoices.batch.estimate_cost(spec, count) for count in [1, 4, 2, 4]]
+    assert oddvoices.batch.schedule(costs) == [1, 3, 2, 0]
+
+
+def test_run_batch(tmp_path):
+    with open(tmp_path / "test.voice", "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+    with open(tmp_path / "music.json", "w") as f:
+        json.dump(SPEC, f)
+    manifest = [
+        {"voice": "test.voice", "spec": "music.json", "output": "1.wav"},
+        {"voice": "missing.voice", "spec": "music.json", "output": "2.wav"},
+        {"voice": "test.voice", "spec": "missing.json", "output": "3.wav"},
+        {"voice": "test.voice", "spec": SPEC, "output": "4.wav"},
+    ]
+    with open(tmp_path / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+
+    jobs = oddvoices.batch.read_manifest(str(tmp_path / "manifest.json"))
+    report = oddvoices.batch.run_batch(jobs, max_workers=2)
+
+    statuses = [result["status"] for result in report["jobs"]]
+    assert statuses == ["ok", "failed", "failed", "ok"]
+    assert (report["succeeded"], report["failed"]) == (2, 2)
+    assert "FileNotFoundError" in report["jobs"][1]["error"]
+    oddvoices.frontend.sing(
+        str(tmp_path / "test.voice"), SPEC, str(tmp_path / "expected.wav")
+    )
+    expected, rate = soundfile.read(tmp_path / "expected.wav")
+    for name in ["1.wav", "4.wav"]:
+        result, rate = soundfile.read(tmp_path / name)
+        np.testing.assert_array_equal(result, expected)
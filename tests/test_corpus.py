@@ -1,6 +1,7 @@
 import io
 import numpy as np
 import oddvoices.corpus
+import common
 
 
 def test_write_and_read_voice_file():
@@ -41,3 +42,85 @@ def test_write_and_read_voice_file():
         assert expected["num_frames"] == actual["num_frames"]
         assert expected["long"] == actual["long"]
         assert np.all(expected["frames"] == actual["frames"])
+
+
+def test_frame_arena():
+    database = common.make_test_database()
+    expected = {
+        segment_id: database["segments"][segment_id]["frames"].copy()
+        for segment_id in database["segments_list"]
+    }
+
+    f = io.BytesIO()
+    oddvoices.corpus.write_voice_file(f, database)
+    f.seek(0)
+    result = oddvoices.corpus.read_voice_file(f, float_arena=True)
+
+    assert result["frames"].dtype == np.float32
+    assert result["frames"].flags["C_CONTIGUOUS"]
+    for segment_id in database["segments_list"]:
+        segment = result["segments"][segment_id]
+        offset = segment["offset"]
+        np.testing.assert_allclose(
+            result["frames"][offset : offset + segment["num_frames"]] * 32767,
+            expected[segment_id],
+            atol=1e-2,
+        )
+        assert np.all(
+            oddvoices.corpus.get_segment_frames(result, segment_id)
+            == expected[segment_id]
+        )
+
+
+def test_compressed_voice_file():
+    database = common.make_test_database()
+
+    f = io.BytesIO()
+    oddvoices.corpus.write_voice_file(f, database, compress=True)
+    assert len(f.getvalue()) < sum(
+        segment["frames"].nbytes for segment in database["segments"].values()
+    )
+    f.seek(0)
+    result = oddvoices.corpus.read_voice_file(f)
+
+    assert result["segments_list"] == database["segments_list"]
+    segment = result["segments"]["A"]
+    assert "frames" not in segment and segment["decoded"] == []
+    frames = oddvoices.corpus.get_segment_frames(result, "A")
+    assert segment["decoded"][0] is frames and "encoded" in segment
+    assert np.all(frames == database["segments"]["A"]["frames"])
+    for segment_id in database["segments_list"]:
+        assert np.all(
+            oddvoices.corpus.get_segment_frames(result, segment_id)
+            == database["segments"][segment_id]["frames"]
+        )
+
+
+def test_dedupe_frames():
+    database = common.make_test_database()
+    # Every segment ends on a copy of the first frame of "A", slightly changed.
+    frame = database["segments"]["A"]["frames"][0]
+    for segment_id in database["segments_list"]:
+        segment = database["segments"][segment_id]
+        segment["frames"][-1] = frame + segment["num_frames"] % 3
+    expected = {
+        segment_id: database["segments"][segment_id]["frames"].copy()
+        for segment_id in database["segments_list"]
+    }
+    num_frames = sum(len(frames) for frames in expected.values())
+
+    threshold = 0.001
+    report = oddvoices.corpus.dedupe_frames(database, threshold)
+    assert report["frames"] == num_frames
+    assert report["pool_frames"] <= num_frames - len(expected) + 1
+    assert report["max_error_db"] <= 20 * np.log10(threshold)
+
+    f = io.BytesIO()
+    oddvoices.corpus.write_voice_file(f, database)
+    f.seek(0)
+    result = oddvoices.corpus.read_voice_file(f)
+    assert len(result["frame_pool"]) == report["pool_frames"]
+    for segment_id in database["segments_list"]:
+        frames = oddvoices.corpus.get_segment_frames(result, segment_id)
+        errors = (frames.astype(float) - expected[segment_id]) / 32767
+        assert np.all(np.sqrt(np.mean(np.square(errors), axis=1)) <= threshold)
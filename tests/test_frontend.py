@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+import soundfile
+
+import oddvoices.cache
+import oddvoices.corpus
+import oddvoices.frontend
+import oddvoices.g2p
+import oddvoices.synth
+import common
+
+PRONUNCIATION_DICT = {
+    "ma": ["m", "A"],
+    "am": ["A", "m"],
+    "mama": ["m", "A", "m", "A"],
+}
+
+
+def test_make_music_chunks_matches_make_music():
+    spec = {
+        "text": "ma am, mama\nam ma. mama am",
+        "notes": [60, 62, 64],
+        "durations": [0.3, 0.6],
+        "portamento": 0.05,
+    }
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    music = oddvoices.frontend.make_music(synth, spec, PRONUNCIATION_DICT)
+    expected = oddvoices.synth.sing(synth, music)
+
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    phrases = oddvoices.g2p.split_phrases(spec["text"])
+    assert len(phrases) == 4
+    phonemes = [
+        oddvoices.g2p.pronounce_text(phrase, PRONUNCIATION_DICT) for phrase in phrases
+    ]
+    chunks = list(oddvoices.frontend.make_music_chunks(synth, spec, phonemes))
+    assert sum(len(chunk["segments"]) for chunk in chunks) == len(music["segments"])
+    assert sum(len(chunk["events"]) for chunk in chunks) == len(music["events"])
+    blocks = list(oddvoices.synth.sing_stream(synth, chunks, block_size=1000))
+
+    assert np.max(np.abs(expected)) > 0.1
+    np.testing.assert_array_equal(np.concatenate(blocks), expected)
+
+
+def render_with_cache(spec, directory=None, canonical_phrase_starts=False):
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    music = oddvoices.frontend.make_music(synth, spec, PRONUNCIATION_DICT)
+    cache = oddvoices.frontend.make_phrase_cache(
+        synth, directory, canonical_phrase_starts
+    )
+    result = oddvoices.synth.sing(synth, music, phrase_cache=cache)
+    if cache is not None:
+        cache.prune()
+    return result, cache
+
+
+def test_incremental_render(tmp_path):
+    # Nine syllables sung legato, with no rests.
+    spec = {
+        "text": "ma am mama am ma mama ma",
+        "notes": [60, 62, 64, 65, 67, 69, 71, 72],
+        "durations": [0.5],
+    }
+    expected, _ = render_with_cache(spec)
+    render_with_cache(spec, tmp_path)
+    result, cache = render_with_cache(spec, tmp_path)
+    np.testing.assert_array_equal(result, expected)
+    assert (cache.hits, cache.misses) == (9, 0)
+
+    # Change the note of the sixth syllable. The five before it are reused.
+    spec["notes"][5] = 53
+    expected, _ = render_with_cache(spec)
+    result, cache = render_with_cache(spec, tmp_path)
+    np.testing.assert_array_equal(result, expected)
+    assert (cache.hits, cache.misses) == (5, 4)
+    assert len(list(tmp_path.iterdir())) == 9
+
+
+def test_incremental_render_canonical(tmp_path):
+    spec = {
+        "text": "ma am mama am ma mama ma",
+        "notes": [60, 62, 64, 65, 67, 69, 71, 72],
+        "durations": [0.5],
+        "rests": [0.2, 0, 0.3],
+    }
+    render_with_cache(spec, tmp_path, canonical_phrase_starts=True)
+
+    # Change a note and a word in the second phrase.
+    spec["notes"][3] = 53
+    spec["text"] = spec["text"].replace("mama am ma", "mama ma ma")
+    expected, _ = render_with_cache(spec, canonical_phrase_starts=True)
+    result, cache = render_with_cache(spec, tmp_path, canonical_phrase_starts=True)
+
+    np.testing.assert_array_equal(result, expected)
+    # Only the two edited syllables are rendered again, since the syllable after
+    # them starts from silence.
+    assert (cache.hits, cache.misses) == (8, 2)
+    assert len(list(tmp_path.iterdir())) == 10
+
+
+def test_plan_with_resample(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        oddvoices.cache, "load_pronunciation_dict", lambda: PRONUNCIATION_DICT
+    )
+    voice_file = str(tmp_path / "test.voice")
+    with open(voice_file, "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+    spec = {"text": "ma mama", "notes": [60, 62], "durations": [0.5]}
+    out_file = str(tmp_path / "out.wav")
+
+    plan = oddvoices.frontend.plan(voice_file, spec, 48000, resample=True)
+    oddvoices.frontend.sing(voice_file, spec, out_file, 48000, resample=True)
+    info = soundfile.info(out_file)
+    assert plan["render_sample_rate"] == common.make_test_database()["rate"]
+    assert plan["sample_rate"] == info.samplerate == 48000
+    assert plan["num_samples"] == info.frames
+
+
+def test_get_sample_format():
+    assert oddvoices.frontend.get_sample_format(None, False) == "float32"
+    assert oddvoices.frontend.get_sample_format(None, True) == "int16"
+    assert oddvoices.frontend.get_sample_format("float32", True) == "float32"
+    args = oddvoices.frontend.make_parser().parse_args(["v", "m", "o", "--draft"])
+    assert args.sample_format is None
+
+
+def test_incremental_requires_phrase_cache():
+    with pytest.raises(SystemExit):
+        oddvoices.frontend.main(["test.voice", "song.json", "out.wav", "--incremental"])
+
+
+def test_cancelled_write_leaves_no_file(tmp_path):
+    out_file = tmp_path / "out.wav"
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    music = oddvoices.frontend.make_music(
+        synth, {"text": "mama", "notes": [60], "durations": [1]}, PRONUNCIATION_DICT
+    )
+    cancel = oddvoices.synth.CancellationToken()
+
+    def progress(samples_rendered, total):
+        if samples_rendered >= total / 2:
+            cancel.cancel()
+
+    blocks = oddvoices.synth.sing_blocks(
+        synth, music, block_size=1000, progress=progress, cancel=cancel
+    )
+    with pytest.raises(oddvoices.synth.RenderCancelled):
+        oddvoices.frontend.write_blocks(
+            blocks, str(out_file), synth.sample_rate, "float32", None
+        )
+    assert list(tmp_path.iterdir()) == []
+
+    blocks = oddvoices.synth.sing_blocks(synth, music)
+    oddvoices.frontend.write_blocks(
+        blocks, str(out_file), synth.sample_rate, "float32", None
+    )
+    assert list(tmp_path.iterdir()) == [out_file]
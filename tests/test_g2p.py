@@ -143,3 +143,13 @@ def test_tokenize(text, expected):
 )
 def test_pronounce_unrecognized_word(word, expected):
     assert oddvoices.g2p.pronounce_unrecognized_word(word) == expected
+
+
+def test_split_phrases():
+    text = 'Hello, world.\n"Goodbye /w@`ld/." Again\n\n'
+    phrases = oddvoices.g2p.split_phrases(text)
+    assert phrases == ["Hello,", "world.", '"Goodbye /w@`ld/."', "Again"]
+    phonemes = []
+    for phrase in phrases:
+        phonemes.extend(oddvoices.g2p.pronounce_text(phrase, {}))
+    assert phonemes == oddvoices.g2p.pronounce_text(text, {})
@@ -0,0 +1,110 @@
+import mido
+import numpy as np
+import pytest
+
+import oddvoices.frontend
+import oddvoices.midi_frontend
+
+
+def make_midi_file():
+    midi_file = mido.MidiFile(ticks_per_beat=100)
+    conductor = mido.MidiTrack(
+        [
+            mido.MetaMessage("set_tempo", tempo=500_000, time=0),
+            mido.MetaMessage("set_tempo", tempo=1_000_000, time=200),
+        ]
+    )
+    melody = mido.MidiTrack(
+        [
+            mido.Message("note_on", note=60, velocity=100, time=0),
+            mido.Message("note_on", note=60, velocity=100, time=50),
+            mido.Message("note_off", note=60, time=50),
+            mido.Message("note_off", note=60, time=25),
+            # Rest, then a note that crosses the tempo change.
+            mido.Message("note_on", note=62, velocity=100, time=25),
+            mido.Message("note_on", note=62, velocity=0, time=100),
+        ]
+    )
+    bass = mido.MidiTrack(
+        [
+            mido.Message("note_on", channel=1, note=40, velocity=100, time=0),
+            mido.Message("note_on", channel=2, note=43, velocity=100, time=0),
+            mido.Message("note_off", channel=2, note=43, time=100),
+            mido.Message("note_off", channel=1, note=40, time=100),
+        ]
+    )
+    midi_file.tracks.extend([conductor, melody, bass])
+    return midi_file
+
+
+def test_make_music_specs_from_midi_file():
+    specs = oddvoices.midi_frontend.make_music_specs_from_midi_file(make_midi_file())
+    assert [(spec["track"], spec["channel"]) for spec in specs] == [
+        (1, 0),
+        (2, 1),
+        (2, 2),
+    ]
+
+    melody = specs[0]
+    assert melody["notes"] == [60, 60, 62]
+    # The first note on is paired with the first note off, and is cut short by
+    # the second note on. 100 ticks is 0.5 s before tick 200 and 1 s after it.
+    assert melody["durations"] == pytest.approx([0.25, 0.375, 0.25 + 0.5])
+    assert melody["rests"] == pytest.approx([0, 0, 0.125])
+    assert specs[1]["durations"] == pytest.approx([1.0])
+    assert specs[2]["durations"] == pytest.approx([0.5])
+
+
+def test_make_events_with_rests():
+    spec = {"notes": [60], "durations": [1.0], "rests": [0.5, 0], "bpm": 120}
+    events = oddvoices.frontend.make_events(spec, 3, [0.1, 0.1, 0.1])
+    assert [event["duration"] for event in events] == pytest.approx(
+        [0.25, 0.4, 0.1, 0.4, 0.1, 0.25, 0.4, 0.1]
+    )
+
+
+def test_midi_file_reader(tmp_path):
+    midi_file = make_midi_file()
+    midi_file.tracks[1].insert(1, mido.Message("program_change", program=3, time=10))
+    midi_file.tracks[1][2].time -= 10
+    path = str(tmp_path / "test.mid")
+    midi_file.save(path)
+
+    reader = oddvoices.midi_frontend.MidiFileReader(path)
+    assert reader.ticks_per_beat == 100
+    assert len(reader.tracks) == 3
+    assert oddvoices.midi_frontend.make_music_specs_from_midi_file(
+        reader
+    ) == oddvoices.midi_frontend.make_music_specs_from_midi_file(midi_file)
+
+
+def test_parse_track_running_status():
+    # A note on and a note on with velocity 0 that reuses its status byte.
+    data = bytes([0x00, 0x91, 60, 100, 0x60, 60, 0, 0x00, 0xFF, 0x2F, 0x00])
+    events = list(oddvoices.midi_frontend.parse_track(data))
+    assert [(event.type, event.time, event.note) for event in events] == [
+        ("note_on", 0, 60),
+        ("note_on", 0x60, 60),
+        ("end_of_track", 0, 0),
+    ]
+    assert events[1].channel == 1
+    assert events[1].velocity == 0
+
+
+def test_mix_part_files(tmp_path):
+    parts = [np.full(10, 0.5, dtype="float32"), np.full(4, 1.0, dtype="float32")]
+    part_files = []
+    for i, part in enumerate(parts):
+        part_files.append(str(tmp_path / f"part-{i}.raw"))
+        part.tofile(part_files[-1])
+
+    blocks = list(oddvoices.midi_frontend.mix_part_files(part_files, block_size=4))
+    assert [len(block) for block in blocks] == [4, 4, 2]
+    np.testing.assert_array_equal(np.concatenate(blocks), [0.75] * 4 + [0.25] * 6)
+
+
+def test_incremental_requires_phrase_cache():
+    with pytest.raises(SystemExit):
+        oddvoices.midi_frontend.main(
+            ["test.voice", "song.mid", "out.wav", "-l", "la", "--incremental"]
+        )
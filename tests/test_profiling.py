@@ -0,0 +1,33 @@
+import numpy as np
+
+import oddvoices.profiling
+
+
+def test_stage_profiler():
+    records = []
+    profiler = oddvoices.profiling.StageProfiler(
+        callback=records.append, trace_memory=True
+    )
+    with profiler.stage("allocate"):
+        array = np.ones(1_000_000)
+    with profiler.stage("nothing"):
+        pass
+
+    assert [record["stage"] for record in profiler.stages] == ["allocate", "nothing"]
+    assert records == profiler.stages
+    assert profiler.stages[0]["peak_memory_bytes"] >= array.nbytes
+    assert profiler.stages[1]["peak_memory_bytes"] < array.nbytes
+    assert profiler.as_dict()["total_seconds"] >= 0
+
+
+def test_null_stage():
+    with oddvoices.profiling.stage(None, "anything"):
+        pass
+
+
+def test_stage_profiler_without_tracing():
+    profiler = oddvoices.profiling.StageProfiler()
+    with profiler.stage("nothing"):
+        pass
+    assert "peak_memory_bytes" not in profiler.stages[0]
+    assert profiler.stages[0]["seconds"] >= 0
@@ -0,0 +1,43 @@
+import pytest
+
+import oddvoices.corpus
+import oddvoices.qa
+import oddvoices.shared
+import common
+
+
+def test_get_pairs():
+    database = common.make_test_database()
+    assert oddvoices.qa.split_segment(database, "mA") == ("m", "A")
+    assert oddvoices.qa.split_segment(database, "_") == ("_", "_")
+    pairs = oddvoices.qa.get_pairs(database)
+    assert ["_A", "A"] in pairs
+    assert ["A", "Am"] in pairs
+    assert ["Am", "A"] not in pairs
+
+
+@pytest.mark.parametrize("shared", [True, False])
+def test_run_qa(tmp_path, monkeypatch, shared):
+    if shared and not oddvoices.shared.AVAILABLE:
+        pytest.skip("no shared memory")
+    monkeypatch.setattr(oddvoices.shared, "AVAILABLE", shared)
+    voice_file = str(tmp_path / "test.voice")
+    with open(voice_file, "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+
+    rows = oddvoices.qa.run_qa(
+        voice_file, frequencies=[100, 200], formant_shifts=[1.0], max_workers=2
+    )
+    assert len(rows) == 9 * 2
+    loop_jumps = [row["loop_jump_db"] for row in rows if row["segments"] == "A"]
+    assert len(loop_jumps) == 2 and all(jump > 0 for jump in loop_jumps)
+    discontinuities = [row["discontinuity"] for row in rows]
+    assert discontinuities == sorted(discontinuities, reverse=True)
+    assert all(row["peak"] > 0 for row in rows if row["segments"] == "A")
+    assert all(row["clipped"] == 0 for row in rows)
+
+    rows = oddvoices.qa.run_qa(
+        voice_file, pairs=True, frequencies=[100], formant_shifts=[1.0]
+    )
+    assert len(rows) == len(oddvoices.qa.get_pairs(common.make_test_database()))
+    assert max(row["discontinuity"] for row in rows) > 0
@@ -0,0 +1,82 @@
+import mido
+import numpy as np
+
+import oddvoices.realtime
+import oddvoices.synth
+import oddvoices.utils
+import common
+
+SEGMENTS = [1, 2, 3, -1, 4, 6, 7, 8]
+EVENTS = [
+    {"frequency": 100, "duration": 0.5, "note_on": True},
+    {"duration": 0.1, "note_off": True},
+    {"frequency": 150, "duration": 0.5, "note_on": True, "formant_shift": 1.5},
+    {"duration": 0.1, "note_off": True},
+]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_matches_offline_render():
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    expected = oddvoices.synth.sing(synth, {"segments": SEGMENTS, "events": EVENTS})
+
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    engine = oddvoices.realtime.RealtimeEngine(synth, block_size=96)
+    names = [synth.database["segments_list"][i] if i >= 0 else "-" for i in SEGMENTS]
+    engine.send({"segments": names}, 0.0)
+    time = 0.0
+    for event in EVENTS:
+        engine.send(
+            {key: value for key, value in event.items() if key != "duration"}, time
+        )
+        time += event["duration"]
+    blocks = [engine.process_block() for i in range(len(expected) // 96 + 1)]
+    result = np.concatenate(blocks)[: len(expected)]
+
+    assert np.max(np.abs(expected)) > 0.1
+    np.testing.assert_array_equal(result, expected)
+    assert engine.stats.events == 5
+    assert engine.stats.late_events == 0
+
+
+def test_midi_latency_and_deadlines():
+    clock = FakeClock()
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    engine = oddvoices.realtime.RealtimeEngine(synth, block_size=80, clock=clock)
+    adapter = oddvoices.realtime.MidiAdapter(engine)
+    engine.send({"segments": ["_A", "A", "A_"]})
+    engine.start()
+    block_duration = 80 / synth.sample_rate
+
+    messages = {
+        3: [mido.Message("note_on", note=60, velocity=100)],
+        5: [mido.Message("note_on", note=64, velocity=100)],
+        8: [mido.Message("note_off", note=64)],
+        12: [mido.Message("note_on", note=60, velocity=0)],
+    }
+    for i in range(20):
+        for message in messages.get(i, []):
+            adapter.send(message)
+        engine.process_block()
+        clock.now += block_duration
+
+    stats = engine.stats
+    assert stats.events == 5
+    assert stats.late_events == 0
+    assert stats.deadline_misses == 0
+    expected_latency = engine.latency + block_duration
+    assert abs(stats.max_latency - expected_latency) < 1 / synth.sample_rate
+    assert synth.frequency == oddvoices.utils.midi_note_to_hertz(60)
+    assert synth.note_offs == 0 and not synth.is_active()
+
+    # A block that starts after it should already be playing misses its deadline.
+    clock.now += 1.0
+    engine.process_block()
+    assert engine.stats.deadline_misses == 1
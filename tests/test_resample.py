@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import oddvoices.frontend
+import oddvoices.resample
+import oddvoices.synth
+import common
+
+
+@pytest.mark.parametrize(
+    "input_rate, output_rate", [(44100, 48000), (48000, 44100), (8000, 44100)]
+)
+def test_resample_blocks(input_rate, output_rate):
+    t = np.arange(input_rate) / input_rate
+    signal = np.sin(2 * np.pi * 440 * t).astype(np.float32)
+    blocks = [signal[i : i + 1000] for i in range(0, len(signal), 1000)]
+    result = np.concatenate(
+        list(oddvoices.resample.resample_blocks(blocks, input_rate, output_rate))
+    )
+    assert len(result) == output_rate
+
+    # Away from the edges, the output is the same sine at the new rate.
+    t = np.arange(len(result)) / output_rate
+    expected = np.sin(2 * np.pi * 440 * t)
+    np.testing.assert_allclose(result[100:-100], expected[100:-100], atol=1e-3)
+
+    # The output does not depend on how the input is split into blocks.
+    whole = np.concatenate(
+        list(oddvoices.resample.resample_blocks([signal], input_rate, output_rate))
+    )
+    assert np.all(result == whole)
+
+
+def test_resample_output():
+    database = common.make_test_database()
+    music = {
+        "segments": [-1, 1, 2, 3],
+        "events": [
+            {"frequency": 200, "duration": 0.5, "note_on": True},
+            {"duration": 0.1, "note_off": True},
+        ],
+    }
+    synth = oddvoices.synth.Synth(database)
+    blocks = oddvoices.synth.sing_blocks(synth, music, block_size=256)
+    blocks, rate = oddvoices.frontend.resample_output(blocks, synth, 16000, True)
+    result = np.concatenate(list(blocks))
+    assert rate == 16000
+
+    # Grains start on the sample grid of the rate they are rendered at, so the
+    # result only matches rendering at the higher rate in length and level.
+    synth = oddvoices.synth.Synth(database, sample_rate=16000)
+    expected = oddvoices.synth.sing(synth, music)
+    assert len(result) == len(expected)
+    rms = np.sqrt(np.mean(np.square(result)))
+    expected_rms = np.sqrt(np.mean(np.square(expected)))
+    assert abs(rms - expected_rms) < 0.1 * expected_rms
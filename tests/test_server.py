@@ -0,0 +1,44 @@
+import json
+import threading
+
+import numpy as np
+import soundfile
+
+import oddvoices.corpus
+import oddvoices.frontend
+import oddvoices.server
+import common
+
+SPEC = {"text": "/mA/ /Am/", "notes": [60, 64], "durations": [0.5]}
+
+
+def test_run_remote_without_server(tmp_path):
+    socket_path = str(tmp_path / "missing.sock")
+    assert oddvoices.server.run_remote("sing", [], socket_path) is None
+
+
+def test_run_remote(tmp_path, monkeypatch):
+    voice_file = str(tmp_path / "test.voice")
+    with open(voice_file, "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+    with open(tmp_path / "music.json", "w") as f:
+        json.dump(SPEC, f)
+    oddvoices.frontend.sing(voice_file, SPEC, str(tmp_path / "expected.wav"))
+
+    socket_path = str(tmp_path / "server.sock")
+    server = oddvoices.server.Server(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        monkeypatch.chdir(tmp_path)
+        argv = ["test.voice", "music.json", "result.wav", "--server"]
+        assert oddvoices.server.run_remote("sing", argv, socket_path) == 0
+        assert oddvoices.server.run_remote("sing", ["--bad"], socket_path) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    expected, rate = soundfile.read(tmp_path / "expected.wav")
+    result, rate = soundfile.read(tmp_path / "result.wav")
+    assert len(result) > 0
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,108 @@
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+import soundfile
+
+import oddvoices.corpus
+import oddvoices.service
+import oddvoices.sinks
+import oddvoices.synth
+import common
+from test_synth import EXAMPLE_MUSIC
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    voice_file = str(tmp_path_factory.mktemp("voices") / "test.voice")
+    with open(voice_file, "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+    service = oddvoices.service.RenderService(
+        {"test": voice_file}, workers=2, preload_dictionary=False
+    )
+    server = oddvoices.service.HTTPServer(("127.0.0.1", 0), service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def request(server, path, body=None):
+    url = f"http://127.0.0.1:{server.server_port}{path}"
+    data = None if body is None else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(url, data) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, error.read()
+
+
+def test_render(server):
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    status, headers, body = request(server, "/render", EXAMPLE_MUSIC)
+    assert status == 200
+    result, rate = soundfile.read(io.BytesIO(body), dtype="float32")
+    assert rate == 8000
+    np.testing.assert_array_equal(result, expected)
+
+    status, headers, body = request(
+        server, "/render?voice=test&format=raw&sample_format=int16", EXAMPLE_MUSIC
+    )
+    assert status == 200
+    assert headers["X-Sample-Format"] == "int16"
+    result = np.frombuffer(body, dtype="<i2")
+    np.testing.assert_array_equal(
+        result, oddvoices.sinks.convert_block(expected, "int16")
+    )
+
+    status, headers, body = request(server, "/metrics")
+    metrics = json.loads(body)
+    assert metrics["completed"] >= 2
+    assert metrics["in_flight"] == 0
+    assert metrics["workers_alive"] == 2
+
+
+def test_errors(server):
+    assert request(server, "/voices")[2] == b'["test"]'
+    assert request(server, "/render?voice=other", EXAMPLE_MUSIC)[0] == 404
+    assert request(server, "/render?format=mp3", EXAMPLE_MUSIC)[0] == 400
+    assert request(server, "/render?sample_rate=abc", EXAMPLE_MUSIC)[0] == 400
+    assert request(server, "/render?sample_rate=-1", EXAMPLE_MUSIC)[0] == 400
+
+    server.service.timeout = 0
+    try:
+        assert request(server, "/render", EXAMPLE_MUSIC)[0] == 504
+    finally:
+        server.service.timeout = 60.0
+
+
+def test_slow_client(server):
+    # A client that reads nothing holds the worker at MAX_PENDING_BLOCKS blocks
+    # ahead instead of letting it buffer the whole render.
+    music = {"segments": EXAMPLE_MUSIC["segments"], "events": []}
+    for i in range(16):
+        music["events"] += EXAMPLE_MUSIC["events"]
+    messages = server.service.render(
+        dict(voice="test", spec=music, sample_format="float32", sample_rate=None)
+    )
+    assert next(messages)[0] == "start"
+    time.sleep(1)
+    blocks = 0
+    for kind, value in messages:
+        if kind == "block":
+            blocks += 1
+            if blocks == 1:
+                with server.service.lock:
+                    job_queue = list(server.service.job_queues.values())[0]
+                assert job_queue.qsize() <= oddvoices.service.MAX_PENDING_BLOCKS
+    assert kind == "done"
+    assert blocks > oddvoices.service.MAX_PENDING_BLOCKS
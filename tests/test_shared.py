@@ -0,0 +1,48 @@
+import concurrent.futures
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import oddvoices.cache
+import oddvoices.corpus
+import oddvoices.shared
+import oddvoices.synth
+import common
+from test_synth import EXAMPLE_MUSIC
+
+
+def render_shared(voice_file):
+    database = oddvoices.cache.load_database(voice_file)
+    frames = database.get("frames", database["segments"]["A"].get("frames"))
+    assert not frames.flags.writeable
+    return oddvoices.synth.sing(oddvoices.synth.Synth(database), EXAMPLE_MUSIC)
+
+
+@pytest.mark.parametrize("float_arena", [False, True])
+def test_shared_voice(tmp_path, float_arena):
+    voice_file = str(tmp_path / "test.voice")
+    with open(voice_file, "wb") as f:
+        oddvoices.corpus.write_voice_file(f, common.make_test_database())
+    with open(voice_file, "rb") as f:
+        database = oddvoices.corpus.read_voice_file(f, float_arena=float_arena)
+    expected = oddvoices.synth.sing(oddvoices.synth.Synth(database), EXAMPLE_MUSIC)
+
+    voice = oddvoices.shared.SharedVoice.publish(voice_file, float_arena=float_arena)
+    with voice:
+        shared_database = voice.database
+        assert oddvoices.cache.load_database(voice_file) is shared_database
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(
+            2,
+            mp_context=context,
+            initializer=oddvoices.shared.install,
+            initargs=([voice.handle],),
+        ) as executor:
+            results = list(executor.map(render_shared, [voice_file] * 2))
+    for result in results:
+        np.testing.assert_array_equal(result, expected)
+
+    with pytest.raises(FileNotFoundError):
+        oddvoices.shared.attach(voice.handle)
+    assert oddvoices.cache.load_database(voice_file) is not shared_database
@@ -0,0 +1,56 @@
+import io
+
+import numpy as np
+import soundfile
+
+import oddvoices.sinks
+
+
+class ListSink:
+    def __init__(self):
+        self.blocks = []
+        self.closed = False
+
+    def write(self, block):
+        self.blocks.append(block)
+
+    def close(self):
+        self.closed = True
+
+
+def test_convert_block():
+    block = np.array([0.0, 0.5, -1.0, 2.0], dtype="float32")
+    np.testing.assert_array_equal(
+        oddvoices.sinks.convert_block(block, "int16"), [0, 16384, -32767, 32767]
+    )
+
+
+def test_raw_sink():
+    stream = io.BytesIO()
+    sink = oddvoices.sinks.RawSink(stream, "int16")
+    sink.write(np.array([1, 2, -3], dtype=np.int16))
+    sink.close()
+    assert stream.getvalue() == b"\x01\x00\x02\x00\xfd\xff"
+
+
+def test_threaded_sink():
+    list_sink = ListSink()
+    sink = oddvoices.sinks.ThreadedSink(list_sink, max_blocks=2)
+    for i in range(10):
+        sink.write(np.full(4, i))
+    sink.close()
+    assert list_sink.closed
+    assert [block[0] for block in list_sink.blocks] == list(range(10))
+
+
+def test_sound_file_sink(tmp_path):
+    path = str(tmp_path / "out.wav")
+    sink = oddvoices.sinks.open_sink(path, 8000, "int16")
+    for i in range(3):
+        sink.write(oddvoices.sinks.convert_block(np.full(100, 0.25 * i), "int16"))
+    sink.close()
+
+    result, rate = soundfile.read(path, dtype="int16")
+    assert rate == 8000
+    assert soundfile.info(path).subtype == "PCM_16"
+    np.testing.assert_array_equal(result[::100], [0, 8192, 16384])
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+import pytest
+
+import common
+
+# For the module behind each command line entry point: heavy modules its import
+# must not load, and a budget in seconds for its cumulative import time, which is
+# several times what it takes on a typical machine.
+ENTRY_POINTS = [
+    ("oddvoices.server", ["numpy", "scipy", "soundfile", "mido"], 0.25),
+    ("oddvoices.frontend", ["scipy", "soundfile", "mido"], 0.6),
+    ("oddvoices.midi_frontend", ["scipy", "soundfile", "mido"], 0.6),
+    ("oddvoices.g2p", ["numpy", "scipy", "soundfile", "mido"], 0.25),
+    ("oddvoices.corpus", ["mido"], None),
+]
+
+
+def get_import_times(module):
+    """Import a module in a fresh interpreter and return the cumulative import
+    time in seconds of every module it loaded."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=common.TEST_ROOT,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+@pytest.mark.parametrize("module, forbidden, budget", ENTRY_POINTS)
+def test_startup(module, forbidden, budget):
+    times = get_import_times(module)
+    loaded = set([name.split(".")[0] for name in times])
+    assert loaded.isdisjoint(forbidden)
+    if budget is not None:
+        assert times[module] < budget
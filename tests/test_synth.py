@@ -0,0 +1,298 @@
+import concurrent.futures
+import copy
+import io
+
+import numpy as np
+import pytest
+
+import oddvoices.corpus
+import oddvoices.curves
+import oddvoices.phrase_cache
+import oddvoices.synth
+import common
+
+EXAMPLE_MUSIC = {
+    "segments": [-1, 1, 2, 3, -1, 4, 6, 7, 8],
+    "events": [
+        {"frequency": 100, "duration": 0.5, "note_on": True},
+        {"duration": 0.1, "note_off": True},
+        {"frequency": 150, "duration": 0.5, "note_on": True, "formant_shift": 1.5},
+        {"duration": 0.1, "note_off": True},
+    ],
+}
+
+
+def test_frame_arena_matches_int16():
+    database = common.make_test_database()
+    synth = oddvoices.synth.Synth(database)
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    database = common.make_test_database()
+    oddvoices.corpus.make_frame_arena(database)
+    synth = oddvoices.synth.Synth(database)
+    result = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    assert np.max(np.abs(expected)) > 0.1
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-4)
+
+
+def test_compressed_voice_matches_raw():
+    database = common.make_test_database()
+    synth = oddvoices.synth.Synth(database)
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    f = io.BytesIO()
+    oddvoices.corpus.write_voice_file(f, database, compress=True)
+    f.seek(0)
+    database = oddvoices.corpus.read_voice_file(f)
+    synth = oddvoices.synth.Synth(database)
+    result = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    assert np.all(result == expected)
+    # Only the segments that were sung have been decoded.
+    assert database["segments"]["_"]["decoded"] == []
+    oddvoices.phrase_cache.get_voice_fingerprint(database)
+    assert database["segments"]["_"]["decoded"] == []
+
+
+def test_compressed_voice_threads():
+    database = common.make_test_database()
+    synth = oddvoices.synth.Synth(database)
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    f = io.BytesIO()
+    oddvoices.corpus.write_voice_file(f, database, compress=True)
+    f.seek(0)
+    database = oddvoices.corpus.read_voice_file(f)
+
+    def render(_):
+        return oddvoices.synth.sing(oddvoices.synth.Synth(database), EXAMPLE_MUSIC)
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(render, range(8)))
+    assert all(np.all(result == expected) for result in results)
+    assert all(
+        len(segment["decoded"]) <= 1 and "encoded" in segment
+        for segment in database["segments"].values()
+    )
+
+
+def test_frame_pool_matches_int16():
+    database = common.make_test_database()
+    synth = oddvoices.synth.Synth(database)
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    oddvoices.corpus.dedupe_frames(database, 0.0)
+    assert "frames" not in database["segments"]["A"]
+    synth = oddvoices.synth.Synth(database)
+    result = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    assert np.all(result == expected)
+
+
+def test_draft_synth():
+    database = common.make_test_database()
+    music = {
+        "segments": [-1, 1, 2, 3],
+        "events": [
+            {"frequency": 800, "duration": 0.5, "note_on": True},
+            {"duration": 0.1, "note_off": True},
+        ],
+    }
+    synth = oddvoices.synth.Synth(database)
+    stats = synth.enable_stats()
+    expected = oddvoices.synth.sing(synth, music)
+    assert stats.peak_grains > 2
+
+    # Without resampling or formant shift, grains read whole samples, so only the
+    # cap on overlapping grains changes the output.
+    synth = oddvoices.synth.DraftSynth(database, max_grains=stats.peak_grains)
+    assert synth.sample_rate == database["rate"]
+    assert np.all(oddvoices.synth.sing(synth, music) == expected)
+
+    synth = oddvoices.synth.DraftSynth(database, max_grains=2)
+    plan = oddvoices.synth.plan(synth, music)
+    stats = synth.enable_stats()
+    result = oddvoices.synth.sing(synth, music)
+    assert len(result) == len(expected)
+    assert stats.peak_grains == 2
+    assert plan["peak_grains"] == 2
+    assert plan["num_grains"] == stats.grains_started
+
+
+def test_render_curve():
+    curve = {"points": [[0.5, 200], [1.0, 400, "exponential"]]}
+    result = oddvoices.curves.render_curve(curve, 100, 12, 8)
+    np.testing.assert_allclose(
+        result,
+        [100, 125, 150, 175, 200, 200 * 2**0.25, 200 * 2**0.5, 200 * 2**0.75]
+        + [400] * 4,
+    )
+
+
+def test_empty_curve():
+    music = copy.deepcopy(EXAMPLE_MUSIC)
+    music["events"][0]["frequency"] = {"points": []}
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    with pytest.raises(ValueError, match="no points"):
+        oddvoices.synth.sing(synth, music)
+    with pytest.raises(ValueError, match="no points"):
+        oddvoices.synth.sing(
+            synth, music, phrase_cache=oddvoices.phrase_cache.PhraseCache()
+        )
+
+
+def test_constant_curve_matches_scalar():
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    music = copy.deepcopy(EXAMPLE_MUSIC)
+    music["events"][0]["frequency"] = {"points": [[0, 100]]}
+    music["events"][2]["formant_shift"] = {"points": [[0, 1.5], [0.5, 1.5]]}
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    result = oddvoices.synth.sing(synth, music)
+
+    np.testing.assert_array_equal(result, expected)
+    assert synth.formant_shift == 1.5
+
+
+def test_vibrato():
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    flat = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    music = copy.deepcopy(EXAMPLE_MUSIC)
+    music["events"][0]["vibrato"] = {"rate": 5, "depth": 1, "delay": 0.1}
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    result = oddvoices.synth.sing(synth, music)
+
+    assert len(result) == len(flat)
+    np.testing.assert_array_equal(result[:800], flat[:800])
+    assert not np.allclose(result, flat)
+    assert synth.frequency == 150
+
+
+class _CountingSynth(oddvoices.synth.Synth):
+    def __init__(self, database):
+        super().__init__(database)
+        self.num_grains = 0
+        self.peak_grains = 0
+
+    def _start_grain(self):
+        self.num_grains += 1 if self.segment_id != "-" else 0
+        super()._start_grain()
+
+    def process(self):
+        result = super().process()
+        self.peak_grains = max(self.peak_grains, len(self.grains))
+        return result
+
+
+def test_plan_matches_render():
+    music = copy.deepcopy(EXAMPLE_MUSIC)
+    music["events"][2]["vibrato"] = {"rate": 6, "depth": 2}
+    synth = _CountingSynth(common.make_test_database())
+
+    plan = oddvoices.synth.plan(synth, music)
+    result = oddvoices.synth.sing(synth, music)
+
+    assert plan["num_samples"] == len(result)
+    assert plan["num_grains"] == synth.num_grains
+    assert plan["peak_grains"] == synth.peak_grains
+    assert plan["num_segments"] == 7
+
+
+def test_stats():
+    music = copy.deepcopy(EXAMPLE_MUSIC)
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    plan = oddvoices.synth.plan(synth, music)
+    stats = synth.enable_stats()
+    oddvoices.synth.sing(synth, music)
+
+    assert stats.samples_rendered == plan["num_samples"]
+    assert stats.grains_started == plan["num_grains"]
+    assert stats.peak_grains == plan["peak_grains"]
+    assert stats.segment_transitions == plan["num_segments"] + 2
+    assert 0 < stats.average_live_grains <= stats.peak_grains
+    assert stats.as_dict()["samples_per_second"] > 0
+
+
+def test_sing_blocks():
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    expected = oddvoices.synth.sing(synth, EXAMPLE_MUSIC)
+
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    blocks = list(oddvoices.synth.sing_blocks(synth, EXAMPLE_MUSIC, block_size=1000))
+
+    assert [len(block) for block in blocks] == [1000] * 9 + [600]
+    np.testing.assert_array_equal(np.concatenate(blocks), expected)
+
+
+def test_phrase_cache(tmp_path):
+    music: dict = {"segments": [-1, 1, 2, 3] * 4, "events": []}
+    for i in range(4):
+        music["events"] += [
+            {"duration": 0.2},
+            {"frequency": 100, "duration": 0.5, "note_on": True},
+            {"duration": 0.3, "note_off": True},
+        ]
+
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    synth.canonical_phrase_starts = True
+    expected = oddvoices.synth.sing(synth, music)
+
+    cache = oddvoices.phrase_cache.PhraseCache(directory=tmp_path)
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    synth.canonical_phrase_starts = True
+    result = oddvoices.synth.sing(synth, music, phrase_cache=cache)
+    np.testing.assert_array_equal(result, expected)
+    # The first note starts from a fresh synth and the last one has no rest
+    # after it, so only the middle two are the same.
+    assert cache.hits == 1
+
+    # A new cache finds the phrase in the directory.
+    cache = oddvoices.phrase_cache.PhraseCache(directory=tmp_path)
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    synth.canonical_phrase_starts = True
+    stats = synth.enable_stats()
+    result = oddvoices.synth.sing(synth, music, phrase_cache=cache)
+    np.testing.assert_array_equal(result, expected)
+    # The leading rest and the four notes.
+    assert cache.hits == 5
+    assert stats.samples_rendered == 0
+    assert stats.cached_samples == len(result)
+    assert stats.cache_seconds > 0
+
+
+def test_phrase_cache_is_exact(tmp_path):
+    music = copy.deepcopy(EXAMPLE_MUSIC)
+    music["events"].insert(2, {"duration": 0.2})
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    expected = oddvoices.synth.sing(synth, music)
+
+    for i in range(2):
+        cache = oddvoices.phrase_cache.PhraseCache(directory=tmp_path)
+        synth = oddvoices.synth.Synth(common.make_test_database())
+        result = oddvoices.synth.sing(synth, music, phrase_cache=cache)
+        np.testing.assert_array_equal(result, expected)
+    assert cache.hits > 0
+
+
+def test_progress_and_cancel():
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    reports = []
+    audio = oddvoices.synth.sing(
+        synth, EXAMPLE_MUSIC, progress=lambda *report: reports.append(report)
+    )
+    total = oddvoices.synth.get_num_samples(synth, EXAMPLE_MUSIC)
+    assert len(audio) == total
+    assert reports[-1] == (total, total)
+
+    synth = oddvoices.synth.Synth(common.make_test_database())
+    cancel = oddvoices.synth.CancellationToken()
+    blocks = oddvoices.synth.sing_blocks(
+        synth, EXAMPLE_MUSIC, block_size=1000, cancel=cancel
+    )
+    next(blocks)
+    cancel.cancel()
+    with pytest.raises(oddvoices.synth.RenderCancelled):
+        next(blocks)